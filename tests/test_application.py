@@ -255,6 +255,300 @@ class ApplicationTest(asynctest.TestCase):
 
         self.assertEqual(response.data, b"['a.txt']")
 
+    async def testMultipartStreaming(self):
+        urls = ("/upload", "upload")
+
+        class upload:
+            def POST(self):
+                i = web.input(file={})
+                return "%s:%s" % (i.x, i.file["a.txt"].read().decode("utf-8"))
+
+        app = web.application(urls, locals())
+        body = "\r\n".join(
+            [
+                "--boundary",
+                'Content-Disposition: form-data; name="x"',
+                "",
+                "foo",
+                "--boundary",
+                'Content-Disposition: form-data; name="file"; filename="a.txt"',
+                "Content-Type: text/plain",
+                "",
+                "abcdef",
+                "--boundary--",
+                "",
+            ]
+        ).encode("utf-8")
+        chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+
+        async def post():
+            scope = dict(
+                server=["0.0.0.0", 8080],
+                method="POST",
+                path="/upload",
+                query_string=b"",
+                headers=[(b"content_type", b"multipart/form-data; boundary=boundary")],
+                scheme="http",
+                root_path="",
+            )
+            response = web.storage(data=b"")
+
+            async def receive():
+                chunk = chunks.pop(0) if chunks else b""
+                return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    response.status = message["status"]
+                else:
+                    response.data += message["body"]
+
+            await app.asgifunc()(scope)(receive, send)
+            return response
+
+        response = await post()
+        self.assertEqual(response.data, b"foo:abcdef")
+
+        chunks = [body[:60]]
+        response = await post()
+        self.assertEqual(response.status, "400 Bad Request")
+
+        chunks = [b"garbage" + body]
+        response = await post()
+        self.assertEqual(response.status, "400 Bad Request")
+
+        web.config.upload_max_memory_size = 2
+        web.config.upload_max_file_size = 3
+        web.config.form_max_value_length = 3
+        try:
+            chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+            response = await post()
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+
+            # fields which aren't files are limited too
+            del web.config.upload_max_file_size
+            web.config.form_max_value_length = 2
+            chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+            response = await post()
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+            del web.config.form_max_value_length
+            chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+            response = await post()
+            self.assertEqual(response.status, "413 Request Entity Too Large")
+        finally:
+            web.config.pop("upload_max_memory_size", None)
+            web.config.pop("upload_max_file_size", None)
+            web.config.pop("form_max_value_length", None)
+
+    async def testFieldLimits(self):
+        urls = ("/", "index")
+
+        class index:
+            def GET(self):
+                return repr(sorted(web.query().items()))
+
+            def POST(self):
+                return repr(sorted(web.input().items()))
+
+        app = web.application(urls, locals())
+
+        response = await app.request("/?a=1&b=x%20y&a=2&c=")
+        self.assertEqual(response.data, b"[('a', ['1', '2']), ('b', 'x y')]")
+
+        web.config.form_max_fields = 2
+        web.config.form_max_value_length = 3
+        try:
+            response = await app.request("/?a=1&b=2&c=3")
+            self.assertEqual(response.status, "400 Bad Request")
+            response = await app.request("/", method="POST", data="a=1234")
+            self.assertEqual(response.status, "400 Bad Request")
+            response = await app.request("/", method="POST", data="a=123&b=4")
+            self.assertEqual(response.data, b"[('a', '123'), ('b', '4')]")
+            # empty fields don't count
+            response = await app.request("/", method="POST", data="&" * 10000 + "a=1&&b=2&")
+            self.assertEqual(response.data, b"[('a', '1'), ('b', '2')]")
+            response = await app.request("/", method="POST", data="&" * 10000 + "a=1&b=2&c")
+            self.assertEqual(response.status, "400 Bad Request")
+        finally:
+            del web.config.form_max_fields
+            del web.config.form_max_value_length
+
+    async def testJSON(self):
+        urls = ("/", "index", "/stream", "stream", "/row", "row")
+
+        class index:
+            def POST(self):
+                return web.JSONResponse({"got": web.json()})
+
+        class row:
+            def GET(self):
+                return web.JSONResponse(web.db.row_class(("id", "name"))((1, "bob")))
+
+        class stream:
+            def GET(self):
+                return web.JSONResponse((x * x for x in range(int(web.query().n))), chunk_size=4)
+
+        app = web.application(urls, locals())
+
+        response = await app.request("/", method="POST", data='{"a": [1, 2]}')
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+        self.assertEqual(response.data, b'{"got":{"a":[1,2]}}')
+
+        response = await app.request("/", method="POST", data="{")
+        self.assertEqual(response.status, "400 Bad Request")
+
+        response = await app.request("/stream?n=5")
+        self.assertEqual(response.data, b"[0,1,4,9,16]")
+        response = await app.request("/stream?n=0")
+        self.assertEqual(response.data, b"[]")
+
+        response = await app.request("/row")
+        self.assertEqual(response.data, b'{"id":1,"name":"bob"}')
+
+    async def testJSONItems(self):
+        urls = ("/stream", "stream", "/buffered", "buffered")
+        received = []
+
+        class stream:
+            @web.stream_body
+            async def POST(self):
+                seen = []
+                async for item in web.json_items("data.records"):
+                    seen.append((item["id"], len(received)))
+                return web.JSONResponse(seen)
+
+        class buffered:
+            async def POST(self):
+                return web.JSONResponse([item async for item in web.json_items()])
+
+        app = web.application(urls, locals())
+        body = b'{"data": {"count": 3, "records": [{"id": 1, "s": "],"}, {"id": 2}, {"id": 3}]}}'
+        chunks = [body[i : i + 5] for i in range(0, len(body), 5)]
+
+        async def receive():
+            received.append(chunks.pop(0))
+            return {"type": "http.request", "body": received[-1], "more_body": bool(chunks)}
+
+        response = web.storage(data=b"")
+
+        async def send(message):
+            response.data += message.get("body", b"")
+
+        scope = dict(
+            server=["0.0.0.0", 8080],
+            method="POST",
+            path="/stream",
+            query_string=b"",
+            headers=[(b"content_type", b"application/json")],
+            scheme="http",
+            root_path="",
+        )
+        await app.asgifunc()(scope)(receive, send)
+        seen = web.jsonutils.loads(response.data)
+        self.assertEqual([i for i, _ in seen], [1, 2, 3])
+        # each record was yielded before the rest of the body had been received.
+        self.assertLess(seen[0][1], seen[1][1])
+        self.assertLess(seen[1][1], len(received))
+
+        # a long string split across many chunks is scanned once, not again with each chunk.
+        body = b'{"data": {"records": [{"id": 1, "s": "%s"}, {"id": 2}]}}' % (b'x\\"' * 1000000)
+        chunks[:] = [body[i : i + 16384] for i in range(0, len(body), 16384)]
+        response.data = b""
+        started = time.time()
+        await app.asgifunc()(scope)(receive, send)
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual([i for i, _ in web.jsonutils.loads(response.data)], [1, 2])
+
+        response = await app.request("/buffered", method="POST", data="[1, [2], {}]")
+        self.assertEqual(response.data, b"[1,[2],{}]")
+        for data in ["[1, 2", "[1, }", "[1,,2]", "[1, 2] x", "[1, 2]]"]:
+            response = await app.request("/buffered", method="POST", data=data)
+            self.assertEqual(response.status, "400 Bad Request", data)
+
+    async def testAutoETag(self):
+        urls = ("/", "index", "/stream", "stream", "/version", "version")
+        calls = []
+
+        class index:
+            def GET(self):
+                return "hello"
+
+        class stream:
+            def GET(self):
+                return (x for x in ["a", "b", "c"])
+
+        class version:
+            def GET(self):
+                web.modified(etag="v1")
+                calls.append(1)
+                return "expensive"
+
+        app = web.application(urls, locals())
+        app.add_processor(web.autoetag)
+
+        response = await app.request("/")
+        self.assertEqual(response.data, b"hello")
+        etag = response.headers["ETag"]
+        response = await app.request("/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status, "304 Not Modified")
+        self.assertEqual(response.data, b"")
+        response = await app.request("/", headers={"If-None-Match": '"other"'})
+        self.assertEqual(response.data, b"hello")
+
+        response = await app.request("/stream")
+        self.assertEqual(response.data, b"abc")
+        response = await app.request("/stream", headers={"If-None-Match": "W/" + response.headers["ETag"]})
+        self.assertEqual(response.status, "304 Not Modified")
+
+        response = await app.request("/version", headers={"If-None-Match": '"v1"'})
+        self.assertEqual(response.status, "304 Not Modified")
+        self.assertEqual(calls, [])
+        response = await app.request("/version")
+        self.assertEqual(response.headers["ETag"], '"v1"')
+        self.assertEqual(response.data, b"expensive")
+
+    async def testByteRanges(self):
+        urls = ("/", "index")
+        body = "".join(chr(ord("a") + i % 26) for i in range(100))
+
+        class index:
+            def GET(self):
+                web.header("Content-Type", "text/plain")
+                web.header("ETag", '"v1"')
+                return body
+
+        app = web.application(urls, locals())
+        app.add_processor(web.byteranges)
+
+        response = await app.request("/")
+        self.assertEqual(response.status, "200")
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+        response = await app.request("/", headers={"Range": "bytes=2-4"})
+        self.assertEqual(response.status, "206 Partial Content")
+        self.assertEqual(response.headers["Content-Range"], "bytes 2-4/100")
+        self.assertEqual(response.data, b"cde")
+
+        response = await app.request("/", headers={"Range": "bytes=0-0,-1"})
+        self.assertTrue(response.headers["Content-Type"].startswith("multipart/byteranges; boundary="))
+        self.assertIn(b"Content-Range: bytes 0-0/100\r\n\r\na\r\n", response.data)
+        self.assertIn(b"Content-Range: bytes 99-99/100\r\n\r\nv\r\n", response.data)
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+
+        response = await app.request("/", headers={"Range": "bytes=0-, 0-, 0-"})
+        self.assertEqual(response.status, "200")
+        self.assertEqual(len(response.data), 100)
+
+        response = await app.request("/", headers={"Range": "bytes=200-"})
+        self.assertEqual(response.status, "416 Range Not Satisfiable")
+        self.assertEqual(response.headers["Content-Range"], "bytes */100")
+
+        response = await app.request("/", headers={"Range": "bytes=2-4", "If-Range": '"v1"'})
+        self.assertEqual(response.data, b"cde")
+        response = await app.request("/", headers={"Range": "bytes=2-4", "If-Range": '"v0"'})
+        self.assertEqual(response.status, "200")
+        self.assertEqual(len(response.data), 100)
+
     async def testCustomNotFound(self):
         urls_a = ("/", "a")
         urls_b = ("/", "b")
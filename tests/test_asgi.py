@@ -0,0 +1,318 @@
+import gzip
+import zlib
+
+import pytest
+import asynctest
+
+import web
+
+pytestmark = pytest.mark.asyncio
+
+
+async def call(asgi, path="/", headers=(), chunks=(b"",), method="GET"):
+    """Runs one request through the ASGI callable `asgi` and collects the response."""
+    scope = dict(
+        server=["0.0.0.0", 8080],
+        method=method,
+        path=path,
+        query_string=b"",
+        headers=list(headers),
+        scheme="http",
+        root_path="",
+    )
+    chunks = list(chunks)
+    response = web.storage(bodies=[])
+
+    async def receive():
+        return {"type": "http.request", "body": chunks.pop(0) if chunks else b"", "more_body": bool(chunks)}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response.status = message["status"]
+            response.headers = dict(message["headers"])
+        else:
+            response.bodies.append(message["body"])
+
+    await asgi(scope)(receive, send)
+    response.data = b"".join(response.bodies)
+    return response
+
+
+class GzipMiddlewareTest(asynctest.TestCase):
+    def setUp(self):
+        urls = ("/big", "big", "/small", "small", "/stream", "stream", "/png", "png", "/partial", "partial")
+        text = "hello, world! " * 100
+
+        class big:
+            def GET(self):
+                web.header("ETag", '"v1"')
+                return text
+
+        class partial:
+            def GET(self):
+                web.ctx.status = "206 Partial Content"
+                web.header("Content-Range", "bytes 0-%d/%d" % (len(text) - 1, len(text) * 2))
+                return text
+
+        class small:
+            def GET(self):
+                return "hello"
+
+        class stream:
+            def GET(self):
+                web.header("Content-Type", "application/json")
+                return ("%d\n" % i * 100 for i in range(10))
+
+        class png:
+            def GET(self):
+                web.header("Content-Type", "image/png")
+                return text
+
+        self.text = text.encode("utf-8")
+        self.stream = b"".join(b"%d\n" % i * 100 for i in range(10))
+        self.middleware = None
+
+        def middleware(app):
+            self.middleware = web.GzipMiddleware(app)
+            return self.middleware
+
+        self.asgi = web.application(urls, locals()).asgifunc(middleware)
+
+    async def testGzip(self):
+        response = await call(self.asgi, "/big", [(b"accept-encoding", b"gzip, deflate")])
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.data))
+        self.assertEqual(gzip.decompress(response.data), self.text)
+        self.assertEqual(response.headers["ETag"], 'W/"v1"')
+
+        # the second identical body comes from the cache.
+        self.assertEqual(len(self.middleware.cache), 1)
+        again = await call(self.asgi, "/big", [(b"accept-encoding", b"gzip")])
+        self.assertEqual(again.data, response.data)
+        self.assertEqual(len(self.middleware.cache), 1)
+
+    async def testDeflate(self):
+        response = await call(self.asgi, "/big", [(b"accept-encoding", b"deflate")])
+        self.assertEqual(response.headers["Content-Encoding"], "deflate")
+        self.assertEqual(zlib.decompress(response.data), self.text)
+
+    async def testStreaming(self):
+        response = await call(self.asgi, "/stream", [(b"accept-encoding", b"gzip")])
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", response.headers)
+        self.assertEqual(gzip.decompress(response.data), self.stream)
+
+    async def testSkipped(self):
+        response = await call(self.asgi, "/big")
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(response.data, self.text)
+
+        response = await call(self.asgi, "/small", [(b"accept-encoding", b"gzip")])
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data, b"hello")
+
+        response = await call(self.asgi, "/partial", [(b"accept-encoding", b"gzip")])
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.data, self.text)
+
+        response = await call(self.asgi, "/png", [(b"accept-encoding", b"gzip")])
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertNotIn("Vary", response.headers)
+        self.assertEqual(response.data, self.text)
+
+
+class StaticMiddlewareTest(asynctest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.write("a.txt", b"hello, world")
+        self.write("big.bin", bytes(range(256)) * 1024)
+        self.write("page.html", b"<p>" * 100)
+        self.write("page.html.gz", gzip.compress(b"<p>" * 100))
+
+        class index:
+            def GET(self):
+                return "app"
+
+        self.middleware = None
+
+        def middleware(app):
+            self.middleware = web.StaticMiddleware(app, directory=self.root, memory_file_size=1024, chunk_size=65536)
+            return self.middleware
+
+        self.asgi = web.application(("/", "index"), locals()).asgifunc(middleware)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        with open(self.root + "/" + name, "wb") as f:
+            f.write(data)
+
+    async def testServe(self):
+        response = await call(self.asgi, "/static/a.txt")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.data, b"hello, world")
+        self.assertEqual(response.headers[b"content-type"], b"text/plain; charset=utf-8")
+        self.assertEqual(response.headers[b"content-length"], b"12")
+        self.assertIn(self.middleware.resolve("a.txt"), self.middleware.bodies)
+
+        etag = response.headers[b"etag"]
+        response = await call(self.asgi, "/static/a.txt", [(b"if-none-match", etag)])
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.data, b"")
+        response = await call(self.asgi, "/static/a.txt", [(b"if-none-match", b"W/" + etag)])
+        self.assertEqual(response.status, 304)
+
+        response = await call(self.asgi, "/static/big.bin")
+        self.assertEqual(response.data, bytes(range(256)) * 1024)
+        self.assertGreater(len(response.bodies), 1)
+
+        self.assertEqual((await call(self.asgi, "/")).data, b"app")
+        self.assertEqual((await call(self.asgi, "/static/nothing")).status, 404)
+        self.assertEqual((await call(self.asgi, "/static/../a.txt")).status, 404)
+        self.assertEqual((await call(self.asgi, "/static/a.txt", method="POST")).status, 405)
+
+    async def testChanged(self):
+        self.assertEqual((await call(self.asgi, "/static/a.txt")).data, b"hello, world")
+        self.write("a.txt", b"bye")
+        self.middleware.check_interval = 0
+        self.assertEqual((await call(self.asgi, "/static/a.txt")).data, b"bye")
+
+    async def testGzipSibling(self):
+        response = await call(self.asgi, "/static/page.html", [(b"accept-encoding", b"gzip")])
+        self.assertEqual(response.headers[b"content-encoding"], b"gzip")
+        self.assertEqual(response.headers[b"content-type"], b"text/html; charset=utf-8")
+        self.assertEqual(gzip.decompress(response.data), b"<p>" * 100)
+
+        response = await call(self.asgi, "/static/page.html")
+        self.assertNotIn(b"content-encoding", response.headers)
+        self.assertEqual(response.headers[b"vary"], b"Accept-Encoding")
+        self.assertEqual(response.data, b"<p>" * 100)
+
+    async def testFingerprint(self):
+        manifest = web.StaticManifest(self.root)
+        files = manifest.build()
+        self.assertEqual(sorted(files), ["a.txt", "big.bin", "page.html"])
+        self.assertEqual(web.StaticManifest(self.root).files, files)
+
+        url = manifest.url("a.txt")
+        self.assertRegex(url, r"^/static/a\.[0-9a-f]{12}\.txt$")
+        web.config.static_manifest = manifest
+        try:
+            self.assertEqual(web.static_url("a.txt"), url)
+            self.assertIs(web.template.Template.globals["static_url"], web.static_url)
+        finally:
+            del web.config.static_manifest
+
+        self.middleware.manifest = manifest
+        response = await call(self.asgi, url)
+        self.assertEqual(response.data, b"hello, world")
+        self.assertEqual(response.headers[b"cache-control"], b"public, max-age=31536000, immutable")
+        response = await call(self.asgi, "/static/a.txt")
+        self.assertNotIn(b"cache-control", response.headers)
+        self.assertEqual((await call(self.asgi, "/static/a.000000000000.txt")).status, 404)
+        self.assertEqual((await call(self.asgi, "/static/manifest.json")).status, 404)
+
+        # a file changed since the manifest was built isn't served under its old hash.
+        self.write("a.txt", b"bye")
+        self.middleware.check_interval = 0
+        self.assertEqual((await call(self.asgi, url)).status, 404)
+        self.assertEqual((await call(self.asgi, "/static/a.txt")).data, b"bye")
+
+    async def testRange(self):
+        response = await call(self.asgi, "/static/big.bin", [(b"range", b"bytes=256-511")])
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.headers[b"content-range"], b"bytes 256-511/262144")
+        self.assertEqual(response.data, bytes(range(256)))
+
+        response = await call(self.asgi, "/static/a.txt", [(b"range", b"bytes=0-1,-2")])
+        self.assertEqual(response.status, 206)
+        self.assertIn(b"\r\n\r\nhe\r\n", response.data)
+        self.assertIn(b"\r\n\r\nld\r\n", response.data)
+
+        response = await call(self.asgi, "/static/a.txt", [(b"range", b"bytes=100-")])
+        self.assertEqual(response.status, 416)
+
+        # overlapping ranges adding up to more than the file get the file once.
+        response = await call(self.asgi, "/static/big.bin", [(b"range", b",".join([b"bytes=0-"] + [b"0-"] * 15))])
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(response.data), 262144)
+
+        # adjacent ranges are merged.
+        response = await call(self.asgi, "/static/big.bin", [(b"range", b"bytes=0-99,100-199")])
+        self.assertEqual(response.headers[b"content-range"], b"bytes 0-199/262144")
+
+        # the parts of a multipart/byteranges body are sent piece by piece.
+        response = await call(self.asgi, "/static/big.bin", [(b"range", b"bytes=0-99999,-100000")])
+        self.assertEqual(response.status, 206)
+        self.assertEqual(int(response.headers[b"content-length"]), len(response.data))
+        self.assertGreater(len(response.bodies), 4)
+        self.assertIn(b"Content-Range: bytes 162144-262143/262144\r\n\r\n" + bytes(range(96, 256)), response.data)
+
+
+class AccessLogMiddlewareTest(asynctest.TestCase):
+    def setUp(self):
+        import io
+
+        urls = ("/hello/(.*)", "hello")
+
+        class hello:
+            def GET(self, name):
+                if name == "missing":
+                    raise web.notfound()
+                return "hello, " + name
+
+        self.stream = io.StringIO()
+        self.middleware = None
+        self.app = web.application(urls, locals())
+
+    def asgi(self, **kw):
+        def middleware(app):
+            self.middleware = web.AccessLogMiddleware(app, stream=self.stream, flush_interval=0, **kw)
+            return self.middleware
+
+        return self.app.asgifunc(middleware)
+
+    async def testCommon(self):
+        asgi = self.asgi()
+        await call(asgi, "/hello/world")
+        await call(asgi, "/hello/missing")
+        await self.middleware.close()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertRegex(lines[0], r'^- - - \[.*\] "GET /hello/world HTTP/1.1" 200 12$')
+        self.assertRegex(lines[1], r'"GET /hello/missing HTTP/1.1" 404 9$')
+
+    async def testCommonEscaping(self):
+        asgi = self.asgi()
+        await call(asgi, '/hello/x" 200 1\n1.2.3.4 - - [x] "GET /\\')
+        await self.middleware.close()
+        lines = self.stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('"GET /hello/x\\x22 200 1\\x0a1.2.3.4 - - [x] \\x22GET /\\x5c HTTP/1.1" 404', lines[0])
+
+    async def testJSON(self):
+        asgi = self.asgi(format="json")
+        await call(asgi, "/hello/world")
+        await self.middleware.close()
+        record = web.jsonutils.loads(self.stream.getvalue())
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["route"], "/hello/(.*)")
+        self.assertEqual(record["bytes"], 12)
+
+    async def testSamplingAndDrops(self):
+        asgi = self.asgi(sample_2xx=0, queue_size=1)
+        await call(asgi, "/hello/world")
+        self.assertIsNone(self.middleware.queue)
+
+        # nothing runs the writer between these, so the second record overflows.
+        self.middleware.log({"path": "/a"}, 500, 0, 0.1)
+        self.middleware.log({"path": "/b"}, 500, 0, 0.1)
+        self.assertEqual(self.middleware.dropped, 1)
+        await self.middleware.close()
+        self.assertIn('"- /a HTTP/1.1" 500 -', self.stream.getvalue())
@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+import asynctest
+
+import web
+
+pytestmark = pytest.mark.asyncio
+
+
+class ResponseCacheTest(asynctest.TestCase):
+    def setUp(self):
+        urls = (
+            "/",
+            "index",
+            "/item/(.*)",
+            "item",
+            "/slow",
+            "slow",
+            "/lang",
+            "lang",
+            "/cookie",
+            "cookie",
+            "/stream",
+            "stream",
+            "/public",
+            "public",
+        )
+        self.calls = calls = []
+        self.cache = cache = web.ResponseCache(ttl=60, stale=60)
+
+        class index:
+            def GET(self):
+                calls.append("index")
+                return "index %d" % len(calls)
+
+        class item:
+            def GET(self, id):
+                cache.tag("item:" + id)
+                calls.append(id)
+                return "item %s %d" % (id, len(calls))
+
+        class slow:
+            async def GET(self):
+                calls.append("slow")
+                await asyncio.sleep(0.05)
+                return "slow"
+
+        class lang:
+            def GET(self):
+                web.header("Vary", "Accept-Language")
+                calls.append("lang")
+                return web.ctx.scope["headers"].get("http_accept_language", "")
+
+        class cookie:
+            def GET(self):
+                web.setcookie("a", "b")
+                calls.append("cookie")
+                return "cookie"
+
+        class stream:
+            def GET(self):
+                calls.append("stream")
+                for i in range(int(web.input(n="4").n)):
+                    yield "x" * 10
+
+        class public:
+            def GET(self):
+                web.header("Cache-Control", "public")
+                calls.append("public")
+                return "public"
+
+        self.app = web.application(urls, locals())
+        self.app.add_processor(cache)
+
+    async def testHit(self):
+        a = await self.app.request("/")
+        b = await self.app.request("/")
+        self.assertEqual(a.data, b"index 1")
+        self.assertEqual(b.data, b"index 1")
+        self.assertEqual((await self.app.request("/?x=1")).data, b"index 2")
+
+        await self.app.request("/cookie")
+        await self.app.request("/cookie")
+        self.assertEqual(self.calls.count("cookie"), 2)
+
+    async def testVary(self):
+        en = await self.app.request("/lang", headers={"Accept-Language": "en"})
+        de = await self.app.request("/lang", headers={"Accept-Language": "de"})
+        en2 = await self.app.request("/lang", headers={"Accept-Language": "en"})
+        self.assertEqual((en.data, de.data, en2.data), (b"en", b"de", b"en"))
+        self.assertEqual(self.calls, ["lang", "lang"])
+        await self.app.request("/lang", headers={"Accept-Language": "de"})
+        self.assertEqual(len(self.calls), 2)
+
+    async def testSingleFlight(self):
+        responses = await asyncio.gather(*[self.app.request("/slow") for i in range(5)])
+        self.assertEqual([r.data for r in responses], [b"slow"] * 5)
+        self.assertEqual(self.calls, ["slow"])
+
+    async def testStaleWhileRevalidate(self):
+        await self.app.request("/")
+        for entry in self.cache.entries.values():
+            entry.expires = 0
+        self.assertEqual((await self.app.request("/")).data, b"index 1")
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.calls, ["index", "index"])
+        self.assertEqual((await self.app.request("/")).data, b"index 2")
+
+    async def testInvalidate(self):
+        await self.app.request("/item/1")
+        await self.app.request("/item/2")
+        self.cache.invalidate("item:1")
+        self.assertEqual((await self.app.request("/item/1")).data, b"item 1 3")
+        self.assertEqual((await self.app.request("/item/2")).data, b"item 2 2")
+
+    async def testLimits(self):
+        self.cache.max_entries = 2
+        for path in ["/item/1", "/item/2", "/item/3", "/item/1"]:
+            await self.app.request(path)
+        self.assertEqual(self.calls, ["1", "2", "3", "1"])
+        self.assertEqual(len(self.cache.entries), 2)
+
+        # the variants of evicted entries are forgotten with them
+        self.assertEqual(len(self.cache.vary), 2)
+        self.cache.invalidate("item:1", "item:3")
+        self.assertEqual(self.cache.vary, {})
+
+    async def testStream(self):
+        self.cache.max_bytes = 50
+        self.assertEqual((await self.app.request("/stream")).data, b"x" * 40)
+        self.assertEqual((await self.app.request("/stream")).data, b"x" * 40)
+        self.assertEqual(self.calls, ["stream"])
+
+        # a body larger than max_bytes is passed through without being kept
+        self.assertEqual((await self.app.request("/stream?n=10")).data, b"x" * 100)
+        self.assertEqual((await self.app.request("/stream?n=10")).data, b"x" * 100)
+        self.assertEqual(self.calls, ["stream"] * 3)
+        self.assertEqual(len(self.cache.entries), 1)
+
+    async def testCredentials(self):
+        await self.app.request("/")
+        for headers in [{"Authorization": "Basic eDp5"}, {"Cookie": "webpy_session_id=abc"}]:
+            self.assertEqual((await self.app.request("/", headers=headers)).data, b"index %d" % len(self.calls))
+        self.assertEqual(self.calls, ["index"] * 3)
+        self.assertEqual((await self.app.request("/")).data, b"index 1")
+
+        # unless the response is public
+        for i in range(2):
+            await self.app.request("/public", headers={"Authorization": "Basic eDp5"})
+        await self.app.request("/public")
+        self.assertEqual(self.calls.count("public"), 1)
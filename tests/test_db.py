@@ -1,11 +1,19 @@
 """DB test"""
 from __future__ import print_function
 
+import asyncio
+import datetime
 import importlib
+import json
 import os
+import pickle
+import sqlite3
+import threading
+import time
 import unittest
 import warnings
 
+import asynctest
 import pytest
 
 import web
@@ -127,14 +135,10 @@ class DBTest(unittest.TestCase):
         self.assertRows(2)
 
     def testPooling(self):
-        # can't test pooling if DBUtils is not installed
-        try:
-            import DBUtils
-        except ImportError:
-            return
         db = setup_database(self.dbname, pooling=True)
-        self.assertEqual(db.ctx.db.__class__.__module__, "DBUtils.PooledDB")
+        self.assertIsInstance(db.ctx.db, web.db.PooledConnection)
         db.select("person", limit=1)
+        self.assertEqual(db.pool.stats().in_use, 0)
 
     def test_multiple_insert(self):
         db = setup_database(self.dbname)
@@ -233,6 +237,62 @@ class SqliteTest(DBTest):
         # pooling is not support for sqlite
         pass
 
+    def test_multiple_insert_explicit_ids(self):
+        db = setup_database(self.dbname)
+        db.printing = False
+        db.query("CREATE TABLE item (id INTEGER PRIMARY KEY, name text)")
+        try:
+            rows = [dict(id=10, name="a"), dict(id=5, name="b"), dict(id=7, name="c")]
+            self.assertEqual(list(db.multiple_insert("item", rows)), [10, 5, 7])
+            # the rowid names are only looked up once per table
+            self.assertEqual(db._rowid_names["item"], {"rowid", "oid", "_rowid_", "id"})
+            self.assertEqual(list(db.multiple_insert("item", [dict(name="d"), dict(name="e")])), [11, 12])
+            self.assertEqual(list(db.multiple_insert("item", [dict(ROWID=20, name="f")])), [20])
+            self.assertEqual(
+                [r.name for r in db.select("item", where="id IN (5, 7, 10, 11, 12, 20)", order="id")],
+                ["b", "c", "a", "d", "e", "f"],
+            )
+        finally:
+            db.query("DROP TABLE item")
+
+    def test_multiple_insert_batches(self):
+        db = setup_database(self.dbname)
+        db.printing = False
+        rows = [dict(name="user%d" % i, email="%d@example.com" % i) for i in range(2500)]
+        self.assertEqual(db.multiple_insert("person", rows), range(1, 2501))
+
+        # multiple-row inserts split to fit the parameter limit
+        db.bulk_executemany = False
+        db.supports_multiple_insert = True
+        db.max_params = 999
+        self.assertEqual(db.multiple_insert("person", rows[:1500]), range(2501, 4001))
+        self.assertEqual(db.multiple_insert("person", rows[:10], seqname=False), None)
+
+        # SQL literals are inserted one row at a time
+        literal = [dict(name=web.SQLLiteral("'x' || 'y'"))]
+        db.bulk_executemany = True
+        db.supports_multiple_insert = False
+        self.assertEqual(db.multiple_insert("person", literal), [4011])
+
+        self.assertEqual(len(db.select("person").list()), 4011)
+        self.assertEqual(db.select("person", where="name = 'xy'").list()[0].email, None)
+
+    def test_stream(self):
+        db = setup_database(self.dbname)
+        db.printing = False
+        db.multiple_insert("person", [dict(name="%03d" % i) for i in range(250)], seqname=False)
+
+        with db.select("person", order="name", stream=True, batch_size=100) as rows:
+            self.assertIsInstance(rows, web.ResultStream)
+            self.assertEqual([len(rows.fetch()) for i in range(2)], [100, 100])
+            self.assertEqual([row.name for row in rows], ["%03d" % i for i in range(200, 250)])
+        self.assertTrue(rows.closed)
+
+        rows = db.query("SELECT * FROM person", stream=True)
+        self.assertEqual(next(iter(rows)).name, "000")
+        rows.close()
+        self.assertEqual(list(rows), [])
+
 
 @requires_module("pysqlite2.dbapi2")
 class SqliteTest_pysqlite2(SqliteTest):
@@ -265,3 +325,344 @@ class MySQLTest_MySQLConnector(MySQLTest_MySQLdb):
 
 
 del DBTest
+
+
+class AsyncDBTest(asynctest.TestCase):
+    def setUp(self):
+        self.adb = web.asyncdatabase(dbn="sqlite", db="webpy.db", max_workers=2)
+        self.adb.db.query("CREATE TABLE person (name text, email text, active boolean)")
+
+    async def tearDown(self):
+        await self.adb.close()
+        setup_database("sqlite").query("DROP TABLE person")
+
+    async def testQueries(self):
+        threads = []
+        execute = self.adb.db._db_execute
+
+        def recording_execute(cur, sql_query, rows=None):
+            threads.append(threading.current_thread().name)
+            return execute(cur, sql_query, rows)
+
+        self.adb.db._db_execute = recording_execute
+
+        await self.adb.insert("person", False, name="a", email="a@example.com")
+        await self.adb.multiple_insert("person", [dict(name="b"), dict(name="c")], seqname=False)
+        self.assertEqual(await self.adb.update("person", where="name = $name", vars={"name": "b"}, active=True), 1)
+
+        rows = await self.adb.select("person", where="name = $name", vars={"name": "a"})
+        self.assertIsInstance(rows, web.ResultSet)
+        self.assertEqual(rows.first().email, "a@example.com")
+        names = [row.name async for row in await self.adb.select("person", order="name")]
+        self.assertEqual(names, ["a", "b", "c"])
+        self.assertEqual(len(await self.adb.where("person", active=True)), 1)
+        self.assertEqual(await self.adb.delete("person", where="name = 'c'"), 1)
+        self.assertEqual(len((await self.adb.query("SELECT * FROM person")).list()), 2)
+
+        self.assertTrue(threads)
+        self.assertTrue(all(name.startswith("web.AsyncDB") for name in threads), threads)
+
+    async def testConcurrent(self):
+        await self.adb.multiple_insert("person", [dict(name=str(i)) for i in range(10)], seqname=False)
+        results = await asyncio.gather(
+            *[self.adb.select("person", where="name = $i", vars={"i": str(i)}) for i in range(10)]
+        )
+        self.assertEqual([r[0].name for r in results], [str(i) for i in range(10)])
+
+    async def testTransaction(self):
+        async with self.adb.transaction():
+            await self.adb.insert("person", False, name="a")
+        try:
+            async with self.adb.transaction():
+                await self.adb.insert("person", False, name="b")
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([row.name for row in await self.adb.select("person")], ["a"])
+
+        t = self.adb.transaction()
+        await t.__aenter__()
+        await self.adb.insert("person", False, name="c")
+        await t.rollback()
+        await t.rollback()
+        self.assertEqual(len(await self.adb.select("person")), 1)
+
+    async def testStream(self):
+        await self.adb.multiple_insert("person", [dict(name="%03d" % i) for i in range(250)], seqname=False)
+
+        rows = await self.adb.select("person", order="name", stream=True, batch_size=100)
+        self.assertIsInstance(rows, web.AsyncResultStream)
+        self.assertEqual(len(await rows.fetch()), 100)
+        self.assertEqual([row.name async for row in rows], ["%03d" % i for i in range(100, 250)])
+        self.assertIsNone(rows.executor)
+
+        # closing a stream early gives its thread back
+        async with await self.adb.query("SELECT * FROM person", stream=True, batch_size=10) as rows:
+            async for row in rows:
+                break
+        self.assertEqual(self.adb._idle.qsize(), 2)
+
+        # so does leaving a loop over it without closing it
+        for i in range(3):
+            rows = await self.adb.query("SELECT * FROM person", stream=True, batch_size=10)
+            async for row in rows:
+                break
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.adb._idle.qsize(), 2)
+
+        async with self.adb.transaction():
+            await self.adb.insert("person", False, name="new")
+            rows = await self.adb.select("person", where="name = 'new'", stream=True)
+            self.assertEqual(len(await rows.list()), 1)
+        self.assertEqual(len(await self.adb.select("person")), 251)
+
+
+class ReparamTest(unittest.TestCase):
+    def testParseCache(self):
+        template = "name = $person.name AND id IN $ids AND x = $$1 -- ReparamTest"
+        before = web.db._parse_cached.stats()
+        q1 = web.reparam(template, dict(person=web.storage(name="a"), ids=[1, 2]))
+        q2 = web.reparam(template, dict(person=web.storage(name="b"), ids=[3]))
+        after = web.db._parse_cached.stats()
+
+        self.assertEqual(after.misses - before.misses, 1)
+        self.assertEqual(after.hits - before.hits, 1)
+        self.assertEqual(q1.query(), "name = %s AND id IN (%s, %s) AND x = $1 -- ReparamTest")
+        self.assertEqual(q1.values(), ["a", 1, 2])
+        self.assertEqual(q2.values(), ["b", 3])
+
+    def testTextCache(self):
+        template = "name = $name AND id = $id -- testTextCache"
+        q1 = web.reparam(template, dict(name="a", id=1))
+        q2 = web.reparam(template, dict(name="b", id=web.SQLLiteral("2")))
+        q3 = web.reparam(template, dict(name="c", id=3))
+        self.assertIsNone(q2.template)
+        self.assertIs(q1.template, q3.template)
+
+        self.assertEqual(q1.query("qmark"), "name = ? AND id = ? -- testTextCache")
+        self.assertEqual(q1.template.texts, {"qmark": "name = ? AND id = ? -- testTextCache"})
+        self.assertIs(q3.query("qmark"), q1.query("qmark"))
+        self.assertEqual(q3.values(), ["c", 3])
+        self.assertEqual(q2.query("qmark"), "name = ? AND id = 2 -- testTextCache")
+
+        q3 += " LIMIT 1"
+        self.assertIsNone(q3.template)
+        self.assertEqual(q3.query("qmark"), "name = ? AND id = ? -- testTextCache LIMIT 1")
+
+
+class RowTest(unittest.TestCase):
+    def testRow(self):
+        make = web.db.row_class(("id", "name", "count(*)", "keys", "id"))
+        self.assertIs(web.db.row_class(("id", "name", "count(*)", "keys", "id")), make)
+        row = make((1, "bob", 3, "k", 2))
+
+        # reads like dict(zip(names, values))
+        expected = {"id": 2, "name": "bob", "count(*)": 3, "keys": "k"}
+        self.assertEqual(row, expected)
+        self.assertEqual(dict(row), expected)
+        self.assertEqual((row.id, row.name, row["keys"], getattr(row, "count(*)")), (2, "bob", "k", 3))
+        self.assertEqual(list(row), list(expected))
+        self.assertEqual(row.items(), list(expected.items()))
+        self.assertEqual(len(row), 4)
+        self.assertEqual(row.get("email", "-"), "-")
+        self.assertRaises(KeyError, lambda: row["email"])
+        self.assertFalse(hasattr(row, "email"))
+        self.assertEqual(web.storage(row), expected)
+        self.assertEqual(json.loads(web.jsonutils.dumps([row])), [expected])
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+
+        copy = row.copy()
+        copy.name = "alice"
+        self.assertEqual(row.name, "bob")
+        with self.assertRaises(AttributeError):
+            row.name = "alice"
+
+    def testQueryRows(self):
+        db = setup_database("sqlite")
+        db.printing = False
+        db.query("CREATE TABLE person (name text, email text, active boolean)")
+        try:
+            db.multiple_insert("person", [dict(name="a", email="a@example.com"), dict(name="b")], seqname=False)
+            row = db.select("person", order="name", stream=True).list()[0]
+            self.assertIsInstance(row, web.Storage)
+            row.email = None
+
+            db = web.database(dbn="sqlite", db="webpy.db", compact_rows=True)
+            db.printing = False
+            rows = db.select("person", order="name").list()
+            self.assertIsInstance(rows[0], web.Row)
+            self.assertIs(type(rows[0]), type(rows[1]))
+            self.assertEqual([(r.name, r.email) for r in rows], [("a", "a@example.com"), ("b", None)])
+        finally:
+            db.query("DROP TABLE person")
+
+
+class CopyReaderTest(unittest.TestCase):
+    def testRead(self):
+        rows = [(1, "a\tb\\c\n", None, True), (2.5, b"\x00\xff", datetime.date(2020, 1, 2), False)]
+        expected = "1\ta\\tb\\\\c\\n\t\\N\tt\n2.5\t\\\\x00ff\t2020-01-02\tf\n"
+        self.assertEqual(web.db._CopyReader(rows).read(), expected)
+
+        reader = web.db._CopyReader(rows)
+        chunks = iter(lambda: reader.read(5), "")
+        self.assertEqual("".join(chunks), expected)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def connect(self):
+        return sqlite3.connect(":memory:", check_same_thread=False)
+
+    def testResultsReadBeforeRelease(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            db = web.db.DB(sqlite3, dict(database=directory + "/pool.db", pooling=dict(max_lifetime=0.05)))
+            db.paramstyle = "qmark"
+            db.printing = False
+            db.query("CREATE TABLE person (name text)")
+            db.insert("person", seqname=False, name="a")
+            db.ctx.db
+            time.sleep(0.1)
+            # the connection expires during the query and is closed when it is released.
+            result = db.select("person")
+            self.assertEqual(db.pool.stats().in_use, 0)
+            self.assertEqual([row.name for row in result.list()], ["a"])
+            db.pool.close()
+
+    def testStreamLoopLeftEarly(self):
+        db = web.db.DB(sqlite3, dict(database=":memory:", pooling=dict(max_size=2, timeout=0.1)))
+        db.paramstyle = "qmark"
+        db.printing = False
+        for i in range(3):
+            for row in db.query("SELECT 1 AS x UNION ALL SELECT 2", stream=True):
+                break
+        for i in range(3):
+            with self.assertRaises(ValueError):
+                for row in db.query("SELECT 1 AS x", stream=True):
+                    raise ValueError(row.x)
+        self.assertEqual(db.pool.stats().in_use, 0)
+        db.pool.close()
+
+    def testNestedQueryDuringStream(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            db = web.db.DB(sqlite3, dict(database=directory + "/pool.db", pooling=dict(max_size=2)))
+            db.paramstyle = "qmark"
+            db.printing = False
+            db.query("CREATE TABLE person (name text)")
+            db.multiple_insert("person", [dict(name="a"), dict(name="b")], seqname=False)
+
+            names = []
+            for row in db.select("person", order="name", stream=True, batch_size=1):
+                names.append(row.name)
+                self.assertEqual(db.query("SELECT count(*) AS n FROM person").first().n, 2)
+                # the stream keeps its connection, which is not handed out again
+                self.assertEqual(db.pool.stats().in_use, 1)
+                other = db.pool.acquire()
+                self.assertIsNot(other.raw, db.ctx.db.raw)
+                other.close()
+            self.assertEqual(names, ["a", "b"])
+            self.assertEqual(db.pool.stats().in_use, 0)
+
+            # queries and transactions during the stream are committed with it
+            rows = db.select("person", stream=True)
+            with db.transaction():
+                db.insert("person", seqname=False, name="c")
+            rows.close()
+            self.assertEqual(db.pool.stats().in_use, 0)
+            self.assertEqual(len(db.select("person").list()), 3)
+            db.pool.close()
+
+    def testNoWaitOnEventLoop(self):
+        pool = web.ConnectionPool(self.connect, max_size=1)
+        conn = pool.acquire()
+
+        async def acquire():
+            return pool.acquire()
+
+        started = time.monotonic()
+        with self.assertRaises(web.PoolTimeout):
+            asyncio.run(acquire())
+        self.assertLess(time.monotonic() - started, 1)
+        conn.close()
+        asyncio.run(acquire()).close()
+        self.assertEqual(pool.stats().timeouts, 1)
+
+    def testReuse(self):
+        pool = web.ConnectionPool(self.connect, max_size=2)
+        a = pool.acquire()
+        raw = a.raw
+        a.close()
+        a.close()
+        b = pool.acquire()
+        self.assertIs(b.raw, raw)
+        stats = pool.stats()
+        self.assertEqual((stats.size, stats.in_use, stats.idle, stats.created), (1, 1, 0, 1))
+
+    def testTimeout(self):
+        pool = web.ConnectionPool(self.connect, max_size=1, timeout=0.05)
+        a = pool.acquire()
+        self.assertRaises(web.PoolTimeout, pool.acquire)
+        self.assertEqual(pool.stats().timeouts, 1)
+
+        threading.Timer(0.05, a.close).start()
+        b = pool.acquire(timeout=5)
+        self.assertIs(b.raw, a.raw)
+        self.assertGreater(pool.stats().wait_time, 0.04)
+
+    def testHealthCheckAndLifetime(self):
+        pool = web.ConnectionPool(self.connect, check_after=0)
+        a = pool.acquire()
+        a.raw.close()
+        a.close()
+        b = pool.acquire()
+        self.assertIsNot(b.raw, a.raw)
+        self.assertEqual(pool.stats().discarded, 1)
+        b.close()
+
+        pool.max_lifetime = 0.01
+        time.sleep(0.02)
+        c = pool.acquire()
+        self.assertIsNot(c.raw, b.raw)
+        self.assertEqual(pool.stats().size, 1)
+
+    def testMinSizeAndClose(self):
+        pool = web.ConnectionPool(self.connect, min_size=3)
+        a = pool.acquire()
+        self.assertEqual((pool.stats().size, pool.stats().idle), (3, 2))
+        pool.close()
+        a.close()
+        self.assertEqual(pool.stats().size, 0)
+
+    def testDB(self):
+        db = web.DB(sqlite3, {"database": ":memory:", "check_same_thread": False, "pooling": dict(max_size=1)})
+        db.paramstyle = "qmark"
+        with db.transaction():
+            db.query("CREATE TABLE t (x int)")
+            db.insert("t", False, x=1)
+            self.assertEqual(db.pool.stats().in_use, 1)
+        self.assertEqual(db.pool.stats().in_use, 0)
+        self.assertEqual(db.select("t").first().x, 1)
+        self.assertEqual(db.pool.stats().created, 1)
+
+
+class RequestConnectionTest(asynctest.TestCase):
+    async def testClosedAfterRequest(self):
+        db = web.DB(sqlite3, {"database": ":memory:", "pooling": False})
+        db.paramstyle = "qmark"
+        connections = []
+
+        class index:
+            def GET(self):
+                connections.append(db.ctx.db)
+                return str(db.query("SELECT 1 AS x").first().x)
+
+        app = web.application(("/", "index"), locals())
+        for _ in range(2):
+            self.assertEqual((await app.request("/")).data, b"1")
+        self.assertEqual(len(connections), 2)
+        self.assertIsNot(connections[0], connections[1])
+        for connection in connections:
+            self.assertRaises(sqlite3.ProgrammingError, connection.cursor)
+        self.assertNotIn("db", db._ctx)
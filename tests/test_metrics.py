@@ -0,0 +1,157 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+import asynctest
+
+import web
+from web import metrics
+
+pytestmark = pytest.mark.asyncio
+
+
+class MetricTypesTest(asynctest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    async def testCounterAndGauge(self):
+        c = metrics.Counter("hits_total", "Hits.", ["page"], registry=self.registry)
+        c.labels("a").inc()
+        c.labels("a").inc(2)
+        c.labels('b"').inc()
+        g = metrics.Gauge("busy", "Busy.", registry=self.registry)
+        g.inc()
+        g.inc()
+        g.dec()
+        text = self.registry.exposition()
+        self.assertIn("# TYPE hits_total counter\n", text)
+        self.assertIn('hits_total{page="a"} 3\n', text)
+        self.assertIn('hits_total{page="b\\""} 1\n', text)
+        self.assertIn("busy 1\n", text)
+        self.assertRaises(ValueError, c.labels)
+        self.assertRaises(ValueError, metrics.Counter, "busy", "Again.", registry=self.registry)
+
+    async def testHistogram(self):
+        h = metrics.Histogram("latency_seconds", "Latency.", buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 3):
+            h.observe(value)
+        text = self.registry.exposition()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 3\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4\n', text)
+        self.assertIn("latency_seconds_sum 3.65\n", text)
+        self.assertIn("latency_seconds_count 4\n", text)
+
+    async def testMergeWorkers(self):
+        c = metrics.Counter("jobs_total", "Jobs.", registry=self.registry)
+        h = metrics.Histogram("job_seconds", "Job time.", buckets=(1,), registry=self.registry)
+        c.inc(5)
+        h.observe(0.5)
+        with tempfile.TemporaryDirectory() as directory:
+            other = self.registry.snapshot()
+            other["jobs_total"]["values"]["[]"] = 7
+            other["job_seconds"]["values"]["[]"] = [0, 2, 4.0]
+            with open(os.path.join(directory, "metrics-1.json"), "w") as f:
+                json.dump(other, f)
+            text = self.registry.exposition(directory)
+            self.assertTrue(os.path.exists(os.path.join(directory, "metrics-%d.json" % os.getpid())))
+        self.assertIn("jobs_total 12\n", text)
+        self.assertIn('job_seconds_bucket{le="1"} 1\n', text)
+        self.assertIn('job_seconds_bucket{le="+Inf"} 3\n', text)
+        self.assertIn("job_seconds_sum 4.5\n", text)
+
+    async def testMergeLiveWorkersOnly(self):
+        c = metrics.Counter("jobs_total", "Jobs.", registry=self.registry)
+        busy = metrics.Gauge("busy", "Busy.", registry=self.registry, multiprocess="sum")
+        started = metrics.Gauge("started", "Start time.", registry=self.registry)
+        c.inc(5)
+        busy.set(2)
+        started.set(100)
+        dead = subprocess.Popen([sys.executable, "-c", ""])
+        dead.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            for pid in (1, dead.pid):
+                with open(os.path.join(directory, "metrics-%d.json" % pid), "w") as f:
+                    json.dump(self.registry.snapshot(), f)
+            text = self.registry.exposition(directory)
+            self.assertFalse(os.path.exists(os.path.join(directory, "metrics-%d.json" % dead.pid)))
+        self.assertIn("jobs_total 10\n", text)
+        self.assertIn("busy 4\n", text)
+        self.assertIn('started{pid="1"} 100\n', text)
+        self.assertIn('started{pid="%d"} 100\n' % os.getpid(), text)
+        self.assertRaises(ValueError, metrics.Gauge, "x", "X.", registry=self.registry, multiprocess="avg")
+
+    async def testThreads(self):
+        c = metrics.Counter("calls_total", "Calls.", registry=self.registry)
+        h = metrics.Histogram("call_seconds", "Call time.", registry=self.registry)
+
+        def work():
+            for i in range(10000):
+                c.inc()
+                h.observe(0.01)
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(c._default.get(), 40000)
+        self.assertEqual(sum(h._default.get()[:-1]), 40000)
+
+        # labels added while another thread takes snapshots
+        pages = metrics.Counter("pages_total", "Pages.", ["page"], registry=self.registry)
+
+        def add():
+            for i in range(20000):
+                pages.labels(i).inc()
+
+        thread = threading.Thread(target=add)
+        thread.start()
+        while thread.is_alive():
+            self.registry.snapshot()
+        thread.join()
+        self.assertEqual(len(self.registry.snapshot()["pages_total"]["values"]), 20000)
+
+
+class ProcessorTest(asynctest.TestCase):
+    def setUp(self):
+        urls = ("/item/(.*)", "item", "/metrics", "metrics_page")
+
+        class item:
+            def GET(self, id):
+                if id == "missing":
+                    raise web.notfound()
+                return id
+
+        metrics_page = metrics.handler()
+        self.app = web.application(urls, locals())
+        self.app.add_processor(metrics.processor)
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+
+    async def testRequests(self):
+        ok = metrics.REQUEST_SECONDS.labels("GET", "/item/(.*)", "200")
+        missing = metrics.REQUEST_SECONDS.labels("GET", "/item/(.*)", "404")
+        before = sum(ok.counts), sum(missing.counts)
+        await self.app.request("/item/1")
+        await self.app.request("/item/2")
+        await self.app.request("/item/missing")
+        self.assertEqual((sum(ok.counts), sum(missing.counts)), (before[0] + 2, before[1] + 1))
+        self.assertEqual(metrics.REQUESTS_IN_FLIGHT._default.value, 0)
+
+        response = await self.app.request("/metrics")
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        text = response.data.decode()
+        self.assertIn('web_request_duration_seconds_count{method="GET",route="/item/(.*)",status="404"}', text)
+        self.assertIn('web_processor_duration_seconds_count{processor="processor"}', text)
+
+    async def testDisabled(self):
+        metrics.disable()
+        child = metrics.REQUEST_SECONDS.labels("GET", "/item/(.*)", "200")
+        count = sum(child.counts)
+        await self.app.request("/item/1")
+        self.assertEqual(sum(child.counts), count)
@@ -0,0 +1,160 @@
+import asyncio
+import time
+
+import pytest
+import asynctest
+
+import web
+
+pytestmark = pytest.mark.asyncio
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplingProfilerTest(asynctest.TestCase):
+    def setUp(self):
+        urls = ("/busy/(.*)", "busy_page", "/wait", "wait_page", "/_profile", "profile")
+
+        class busy_page:
+            def GET(self, name):
+                busy(0.05)
+                return "ok"
+
+        class wait_page:
+            async def GET(self):
+                await asyncio.sleep(0.05)
+                return "ok"
+
+        self.profiler = web.SamplingProfiler(interval=0.001, wall=True)
+        profile = self.profiler.handler(token="secret")
+        self.app = web.application(urls, locals())
+        self.app.add_processor(self.profiler)
+
+    def tearDown(self):
+        self.profiler.stop()
+
+    async def testSamples(self):
+        await self.app.request("/busy/x")
+        self.assertEqual(len(self.profiler.stacks), 0)
+
+        self.profiler.start()
+        await self.app.request("/busy/x")
+        await self.app.request("/wait")
+        collapsed = self.profiler.collapsed()
+        self.assertRegex(collapsed, r"(?m)^/busy/\(\.\*\);.*busy \(test_profiler\.py:\d+\) \d+$")
+        self.assertRegex(collapsed, r"(?m)^/wait;.*GET \(test_profiler\.py:\d+\);.*\(waiting\) \d+$")
+        self.assertIn("/busy/(.*) (", self.profiler.top())
+
+    async def testHandler(self):
+        self.assertEqual((await self.app.request("/_profile")).status, "404 Not Found")
+        response = await self.app.request("/_profile?action=start", headers={"X-Profiler-Token": "secret"})
+        self.assertEqual(response.status, "200")
+        self.assertTrue(self.profiler.enabled)
+
+
+class BlockingDetectorTest(asynctest.TestCase):
+    def setUp(self):
+        urls = ("/block/(.*)", "block_page", "/wait", "wait_page")
+
+        class block_page:
+            def GET(self, name):
+                busy(0.15)
+                return "ok"
+
+        class wait_page:
+            async def GET(self):
+                await asyncio.sleep(0.15)
+                return "ok"
+
+        self.detector = web.BlockingDetector(threshold=0.05, interval=0.005)
+        self.app = web.application(urls, locals())
+        self.app.add_processor(self.detector)
+        web.metrics.enable()
+
+    def tearDown(self):
+        self.detector.stop()
+        web.metrics.disable()
+
+    async def testRequest(self):
+        self.detector.start()
+        with self.assertLogs("web.profiler", "WARNING") as logs:
+            await self.app.request("/block/x")
+        (stall,) = self.detector.reports
+        self.assertEqual(stall.route, "/block/(.*)")
+        self.assertRegex(stall.handler, r"^GET \(test_profiler\.py:\d+\)$")
+        self.assertGreater(stall.duration, 0.05)
+        self.assertIn("busy", stall.stack)
+        self.assertIn("event loop blocked for", logs.output[0])
+        self.assertGreaterEqual(web.metrics.LOOP_BLOCKS.labels(stall.route, stall.handler).value, 1)
+
+        await self.app.request("/wait")
+        self.assertEqual(len(self.detector.reports), 1)
+
+    async def testOutsideRequest(self):
+        self.detector.start()
+        await asyncio.sleep(0.02)
+        busy(0.15)
+        await asyncio.sleep(0.02)
+        (stall,) = self.detector.reports
+        self.assertIsNone(stall.route)
+        self.assertRegex(stall.handler, r"^testOutsideRequest \(test_profiler\.py:\d+\)$")
+
+
+leaked = []
+
+
+class MemoryProfilerTest(asynctest.TestCase):
+    def setUp(self):
+        urls = ("/leak", "leak_page", "/temp", "temp_page", "/_memory", "memory")
+
+        class leak_page:
+            def GET(self):
+                leaked.append([object() for i in range(2000)])
+                return "ok"
+
+        class temp_page:
+            def GET(self):
+                temp = [object() for i in range(2000)]
+                return str(len(temp))
+
+        self.profiler = web.MemoryProfiler(rate=1.0)
+        memory = self.profiler.handler(token="secret")
+        self.app = web.application(urls, locals())
+        self.app.add_processor(self.profiler)
+
+    def tearDown(self):
+        self.profiler.stop()
+        del leaked[:]
+
+    async def testLeaks(self):
+        await self.app.request("/leak")
+        self.assertEqual(self.profiler.routes, {})
+
+        self.profiler.start()
+        for i in range(3):
+            await self.app.request("/leak")
+            await self.app.request("/temp")
+        leak, temp = self.profiler.routes["/leak"], self.profiler.routes["/temp"]
+        self.assertEqual((leak.requests, temp.requests), (3, 3))
+        self.assertGreater(leak.size / leak.requests, 2000 * 16)
+        self.assertLess(temp.size / temp.requests, 2000 * 16)
+
+        report = self.profiler.leaks()
+        self.assertTrue(report.startswith("/leak: +"), report)
+        self.assertRegex(report, r"KiB  test_profiler\.py:\d+")
+
+    async def testDiff(self):
+        self.profiler.start()
+        self.profiler.mark()
+        for i in range(3):
+            await self.app.request("/leak")
+        diff = self.profiler.diff(5)
+        self.assertRegex(diff, r"KiB\s+\+\d+ objects  test_profiler\.py:\d+")
+
+        response = await self.app.request("/_memory?format=diff", headers={"X-Profiler-Token": "secret"})
+        self.assertIn(b"in total since the mark", response.data)
+        self.assertEqual((await self.app.request("/_memory?token=wrong")).status, "404 Not Found")
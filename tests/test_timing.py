@@ -0,0 +1,59 @@
+import re
+import time
+
+import pytest
+import asynctest
+
+import web
+from web import timing
+
+pytestmark = pytest.mark.asyncio
+
+
+class ServerTimingTest(asynctest.TestCase):
+    def setUp(self):
+        urls = ("/", "index")
+
+        class index:
+            def GET(self):
+                with timing.measure("cache", 'remote "kv"'):
+                    time.sleep(0.01)
+                with timing.measure("cache", 'remote "kv"'):
+                    pass
+                time.sleep(0.02)
+                return "ok"
+
+        async def slow(handler):
+            time.sleep(0.03)
+            return await handler()
+
+        self.app = web.application(urls, locals())
+        self.app.processors.insert(0, timing.processor)
+        self.app.add_processor(slow)
+        timing.enable()
+
+    def tearDown(self):
+        timing.disable()
+
+    async def testHeader(self):
+        response = await self.app.request("/")
+        entries = {}
+        for value in response.headers["Server-Timing"].split(", "):
+            m = re.match(r'^([^;]+);dur=([\d.]+)(?:;desc="(.*)")?$', value)
+            self.assertIsNotNone(m, value)
+            entries[m.group(1)] = (float(m.group(2)), m.group(3))
+
+        self.assertEqual(entries["cache"][1], 'remote \\"kv\\" x2')
+        self.assertEqual(entries["loadhook__load_"][1], "loadhook(_load)")
+        self.assertGreaterEqual(entries["cache"][0], 10)
+        # the time of the handler and of the processors doesn't include what they call.
+        self.assertTrue(20 <= entries["handler"][0] < 30, entries)
+        self.assertTrue(30 <= entries["slow"][0] < 60, entries)
+        self.assertGreaterEqual(entries["total"][0], 60)
+
+    async def testDisabled(self):
+        timing.disable()
+        response = await self.app.request("/")
+        self.assertNotIn("Server-Timing", response.headers)
+        with timing.measure("x"):
+            pass
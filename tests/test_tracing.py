@@ -0,0 +1,111 @@
+import io
+import json
+
+import pytest
+import asynctest
+
+import web
+from web import tracing
+
+pytestmark = pytest.mark.asyncio
+
+
+class ListExporter:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+class TracingTest(asynctest.TestCase):
+    def setUp(self):
+        self.debug = web.config.get("debug")
+        web.config.debug = False
+        urls = ("/item/(.*)", "item", "/fail", "fail")
+
+        class item:
+            @tracing.traced()
+            async def GET(self, id):
+                with tracing.span("lookup", id=id):
+                    return "item " + id
+
+        class fail:
+            def GET(self):
+                raise ValueError("boom")
+
+        async def noop(handler):
+            return await handler()
+
+        self.app = web.application(urls, locals())
+        self.app.add_processor(noop)
+        self.exporter = ListExporter()
+        tracing.enable(self.exporter, tracing.TailSampler(threshold=0))
+
+    def tearDown(self):
+        tracing.disable()
+        web.config.debug = self.debug
+
+    async def testSpans(self):
+        response = await self.app.request("/item/1")
+        self.assertEqual(response.data, b"item 1")
+        (spans,) = self.exporter.traces
+        names = [s["name"] for s in spans]
+        expected = [
+            "GET /item/(.*)",
+            "processor loadhook(_load)",
+            "processor unloadhook(_unload)",
+            "processor noop",
+            "handler",
+            "TracingTest.setUp.<locals>.item.GET",
+            "lookup",
+        ]
+        self.assertEqual(names, expected)
+        for parent, child in zip(spans, spans[1:]):
+            self.assertEqual(child["parent_id"], parent["span_id"])
+            self.assertEqual(child["trace_id"], spans[0]["trace_id"])
+        self.assertIsNone(spans[0]["parent_id"])
+        self.assertEqual(spans[0]["attributes"]["http.status"], "200")
+        self.assertEqual(spans[-1]["attributes"], {"id": "1"})
+
+    async def testTraceparent(self):
+        trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+        await self.app.request("/item/1", headers={"traceparent": "00-%s-%s-01" % (trace_id, parent_id)})
+        root = self.exporter.traces[0][0]
+        self.assertEqual((root["trace_id"], root["parent_id"]), (trace_id, parent_id))
+
+        await self.app.request("/item/1", headers={"traceparent": "garbage"})
+        self.assertIsNone(self.exporter.traces[1][0]["parent_id"])
+
+        with tracing.span("client") as s:
+            self.assertEqual(tracing.traceparent(), "00-%s-%s-01" % (s.trace_id, s.span_id))
+        self.assertIsNone(tracing.traceparent())
+
+    async def testTailSampler(self):
+        tracing.enable(self.exporter, tracing.TailSampler(threshold=10))
+        await self.app.request("/item/1")
+        self.assertEqual(self.exporter.traces, [])
+
+        await self.app.request("/fail")
+        (spans,) = self.exporter.traces
+        self.assertEqual(spans[0]["attributes"]["http.status"], "500")
+        self.assertTrue(any(s["error"] == "ValueError: boom" for s in spans))
+
+    async def testDisabled(self):
+        tracing.disable()
+        await self.app.request("/item/1")
+        self.assertEqual(self.exporter.traces, [])
+        with tracing.span("x") as s:
+            s.set("a", 1)
+
+    async def testJSONLinesExporter(self):
+        stream = io.StringIO()
+        exporter = tracing.JSONLinesExporter(stream=stream, flush_interval=0)
+        tracing.enable(exporter, tracing.TailSampler(threshold=0))
+        await self.app.request("/item/1")
+        await self.app.request("/item/2")
+        await exporter.close()
+        traces = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(len(traces), 2)
+        self.assertEqual(traces[1]["spans"][-1]["attributes"], {"id": "2"})
+        self.assertEqual(traces[1]["trace_id"], traces[1]["spans"][0]["trace_id"])
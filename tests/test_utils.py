@@ -1,5 +1,10 @@
+import asyncio
+import threading
+import time
+
 from web import utils
 
+
 def test_group():
     assert list(utils.group([], 2)) == []
     assert list(utils.group([1, 2, 3, 4, 5, 6, 7, 8, 9], 3)) == [[1, 2, 3], [4, 5, 6], [7, 8, 9]]    
@@ -9,4 +14,83 @@ def test_group():
 class TestIterBetter:
     def test_iter(self):
         assert list(utils.IterBetter(iter([]))) == []
-        assert list(utils.IterBetter(iter([1, 2, 3]))) == [1, 2, 3]
\ No newline at end of file
+        assert list(utils.IterBetter(iter([1, 2, 3]))) == [1, 2, 3]
+
+
+class TestMemoize:
+    def test_async_single_flight(self):
+        calls = []
+
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        fast = utils.memoize(slow, maxsize=2)
+
+        async def run():
+            results = await asyncio.gather(*[fast(1) for i in range(5)])
+            assert results == [2] * 5
+            assert await fast(1) == 2
+
+        asyncio.run(run())
+        assert calls == [1]
+        assert (fast.hits, fast.misses) == (1, 5)
+
+    def test_async_background_refresh(self):
+        calls = []
+
+        async def f():
+            calls.append(1)
+            return len(calls)
+
+        fast = utils.memoize(f, expires=0.01, background=True)
+
+        async def run():
+            assert await fast() == 1
+            await asyncio.sleep(0.02)
+            assert await fast() == 1
+            await asyncio.sleep(0)
+            assert await fast() == 2
+
+        asyncio.run(run())
+        assert fast.refreshes == 1
+
+    def test_async_leader_cancelled(self):
+        calls = []
+
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x * 2
+
+        fast = utils.memoize(slow)
+
+        async def run():
+            leader = asyncio.ensure_future(fast(1))
+            await asyncio.sleep(0)
+            waiters = [asyncio.ensure_future(fast(1)) for i in range(3)]
+            await asyncio.sleep(0)
+            leader.cancel()
+            assert await asyncio.gather(*waiters) == [2, 2, 2]
+            assert leader.cancelled()
+
+        asyncio.run(run())
+        assert calls == [1, 1]
+        assert fast.running == {}
+
+    def test_threads_single_flight(self):
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.05)
+            return 42
+
+        fast = utils.memoize(slow)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fast())) for i in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        assert results == [42] * 5
+        assert calls == [1]
@@ -0,0 +1,136 @@
+"""
+Benchmarks of the database layer, run against a temporary SQLite database.
+
+    $ python tools/benchmark_db.py [name ...]
+
+Runs every benchmark when no name is given.
+"""
+import os
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import web  # noqa: E402
+from web import db as webdb  # noqa: E402
+
+
+def setup(rows=1000):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db = web.database(dbn="sqlite", db=path)
+    db.printing = False
+    db.query("CREATE TABLE person (id INTEGER PRIMARY KEY, name TEXT, age INTEGER)")
+    with db.transaction():
+        db.multiple_insert("person", [dict(name="name%d" % i, age=i % 90) for i in range(rows)])
+    return db
+
+
+def report(name, number, seconds):
+    print("%-50s %8.2f us/call" % (name, seconds / number * 1e6))
+
+
+def bench_reparam(number=20000):
+    """Queries with a `$var` where clause, with and without the parse cache."""
+    template = "id = $id AND name = $person.name AND age > $ages[0]"
+    values = dict(id=1, person=web.storage(name="x"), ages=[18])
+    db = setup()
+    select = lambda: db.select("person", where="id=$id", vars=dict(id=42)).list()  # noqa: E731
+
+    cached = webdb._parse_cached
+    for label, parse in ("parsing every call", webdb._parse), ("cached parse", cached):
+        webdb._parse_cached = parse
+        try:
+            report("reparam, " + label, number, timeit.timeit(lambda: webdb.reparam(template, values), number=number))
+            report("db.select(where='id=$id'), " + label, number, timeit.timeit(select, number=number))
+        finally:
+            webdb._parse_cached = cached
+
+
+def bench_sqltext(number=20000):
+    """`$var` queries with and without the cache of their SQL text, best of 5."""
+    db = setup()
+    template = "SELECT * FROM person WHERE name = $name AND age > $age ORDER BY id LIMIT 1"
+    values = dict(name="name1", age=0)
+    q = webdb.reparam(template, values)
+    statements = [
+        ("SQLQuery.query() of a reparam()", lambda: q.query("qmark")),
+        ("db.query('... $name ...', vars)", lambda: db.query(template, vars=values).list()),
+    ]
+    query = webdb.SQLQuery.query
+    for label, render in ("rendering every call", webdb.SQLQuery._render), ("cached text", query):
+        webdb.SQLQuery.query = render
+        try:
+            with db.transaction():
+                for name, f in statements:
+                    report("%s, %s" % (name, label), number, min(timeit.repeat(f, number=number, repeat=5)))
+        finally:
+            webdb.SQLQuery.query = query
+
+
+def bench_multiple_insert(number=1000000):
+    """multiple_insert of 1M rows into SQLite: one insert per row, multiple-row inserts, executemany."""
+    values = [dict(name="name%d" % i, age=i % 90) for i in range(number)]
+    modes = [
+        ("one insert per row", dict(bulk_executemany=False, supports_multiple_insert=False)),
+        ("multiple-row inserts", dict(bulk_executemany=False, supports_multiple_insert=True)),
+        ("executemany", dict(bulk_executemany=True, supports_multiple_insert=False)),
+    ]
+    for label, attrs in modes:
+        db = setup(rows=0)
+        db.__dict__.update(attrs)
+        with db.transaction():
+            seconds = timeit.timeit(lambda: db.multiple_insert("person", values), number=1)
+        print("%-50s %8.2f s, %.0f rows/s" % ("multiple_insert(), " + label, seconds, number / seconds))
+
+
+def bench_stream(number=1000000):
+    """Reading 1M rows: time and peak memory of list(), plain iteration and a stream."""
+    db = setup(rows=number)
+    reads = [
+        ("select().list()", lambda: len(db.select("person").list())),
+        ("for row in select()", lambda: sum(1 for row in db.select("person"))),
+        ("for row in select(stream=True)", lambda: sum(1 for row in db.select("person", stream=True))),
+    ]
+    for label, read in reads:
+        tracemalloc.start()
+        start = time.perf_counter()
+        count = read()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-50s %8.2f s, peak %.1f MB, %d rows" % (label, seconds, peak / 1e6, count))
+
+
+def bench_rows(number=1000000):
+    """1M-row results as storage dicts and as compact rows: memory held, time to build and to read."""
+    db = setup(rows=number)
+    for label, compact in ("storage rows", False), ("compact rows", True):
+        db.compact_rows = compact
+        start = time.perf_counter()
+        rows = db.select("person").list()
+        built = time.perf_counter() - start
+        del rows
+
+        tracemalloc.start()
+        rows = db.select("person").list()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        total = 0
+        for row in rows:
+            total += row.age + len(row["name"])
+        read = time.perf_counter() - start
+        print("%-50s %6.1f MB, list() %.2f s, reading %.2f s" % (label, held / 1e6, built, read))
+        del rows
+
+
+BENCHMARKS = {name[len("bench_"):]: f for name, f in sorted(globals().items()) if name.startswith("bench_")}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
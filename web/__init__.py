@@ -8,8 +8,8 @@ __author__ = [
 __license__ = "MIT"
 __contributors__ = "see http://asyncio-webpy.imop.io/changes"
 
-from . import utils, db, net, wsgi, http, webapi, httpserver, debugerror
-from . import template, form
+from . import utils, db, net, wsgi, asgi, http, webapi, httpserver, debugerror
+from . import template, form, jsonutils, cache, static, profiler, metrics, timing, tracing
 
 from . import session
 
@@ -17,8 +17,13 @@ from .utils import *
 from .db import *
 from .net import *
 from .wsgi import *
+from .asgi import *
 from .http import *
 from .webapi import *
+from .jsonutils import *
+from .cache import *
+from .static import *
+from .profiler import *
 from .httpserver import *
 from .debugerror import *
 from .application import *
@@ -5,13 +5,14 @@ Web application
 
 import os
 import sys
+import time
 import logging
 from io import BytesIO
 from inspect import isclass, isawaitable, iscoroutine, iscoroutinefunction
 from importlib import reload
 from urllib.parse import unquote, urlencode, splitquery
 
-from . import wsgi, types, utils
+from . import metrics, timing, tracing, wsgi, types, utils
 from . import webapi as web
 from . import browser, httpserver
 from .utils import safebytes
@@ -267,13 +268,16 @@ class application:
     async def handle(self):
         fn, args = self._match(self.mapping, web.ctx.path)
         logger.getChild("application.handle").debug("match result: fn(%s), args(%s)", fn, args)
-        return await self._delegate(fn, self.fvars, args)
+        with tracing.child_span("handler", handler=fn), timing.measure("handler"):
+            return await self._delegate(fn, self.fvars, args)
 
     def handle_with_processors(self):
         async def process(processors):
             try:
                 if processors:
                     p, processors = processors[0], processors[1:]
+                    if metrics.enabled or tracing.enabled or timing.enabled:
+                        return await instrumented(p, lambda: process(processors))
                     response = await p(lambda: process(processors))
                     if isawaitable(response):
                         return await response
@@ -288,7 +292,26 @@ class application:
                 logger.getChild("application.handle_with_processors").critical("", exc_info=exc)
                 raise self.internalerror()
 
+        async def instrumented(p, handler):
+            name = getattr(p, "__name__", None) or type(p).__name__
+            start = time.perf_counter()
+            try:
+                with tracing.child_span("processor " + name), timing.measure(name):
+                    response = await p(handler)
+                    if isawaitable(response):
+                        response = await response
+                    return response
+            finally:
+                if metrics.enabled:
+                    metrics.PROCESSOR_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+        async def traced():
+            with tracing.request_span():
+                return await process(self.processors)
+
         # processors must be applied in the resvere order. (??)
+        if tracing.enabled:
+            return traced()
         return process(self.processors)
 
     def asgifunc(self, *middleware):
@@ -304,18 +327,83 @@ class application:
 
         return asgi
 
-    async def __call__(self, receive, send):
+    async def _read_body(self, receive):
+        """Consumes the request body from `receive`.
+
+        `multipart/form-data` bodies are handed to a `web.MultipartReader` chunk by
+        chunk as they arrive, everything else is buffered into `scope["input"]`.
+        """
+        reader = None
+        content_type = web.ctx.scope["headers"].get("content_type", "")
+        if content_type.startswith("multipart/form-data"):
+            reader = web.ctx.scope["multipart"] = web.MultipartReader(content_type)
+
         body = BytesIO()
+        web.ctx.scope["input"] = body
         more_body = True
         while more_body:
             message = await receive()
+            if message["type"] == "http.disconnect":
+                break
             if message["type"] == "http.request":
-                body.write(message["body"])
-                more_body = message["more_body"]
+                if reader is not None:
+                    reader.write(message["body"])
+                else:
+                    body.write(message["body"])
+                more_body = message.get("more_body", False)
+
+        if reader is not None:
+            reader.finalize()
+
+    def _lookup(self, path):
+        """Returns the handler function `path` would be delegated to, without calling it."""
+        what, prefix = self._match_handler(path)
+        if isinstance(what, application):
+            return what._lookup(path[len(prefix) :])
+        if isinstance(what, string_types):
+            if what.startswith("redirect "):
+                return None
+            elif "." in what:
+                mod, cls = what.rsplit(".", 1)
+                what = getattr(__import__(mod, None, None, [""]), cls)
+            else:
+                what = self.fvars.get(what)
+        if isclass(what):
+            meth = web.ctx.method
+            if meth == "HEAD" and not hasattr(what, meth):
+                meth = "GET"
+            return getattr(what, meth, None)
+        return what
 
-        web.ctx.scope["input"] = body
+    def _match_handler(self, path):
+        for pat, what in self.mapping:
+            if isinstance(what, application):
+                if path.startswith(pat):
+                    return what, pat
+                continue
+            elif isinstance(what, string_types):
+                what, result = utils.re_subm(r"^%s\Z" % (pat,), what, path)
+            else:
+                result = utils.re_compile(r"^%s\Z" % (pat,)).match(path)
+            if result:
+                return what, None
+        return None, None
 
+    async def __call__(self, receive, send):
         try:
+            await self._respond(receive, send)
+        finally:
+            # e.g. the database connections opened by the request.
+            for cleanup in web.ctx.get("cleanups", []):
+                cleanup()
+
+    async def _respond(self, receive, send):
+        try:
+            if web.ctx.method not in ("GET", "HEAD") and getattr(self._lookup(web.ctx.path), "stream_body", False):
+                # the handler reads the body itself with `web.body_chunks()`.
+                web.ctx.scope["receive"] = receive
+            else:
+                await self._read_body(receive)
             if web.ctx.method.upper() != web.ctx.method:
                 raise web.nomethod()
             result = await self.handle_with_processors()
@@ -323,9 +411,9 @@ class application:
         except web.HTTPError as e:
             result = e.data
 
-        await send({"type": "http.response.start", "status": web.ctx.status, "headers": web.ctx.headers})
         if hasattr(result, "__body__"):
-            result = str(body)
+            result = result.__body__()
+        await send({"type": "http.response.start", "status": web.ctx.status, "headers": web.ctx.headers})
         if is_iter(result):
             for chunck in result:
                 await send({"type": "http.response.body", "body": safebytes(chunck), "more_body": True})
@@ -358,6 +446,7 @@ class application:
         ctx.clear()
 
         ctx.status = 200
+        ctx.cleanups = []
 
         ctx.headers: types.Headers = types.Headers({})
         ctx.output = ""
@@ -486,6 +575,7 @@ class application:
             if isinstance(what, application):
                 if value.startswith(pat):
                     what.parent = self
+                    web.ctx.route = web.ctx.get("route", "") + pat
                     return (self._delegate_sub_application(pat, what), None)
                 else:
                     continue
@@ -495,6 +585,8 @@ class application:
                 result = utils.re_compile(r"^%s\Z" % (pat,)).match(value)
 
             if result:  # it's a match
+                # the url pattern, for grouping requests in logs and metrics.
+                web.ctx.route = web.ctx.get("route", "") + pat
                 return what, [x for x in result.groups()]
         return None, None
 
@@ -610,7 +702,8 @@ class subdomain_application(application):
         logger.getChild("subdomain_application.handle").debug("host: %s", host)
         fn, args = self._match(self.mapping, host)
         logger.getChild("subdomain_application.handle").debug("fn: %s, args: %s", fn, args)
-        return await self._delegate(fn, self.fvars, args)
+        with tracing.child_span("handler", handler=fn), timing.measure("handler"):
+            return await self._delegate(fn, self.fvars, args)
 
     def _match(self, mapping, value):
         for pat, what in mapping:
@@ -624,6 +717,10 @@ class subdomain_application(application):
                 return what, [x for x in result.groups()]
         return None, None
 
+    def _match_handler(self, path):
+        what, args = self._match(self.mapping, web.ctx.host.split(":")[0])
+        return what, ""
+
 
 def loadhook(h):
     """
@@ -645,6 +742,7 @@ def loadhook(h):
         else:
             return handler()
 
+    processor.__name__ = "loadhook(%s)" % getattr(h, "__name__", type(h).__name__)
     return processor
 
 
@@ -698,6 +796,7 @@ def unloadhook(h):
     #         except StopIteration:
     #             return
 
+    processor.__name__ = "unloadhook(%s)" % getattr(h, "__name__", type(h).__name__)
     return processor
 
 
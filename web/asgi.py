@@ -3,11 +3,27 @@ ASGI Utilities
 (from asyncio-webpy)
 """
 
+__all__ = ["runasgi", "GzipMiddleware", "StaticMiddleware", "AccessLogMiddleware"]
+
 import os, sys
+import re
+import json
+import zlib
+import stat
+import time
+import random
+import functools
+import asyncio
+import hashlib
+import datetime
+import mimetypes
+import posixpath
+from collections import OrderedDict
+from collections.abc import Mapping
 
-from . import http
+from . import http, net
 from . import webapi as web
-from .utils import listget, intget
+from .utils import BatchWriter, listget, intget, safestr, safebytes
 from .net import validaddr, validip
 from . import httpserver
 
@@ -25,6 +41,631 @@ def runasgi(func):
     return httpserver.runsimple(func, server_addr)
 
 
+def request_header(scope, name, default=None):
+    """
+    Returns the value of the request header `name` from an ASGI `scope`.
+
+    Works both on the raw header list sent by the server and on the scope
+    once `application.load` has replaced it with an `ImmutableDict`.
+    """
+    key = name.lower().replace("-", "_")
+    headers = scope.get("headers") or ()
+    if isinstance(headers, Mapping):
+        for k in (key, "http_" + key):
+            if k in headers:
+                return headers[k]
+        return default
+    for k, v in headers:
+        k = safestr(k).lower().replace("-", "_")
+        if k == key or k == "http_" + key:
+            return safestr(v)
+    return default
+
+
+def response_header(headers, name, default=None):
+    """Returns the value of header `name` from the `headers` of an `http.response.start` message."""
+    name = name.lower()
+    items = headers.items() if isinstance(headers, Mapping) else headers
+    for k, v in items:
+        if safestr(k).lower() == name:
+            return safestr(v)
+    return default
+
+
+def update_headers(headers, values, remove=()):
+    """
+    Returns a copy of the response `headers` with `values` set and the
+    headers named in `remove` dropped, keeping the form they were given in:
+    a dict of strings as `application` sends them or a list of byte pairs.
+    """
+    drop = {name.lower() for name in remove} | {name.lower() for name in values}
+    if isinstance(headers, Mapping):
+        result = {k: v for k, v in headers.items() if safestr(k).lower() not in drop}
+        result.update(values)
+        return result
+    result = [(k, v) for k, v in headers if safestr(k).lower() not in drop]
+    result.extend((safebytes(k), safebytes(v)) for k, v in values.items())
+    return result
+
+
+def _status(status):
+    return intget(str(status).split(" ", 1)[0], 200)
+
+
+class GzipMiddleware:
+    """
+    ASGI middleware compressing responses with gzip or deflate, whichever
+    the client prefers in its `Accept-Encoding` header.
+
+    Streamed responses are compressed chunk by chunk as they are sent.
+    Bodies smaller than `minimum_size` bytes, responses which already carry
+    a `Content-Encoding` and content types which don't compress well are
+    sent unchanged. Compressed whole bodies of up to `cache_max_body` bytes
+    are kept in an LRU cache of `cache_size` entries, so hot static
+    responses are only compressed once.
+
+        asgi = app.asgifunc(web.GzipMiddleware)
+        asgi = app.asgifunc(lambda a: web.GzipMiddleware(a, minimum_size=1024))
+    """
+
+    compressible_types = (
+        "text/",
+        "application/json",
+        "application/javascript",
+        "application/xml",
+        "application/xhtml+xml",
+        "image/svg+xml",
+    )
+
+    def __init__(self, app, minimum_size=500, level=6, cache_size=128, cache_max_body=1024 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.cache_size = cache_size
+        self.cache_max_body = cache_max_body
+        self.cache = OrderedDict()
+
+    def __call__(self, scope):
+        inner = self.app(scope)
+        encoding = self.negotiate(request_header(scope, "Accept-Encoding", ""))
+
+        async def app(receive, send):
+            await inner(receive, _CompressingSender(self, encoding, send))
+
+        return app
+
+    @staticmethod
+    def negotiate(accept_encoding):
+        """
+        Returns "gzip", "deflate" or None for the given `Accept-Encoding` header.
+
+            >>> GzipMiddleware.negotiate("deflate, gzip;q=0.5")
+            'deflate'
+            >>> GzipMiddleware.negotiate("*;q=0.1, gzip;q=0")
+            'deflate'
+            >>> GzipMiddleware.negotiate("identity") is None
+            True
+        """
+        weights = {}
+        for part in accept_encoding.lower().split(","):
+            coding, _, params = part.partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            weights[coding.strip()] = q
+
+        star = weights.get("*", 0.0)
+        best, best_q = None, 0.0
+        for coding in ("gzip", "deflate"):
+            q = weights.get(coding, star)
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def compressible(self, headers):
+        content_type = response_header(headers, "Content-Type", "text/html").lower()
+        return content_type.startswith(self.compressible_types) or content_type.split(";")[0].endswith(
+            ("+json", "+xml")
+        )
+
+    def compressor(self, encoding):
+        wbits = 31 if encoding == "gzip" else 15
+        return zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+
+    def compress(self, encoding, body):
+        """Compresses a whole `body`, going through the LRU cache."""
+        if len(body) > self.cache_max_body or not self.cache_size:
+            c = self.compressor(encoding)
+            return c.compress(body) + c.flush()
+
+        key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+        try:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        except KeyError:
+            pass
+        c = self.compressor(encoding)
+        data = self.cache[key] = c.compress(body) + c.flush()
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return data
+
+
+class _CompressingSender:
+    """The `send` callable `GzipMiddleware` passes down for one response."""
+
+    def __init__(self, middleware, encoding, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            headers = message.get("headers", {})
+            status = _status(message["status"])
+            if (
+                status < 200
+                or status in (204, 206, 304)
+                or response_header(headers, "Content-Range")
+                or not self.middleware.compressible(headers)
+            ):
+                self.passthrough = True
+                return await self.send(message)
+            headers = update_headers(headers, {"Vary": self._vary(headers)})
+            if self.encoding is None or response_header(headers, "Content-Encoding"):
+                self.passthrough = True
+                return await self.send(dict(message, headers=headers))
+            # wait for the first chunk of the body to decide.
+            self.start = dict(message, headers=headers)
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            return await self.send(message)
+
+        body = safebytes(message.get("body", b""))
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            if not more_body:
+                if len(body) < self.middleware.minimum_size:
+                    self.passthrough = True
+                    await self.send(start)
+                    return await self.send(message)
+                body = self.middleware.compress(self.encoding, body)
+                start["headers"] = update_headers(
+                    start["headers"],
+                    self._encoded({"Content-Encoding": self.encoding, "Content-Length": str(len(body))}, start),
+                )
+                await self.send(start)
+                return await self.send(dict(message, body=body))
+
+            self.compressor = self.middleware.compressor(self.encoding)
+            start["headers"] = update_headers(
+                start["headers"], self._encoded({"Content-Encoding": self.encoding}, start), remove=["Content-Length"]
+            )
+            await self.send(start)
+
+        data = self.compressor.compress(body)
+        if not more_body:
+            data += self.compressor.flush()
+        if data or not more_body:
+            await self.send(dict(message, body=data))
+
+    def _encoded(self, values, start):
+        # the encoded body is not byte for byte the one a strong ETag stands for.
+        etag = response_header(start["headers"], "ETag")
+        if etag and not etag.startswith("W/"):
+            values["ETag"] = "W/" + etag
+        return values
+
+    def _vary(self, headers):
+        vary = response_header(headers, "Vary")
+        if not vary:
+            return "Accept-Encoding"
+        if "accept-encoding" in vary.lower() or vary.strip() == "*":
+            return vary
+        return vary + ", Accept-Encoding"
+
+
+def _weak(etag):
+    """Returns `etag` without its weak indicator, for the weak comparison of `If-None-Match`."""
+    etag = etag.strip()
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+class _StaticFile:
+    """Stat of a static file together with its precomputed response headers."""
+
+    __slots__ = ("path", "size", "mtime", "etag", "modified", "headers", "checked", "fingerprint")
+
+    def __init__(self, path, st, content_type, checked):
+        self.path = path
+        # the fingerprinted name checked against the content of this version of the file.
+        self.fingerprint = None
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.modified = datetime.datetime.utcfromtimestamp(int(st.st_mtime))
+        self.checked = checked
+        self.headers = [
+            (b"content-type", safebytes(content_type)),
+            (b"content-length", b"%d" % st.st_size),
+            (b"etag", safebytes(self.etag)),
+            (b"last-modified", safebytes(net.httpdate(self.modified))),
+            (b"accept-ranges", b"bytes"),
+        ]
+
+
+class StaticMiddleware:
+    """
+    ASGI middleware serving the files in `directory` at the URLs starting
+    with `prefix`; everything else goes to the wrapped application.
+
+        asgi = app.asgifunc(web.StaticMiddleware)
+
+    File stats are cached for up to `max_entries` files and checked again at
+    most every `check_interval` seconds, so a file is rebuilt when its mtime
+    or size changes. Files up to `memory_file_size` bytes are kept in an LRU
+    of `memory_cache_size` bytes. When the client accepts gzip and a `.gz`
+    sibling of the file exists, the sibling is sent instead. Larger files go
+    out through the server's `http.response.zerocopy` extension when it
+    offers one, and are otherwise read in `chunk_size` pieces off the event
+    loop. `If-None-Match` and `Range` requests are answered as well.
+
+    With a `StaticManifest`, the fingerprinted names it lists are served too,
+    marked `Cache-Control: public, max-age=31536000, immutable`, as long as
+    their hash matches the content of the file; they are not found when the
+    file changed since the manifest was built. The manifest itself isn't
+    served.
+    """
+
+    immutable = [(b"cache-control", b"public, max-age=31536000, immutable")]
+
+    def __init__(
+        self,
+        app,
+        prefix="/static/",
+        directory="static",
+        max_entries=1024,
+        check_interval=1.0,
+        memory_file_size=64 * 1024,
+        memory_cache_size=16 * 1024 * 1024,
+        chunk_size=256 * 1024,
+        manifest=None,
+    ):
+        self.app = app
+        self.manifest = manifest
+        self.prefix = prefix
+        self.root = os.path.abspath(directory)
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.memory_file_size = memory_file_size
+        self.memory_cache_size = memory_cache_size
+        self.chunk_size = chunk_size
+        self.files = OrderedDict()
+        self.missing = OrderedDict()
+        self.bodies = OrderedDict()
+        self.bodies_size = 0
+
+    def __call__(self, scope):
+        path = scope.get("path", "")
+        if scope.get("type", "http") != "http" or not path.startswith(self.prefix):
+            return self.app(scope)
+
+        async def app(receive, send):
+            await self.serve(scope, path[len(self.prefix) :], send)
+
+        return app
+
+    def resolve(self, name):
+        """Returns the filesystem path of the URL path `name`, or None if it is outside `directory`."""
+        name = posixpath.normpath(name)
+        if name.startswith(("/", "../")) or name == ".." or "\x00" in name or "\\" in name:
+            return None
+        return os.path.join(self.root, *name.split("/"))
+
+    def lookup(self, path, content_type=None):
+        """
+        Returns the cached `_StaticFile` for `path`, checking its stat first
+        if it is due. None if it isn't a file.
+        """
+        now = time.monotonic()
+        entry = self.files.get(path)
+        if entry is not None and now - entry.checked < self.check_interval:
+            self.files.move_to_end(path)
+            return entry
+        checked = self.missing.get(path)
+        if checked is not None and now - checked < self.check_interval:
+            return None
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.forget(path)
+            # remember misses too, `.gz` siblings are looked up on every hit.
+            self.missing[path] = now
+            self.missing.move_to_end(path)
+            while len(self.missing) > self.max_entries:
+                self.missing.popitem(last=False)
+            return None
+        self.missing.pop(path, None)
+        if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+            entry.checked = now
+            self.files.move_to_end(path)
+            return entry
+
+        self.forget(path)
+        if content_type is None:
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            if content_type.startswith("text/"):
+                content_type += "; charset=utf-8"
+        entry = self.files[path] = _StaticFile(path, st, content_type, now)
+        while len(self.files) > self.max_entries:
+            self.forget(next(iter(self.files)))
+        return entry
+
+    def forget(self, path):
+        if self.files.pop(path, None) is not None:
+            body = self.bodies.pop(path, None)
+            if body is not None:
+                self.bodies_size -= len(body)
+
+    async def serve(self, scope, name, send):
+        method = scope.get("method", "GET")
+        if method not in ("GET", "HEAD"):
+            return await self.error(send, 405, b"method not allowed", [(b"allow", b"GET, HEAD")])
+        manifest = self.manifest
+        original = manifest and manifest.original(name)
+        path = self.resolve(original or name)
+        if manifest and path == os.path.abspath(manifest.path):
+            path = None
+        entry = path and self.lookup(path)
+        if entry is not None and original and entry.fingerprint != name:
+            loop = asyncio.get_event_loop()
+            if not await loop.run_in_executor(None, manifest.matches, name, path):
+                entry = None
+            else:
+                entry.fingerprint = name
+        if entry is None:
+            return await self.error(send, 404, b"not found")
+
+        headers = entry.headers
+        range_header = request_header(scope, "Range")
+        gz = self.lookup(path + ".gz", headers[0][1])
+        if gz is not None:
+            if (
+                range_header is None
+                and GzipMiddleware.negotiate(request_header(scope, "Accept-Encoding", "")) == "gzip"
+            ):
+                entry = gz
+                headers = gz.headers + [(b"content-encoding", b"gzip")]
+            headers = headers + [(b"vary", b"Accept-Encoding")]
+        if original:
+            headers = headers + self.immutable
+
+        etags = request_header(scope, "If-None-Match")
+        if etags is not None and (etags.strip() == "*" or entry.etag in [_weak(e) for e in etags.split(",")]):
+            headers = [(k, v) for k, v in headers if k in (b"etag", b"last-modified", b"vary")]
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            return await send({"type": "http.response.body", "body": b""})
+
+        ranges = None
+        if range_header is not None and method == "GET":
+            if http.if_range(request_header(scope, "If-Range"), entry.etag.strip('"'), entry.modified):
+                ranges = http.parse_range(range_header, entry.size)
+        if ranges == []:
+            headers = [(b"content-range", b"bytes */%d" % entry.size)]
+            return await self.error(send, 416, b"range not satisfiable", headers)
+
+        if ranges is None:
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            if method == "HEAD":
+                return await send({"type": "http.response.body", "body": b""})
+            return await self.send_file(scope, send, entry, 0, entry.size)
+
+        headers = [(k, v) for k, v in headers if k not in (b"content-type", b"content-length")]
+        content_type = entry.headers[0][1]
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            headers += [
+                (b"content-type", content_type),
+                (b"content-length", b"%d" % (stop - start)),
+                (b"content-range", b"bytes %d-%d/%d" % (start, stop - 1, entry.size)),
+            ]
+            await send({"type": "http.response.start", "status": 206, "headers": headers})
+            return await self.send_file(scope, send, entry, start, stop - start)
+
+        loop = asyncio.get_event_loop()
+        fd = os.open(entry.path, os.O_RDONLY)
+        try:
+            content_type, length, parts = http.byteranges_body(
+                ranges, entry.size, safestr(content_type), lambda start, stop: self._read_range(fd, start, stop)
+            )
+            headers += [(b"content-type", safebytes(content_type)), (b"content-length", b"%d" % length)]
+            await send({"type": "http.response.start", "status": 206, "headers": headers})
+            # one part at a time: the parts together may be as large as the file.
+            for part in parts:
+                if not isinstance(part, bytes):
+                    part = await loop.run_in_executor(None, part)
+                await send({"type": "http.response.body", "body": part, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            os.close(fd)
+
+    def _read_range(self, fd, start, stop):
+        """Returns callables reading `start:stop` of `fd` in `chunk_size` pieces, to be run off the event loop."""
+        for offset in range(start, stop, self.chunk_size):
+            yield functools.partial(os.pread, fd, min(self.chunk_size, stop - offset), offset)
+
+    async def send_file(self, scope, send, entry, offset, count):
+        loop = asyncio.get_event_loop()
+        if entry.size <= self.memory_file_size:
+            body = self.bodies.get(entry.path)
+            if body is None:
+                body = await loop.run_in_executor(None, _read_file, entry.path)
+                if len(body) != entry.size:
+                    # changed under our feet, don't keep it.
+                    self.forget(entry.path)
+                elif entry.path in self.files:
+                    self.bodies[entry.path] = body
+                    self.bodies_size += len(body)
+                    while self.bodies_size > self.memory_cache_size:
+                        self.bodies_size -= len(self.bodies.popitem(last=False)[1])
+            else:
+                self.bodies.move_to_end(entry.path)
+            return await send({"type": "http.response.body", "body": body[offset : offset + count]})
+
+        with open(entry.path, "rb") as f:
+            if "http.response.zerocopy" in (scope.get("extensions") or {}):
+                return await send({"type": "http.response.zerocopy", "file": f, "offset": offset, "count": count})
+            fd = f.fileno()
+            while count > 0:
+                chunk = await loop.run_in_executor(None, os.pread, fd, min(self.chunk_size, count), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+            if count > 0:
+                await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    async def error(send, status, message, headers=()):
+        headers = [(b"content-type", b"text/html"), (b"content-length", b"%d" % len(message))] + list(headers)
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": message})
+
+
+class AccessLogMiddleware(BatchWriter):
+    """
+    ASGI middleware writing an access log without blocking requests.
+
+    Every response becomes a record with the client address, method, path,
+    status, body size, latency and `route` pattern, which is put on a
+    queue of at most `queue_size` records. A background task takes up to
+    `batch_size` records at a time, waiting `flush_interval` seconds for a
+    batch to fill, and writes them to `stream` from a worker thread.
+    Records which don't fit in the queue are counted in `dropped`.
+
+    `format` is "common" (Common Log Format), "json" (one object per line)
+    or a function formatting a record dict into a line. Only a
+    `sample_2xx` fraction of successful responses is logged.
+
+        asgi = app.asgifunc(web.AccessLogMiddleware)
+        asgi = app.asgifunc(lambda a: web.AccessLogMiddleware(a, format="json", sample_2xx=0.1))
+    """
+
+    what = "the access log"
+
+    def __init__(
+        self,
+        app,
+        stream=None,
+        format="common",
+        queue_size=10000,
+        batch_size=256,
+        flush_interval=0.5,
+        sample_2xx=1.0,
+    ):
+        super().__init__(None, stream, queue_size, batch_size, flush_interval)
+        self.app = app
+        if format == "common":
+            format = self.common
+        elif format == "json":
+            format = self.json
+        self.format = format
+        self.sample_2xx = sample_2xx
+
+    def __call__(self, scope):
+        inner = self.app(scope)
+
+        async def app(receive, send):
+            started = time.perf_counter()
+            response = {"status": 500, "bytes": 0}
+
+            async def logging_send(message):
+                if message["type"] == "http.response.start":
+                    response["status"] = _status(message["status"])
+                elif message["type"] == "http.response.zerocopy":
+                    response["bytes"] += message.get("count") or 0
+                else:
+                    response["bytes"] += len(message.get("body") or b"")
+                await send(message)
+
+            try:
+                await inner(receive, logging_send)
+            finally:
+                self.log(scope, response["status"], response["bytes"], time.perf_counter() - started)
+
+        return app
+
+    def log(self, scope, status, size, latency):
+        if 200 <= status < 300 and self.sample_2xx < 1.0 and random.random() >= self.sample_2xx:
+            return
+        client = scope.get("client") or ("-", 0)
+        self.put(
+            {
+                "time": time.time(),
+                "remote": client[0] or "-",
+                "method": scope.get("method", "-"),
+                "path": scope.get("path", ""),
+                "query": safestr(scope.get("query_string") or b""),
+                "protocol": "HTTP/" + scope.get("http_version", "1.1"),
+                "status": status,
+                "bytes": size,
+                "latency": latency,
+                "route": web.ctx.get("route"),
+            }
+        )
+
+    @staticmethod
+    def common(record):
+        """Formats `record` in the Common Log Format."""
+        path = record["path"] + ("?" + record["query"] if record["query"] else "")
+        return '%s - - [%s] "%s %s %s" %d %s' % (
+            _log_escape(record["remote"]),
+            time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(record["time"])),
+            _log_escape(record["method"]),
+            _log_escape(path),
+            _log_escape(record["protocol"]),
+            record["status"],
+            record["bytes"] or "-",
+        )
+
+    @staticmethod
+    def json(record):
+        """Formats `record` as a JSON object."""
+        return json.dumps(dict(record, latency=round(record["latency"], 6)), separators=(",", ":"))
+
+
+_log_unsafe = re.compile(r'["\\\x00-\x1f\x7f]')
+
+
+def _log_escape(value):
+    """
+    Escapes the quotes, backslashes and control characters of `value` as
+    `\\xNN`, so that it can neither close a quoted field nor start a line.
+
+        >>> print(_log_escape('/a"b\\nc'))
+        /a\\x22b\\x0ac
+    """
+    return _log_unsafe.sub(lambda m: "\\x%02x" % ord(m.group()), value)
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
 def _is_dev_mode():
     # Some embedded python interpreters won't have sys.arv
     # For details, see https://github.com/webpy/webpy/issues/87
@@ -0,0 +1,258 @@
+"""
+Response Caching
+(from asyncio-webpy)
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+
+from . import utils
+from . import webapi as web
+from .asgi import request_header, response_header
+from .py3helpers import is_iter
+
+__all__ = ["ResponseCache"]
+
+logger = logging.getLogger("web.cache")
+
+
+class _Entry:
+    __slots__ = ("status", "headers", "body", "expires", "stale_until", "tags", "public", "size")
+
+    def __init__(self, status, headers, body, expires, stale_until, tags, public):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.stale_until = stale_until
+        self.tags = tags
+        self.public = public
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+
+class ResponseCache:
+    """
+    Processor caching whole responses of `GET` and `HEAD` requests.
+
+    Responses are keyed on the method, path and query string, plus the
+    values of the request headers named in the response's `Vary` header.
+    Only `200` responses which don't set cookies and aren't marked
+    `Cache-Control: private` or `no-store` are kept. Requests with an
+    `Authorization` header or a session cookie bypass the cache, unless
+    the response is marked `Cache-Control: public`. Streamed responses
+    larger than `max_bytes` are passed through without being cached.
+
+    An entry is fresh for `ttl` seconds and is then served stale for up to
+    `stale` more seconds while a single background request refreshes it.
+    Concurrent misses for the same key wait for the one request already
+    computing it. The least recently used entries are evicted beyond
+    `max_entries` entries or `max_bytes` bytes.
+
+        cache = web.ResponseCache(ttl=60)
+        app.add_processor(cache)
+
+        class item:
+            def GET(self, id):
+                cache.tag("item:" + id)
+                ...
+
+            def POST(self, id):
+                ...
+                cache.invalidate("item:" + id)
+    """
+
+    def __init__(self, ttl=60, stale=300, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.vary = {}
+        # number of entries per method, path and query, to drop their `vary` with the last one
+        self.variants = {}
+        self.tags = {}
+        self.inflight = {}
+
+    def tag(self, *tags):
+        """Tags the response of the current request, for `invalidate`."""
+        web.ctx.cache_tags = web.ctx.get("cache_tags", ()) + tags
+
+    def invalidate(self, *tags):
+        """Drops every cached response tagged with any of `tags`."""
+        for tag in tags:
+            for key in list(self.tags.pop(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.tags.clear()
+        self.vary.clear()
+        self.variants.clear()
+        self.size = 0
+
+    def _key(self):
+        scope = web.ctx.scope
+        base = (web.ctx.method, scope["path"], scope.get("query_string", b""))
+        names = self.vary.get(base, ())
+        return base, base + tuple(request_header(scope, name) for name in names)
+
+    async def __call__(self, handler):
+        if web.ctx.method not in ("GET", "HEAD"):
+            return await handler()
+
+        base, key = self._key()
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if self._private():
+            # the response may be meant for this client only, so it isn't shared with others.
+            if entry is not None and entry.public and now < entry.expires:
+                self.entries.move_to_end(key)
+                return self._serve(entry)
+            return (await self._compute(base, key, handler, private=True))[1]
+
+        if entry is not None:
+            if now < entry.expires:
+                self.entries.move_to_end(key)
+                return self._serve(entry)
+            if now < entry.stale_until:
+                self.entries.move_to_end(key)
+                if key not in self.inflight:
+                    self.inflight[key] = asyncio.get_event_loop().create_future()
+                    asyncio.ensure_future(self._refresh(base, key, handler))
+                return self._serve(entry)
+            self._remove(key)
+
+        future = self.inflight.get(key)
+        if future is not None:
+            entry = await asyncio.shield(future)
+            if entry is not None:
+                return self._serve(entry)
+            return await handler()
+
+        future = self.inflight[key] = asyncio.get_event_loop().create_future()
+        try:
+            entry, body = await self._compute(base, key, handler)
+        except BaseException:
+            self._finish(key, future, None)
+            raise
+        self._finish(key, future, entry)
+        return body
+
+    def _finish(self, key, future, entry):
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if not future.done():
+            future.set_result(entry)
+
+    async def _refresh(self, base, key, handler):
+        future = self.inflight[key]
+        entry = None
+        try:
+            # the background request must not touch the headers of the one being served.
+            web.ctx.status = 200
+            web.ctx.headers = {}
+            web.ctx.cache_tags = ()
+            entry, _ = await self._compute(base, key, handler)
+        except Exception as exc:
+            logger.getChild("ResponseCache._refresh").warning("refreshing %r failed", key, exc_info=exc)
+        finally:
+            self._finish(key, future, entry)
+
+    def _private(self):
+        """Returns whether the request carries credentials: an `Authorization` header or a session cookie."""
+        if request_header(web.ctx.scope, "Authorization") is not None:
+            return True
+        cookie_name = (web.config.get("session_parameters") or {}).get("cookie_name", "webpy_session_id")
+        return cookie_name in web.parse_cookies(request_header(web.ctx.scope, "Cookie", ""))
+
+    async def _compute(self, base, key, handler, private=False):
+        """
+        Runs `handler` and stores its response. Returns the new entry, or
+        None, and the body, which is left streaming when it isn't stored.
+        """
+        before = dict(web.ctx.headers)
+        result = await handler()
+        if hasattr(result, "__body__"):
+            result = result.__body__()
+        if is_iter(result):
+            headers = [(k, v) for k, v in web.ctx.headers.items() if before.get(k) != v]
+            if not self._cacheable(headers, private):
+                return None, result
+            # buffer the body only as long as it may still be stored.
+            chunks, size, rest = [], 0, iter(result)
+            for chunk in rest:
+                chunk = utils.safebytes(chunk)
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.max_bytes:
+                    return None, itertools.chain(chunks, rest)
+            result = b"".join(chunks)
+        body = utils.safebytes(result) if result is not None else b""
+
+        headers = [(k, v) for k, v in web.ctx.headers.items() if before.get(k) != v]
+        if not self._cacheable(headers, private):
+            return None, body
+
+        vary = response_header(headers, "Vary", "")
+        names = tuple(sorted({name.strip().lower() for name in vary.split(",") if name.strip()}))
+        if self.vary.get(base, ()) != names:
+            key = base + tuple(request_header(web.ctx.scope, name) for name in names)
+
+        now = time.monotonic()
+        tags = web.ctx.get("cache_tags", ())
+        public = "public" in response_header(headers, "Cache-Control", "").lower()
+        entry = _Entry(web.ctx.status, headers, body, now + self.ttl, now + self.ttl + self.stale, tags, public)
+        if entry.size <= self.max_bytes:
+            self.vary[base] = names
+            self._store(key, entry)
+        return entry, body
+
+    def _cacheable(self, headers, private=False):
+        if str(web.ctx.status).split(" ", 1)[0] != "200":
+            return False
+        if response_header(headers, "Set-Cookie") is not None:
+            return False
+        cache_control = response_header(headers, "Cache-Control", "").lower()
+        if "private" in cache_control or "no-store" in cache_control:
+            return False
+        if private and "public" not in cache_control:
+            return False
+        return response_header(headers, "Vary", "").strip() != "*"
+
+    def _store(self, key, entry):
+        self._remove(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        base = key[:3]
+        self.variants[base] = self.variants.get(base, 0) + 1
+        for tag in entry.tags:
+            self.tags.setdefault(tag, set()).add(key)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        base = key[:3]
+        self.variants[base] -= 1
+        if not self.variants[base]:
+            del self.variants[base]
+            self.vary.pop(base, None)
+        for tag in entry.tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def _serve(self, entry):
+        web.ctx.status = entry.status
+        for k, v in entry.headers:
+            web.header(k, v)
+        return entry.body
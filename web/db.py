@@ -3,20 +3,33 @@ Database API
 (part of web.py)
 """
 import ast
+import asyncio
+import contextvars
 import datetime
+import decimal
+import functools
+import importlib
+import itertools
 import os
 import re
+import threading
 import time
+import uuid
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote, urlparse
 
+from . import metrics, timing, tracing
 from .py3helpers import iteritems, numeric_types, string_types
-from .utils import Context, iterbetter, iters, safestr, safebytes, storage
-from .webapi import config, debug
+from .utils import Context, iterbetter, iters, memoize, safestr, safebytes, storage
+from .webapi import config, ctx as web_ctx, debug
 
 __all__ = [
     "UnknownParamstyle",
     "UnknownDB",
     "TransactionError",
+    "PoolTimeout",
+    "ConnectionPool",
     "sqllist",
     "sqlors",
     "reparam",
@@ -27,7 +40,13 @@ __all__ = [
     "SQLLiteral",
     "sqlliteral",
     "database",
+    "asyncdatabase",
     "DB",
+    "AsyncDB",
+    "ResultSet",
+    "ResultStream",
+    "Row",
+    "AsyncResultStream",
 ]
 
 TOKEN = (
@@ -63,6 +82,12 @@ class TransactionError(Exception):
     pass
 
 
+class PoolTimeout(Exception):
+    """raised when no pooled connection becomes available in time"""
+
+    pass
+
+
 class UnknownParamstyle(Exception):
     """
     raised for unsupported db paramstyles
@@ -130,9 +155,13 @@ class SQLQuery(object):
 
     Internally, consists of `items`, which is a list of strings and
     SQLParams, which get concatenated to produce the actual query.
+
+    Queries made by `reparam` of a string with no lists or SQL literals in
+    its values keep the parsed string as their `template`, where their text
+    is only built once per paramstyle. Modifying a query drops it.
     """
 
-    __slots__ = ["items"]
+    __slots__ = ["items", "template"]
 
     # tested in sqlquote's docstring
     def __init__(self, items=None):
@@ -148,6 +177,7 @@ class SQLQuery(object):
             >>> SQLQuery(SQLParam(1))
             <sql: '1'>
         """
+        self.template = None
         if items is None:
             self.items = []
         elif isinstance(items, list):
@@ -156,6 +186,7 @@ class SQLQuery(object):
             self.items = [items]
         elif isinstance(items, SQLQuery):
             self.items = list(items.items)
+            self.template = items.template
         else:
             self.items = [items]
 
@@ -166,6 +197,7 @@ class SQLQuery(object):
 
     def append(self, value):
         self.items.append(value)
+        self.template = None
 
     def __add__(self, other):
         if isinstance(other, string_types):
@@ -192,6 +224,7 @@ class SQLQuery(object):
             self.items.extend(other.items)
         else:
             return NotImplemented
+        self.template = None
         return self
 
     def __len__(self):
@@ -209,6 +242,15 @@ class SQLQuery(object):
             >>> q.query(paramstyle='qmark')
             'SELECT * FROM test WHERE name=?'
         """
+        template = self.template
+        if template is None:
+            return self._render(paramstyle)
+        text = template.texts.get(paramstyle)
+        if text is None:
+            text = template.texts[paramstyle] = self._render(paramstyle)
+        return text
+
+    def _render(self, paramstyle=None):
         s = []
         for x in self.items:
             if isinstance(x, SQLParam):
@@ -249,6 +291,8 @@ class SQLQuery(object):
         """
         if target is None:
             target = SQLQuery()
+        else:
+            target.template = None
 
         target_items = target.items
 
@@ -287,6 +331,34 @@ class SQLQuery(object):
         return "<sql: %s>" % repr(str(self))
 
 
+def _insert_keys(values):
+    """Returns the sorted keys of the dicts `values`, or None when they differ."""
+    keys = values[0].keys()
+    for v in values:
+        if v.keys() != keys:
+            return None
+    return sorted(keys)
+
+
+def _insert_rows(keys, values):
+    """Returns `values` as tuples in the order of `keys`, or None when they hold SQL literals."""
+    rows = [tuple([row[k] for k in keys]) for row in values]
+    for row in rows:
+        for v in row:
+            if type(v) is SQLLiteral:
+                return None
+    return rows
+
+
+def _join_ids(ranges):
+    """Joins the ranges of ids inserted by consecutive statements, None when some are unknown."""
+    if not ranges or None in ranges:
+        return None
+    if all(a.stop == b.start for a, b in zip(ranges, ranges[1:])):
+        return range(ranges[0].start, ranges[-1].stop)
+    return [i for r in ranges for i in r]
+
+
 class SQLLiteral:
     """
     Protects a string from `sqlquote`.
@@ -526,6 +598,228 @@ class Transaction:
             self.ctx.transactions = self.ctx.transactions[: self.transaction_count]
 
 
+class PooledConnection:
+    """A connection checked out of a `ConnectionPool`. Closing it returns it to the pool."""
+
+    __slots__ = ("pool", "raw", "created", "idle_since", "checked_out")
+
+    def __init__(self, pool, raw):
+        self.pool = pool
+        self.raw = raw
+        self.created = self.idle_since = time.monotonic()
+        self.checked_out = False
+
+    def cursor(self, *a, **kw):
+        return self.raw.cursor(*a, **kw)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        if self.checked_out:
+            self.pool.release(self)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def _running_loop():
+    """Returns whether an event loop is running in the current thread."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of the connections returned by `connect()`.
+
+    Holds between `min_size` and `max_size` connections. `acquire` waits up
+    to `timeout` seconds for one to be released when all are in use, then
+    raises `PoolTimeout`. On the thread of a running event loop it doesn't
+    wait, as that would block the tasks which are to release the
+    connections, and raises `PoolTimeout` at once; use `AsyncDB` there.
+    Connections idle for more than `check_after`
+    seconds are tested with the `health_check` statement before being
+    handed out, and connections older than `max_lifetime` seconds are
+    replaced, so that the ones dropped by the server or by a firewall are
+    never used.
+
+    `DB` checks a connection out for every query outside of a transaction,
+    and for the whole of a transaction, and keeps it in a context variable,
+    so that concurrent requests never share one.
+
+        >>> import sqlite3
+        >>> pool = ConnectionPool(lambda: sqlite3.connect(":memory:"), max_size=2)
+        >>> conn = pool.acquire()
+        >>> pool.stats().in_use
+        1
+        >>> conn.close()
+        >>> pool.stats().idle
+        1
+    """
+
+    def __init__(
+        self,
+        connect,
+        min_size=0,
+        max_size=10,
+        timeout=30.0,
+        max_lifetime=3600.0,
+        health_check="SELECT 1",
+        check_after=5.0,
+    ):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.check_after = check_after
+        self.idle = []
+        self.size = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.closed = False
+        self._lock = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Returns a connection, waiting up to `timeout` (default: `self.timeout`) seconds for one."""
+        if timeout is None:
+            timeout = self.timeout
+        on_loop = _running_loop()
+        started = time.monotonic()
+        with self._lock:
+            if self.closed:
+                raise PoolTimeout("the pool is closed")
+            self.waiting += 1
+            try:
+                while not self.idle and self.size >= self.max_size:
+                    if on_loop:
+                        self.timeouts += 1
+                        raise PoolTimeout("no connection available on the event loop, %d in use" % self.in_use)
+                    remaining = started + timeout - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout("no connection available after %.1fs, %d in use" % (timeout, self.in_use))
+                    self._lock.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.acquired += 1
+            self.wait_time += time.monotonic() - started
+            self.in_use += 1
+            conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                self.size += 1
+
+        if conn is not None and not self._usable(conn):
+            # its slot goes to the connection replacing it.
+            self._close(conn, keep_slot=True)
+            conn = None
+        if conn is None:
+            try:
+                conn = PooledConnection(self, self.connect())
+            except BaseException:
+                with self._lock:
+                    self.size -= 1
+                    self.in_use -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self.created += 1
+        conn.checked_out = True
+        if self.size < self.min_size:
+            self._fill()
+        return conn
+
+    def _usable(self, conn):
+        now = time.monotonic()
+        if self.max_lifetime and now - conn.created > self.max_lifetime:
+            return False
+        if self.health_check and now - conn.idle_since > self.check_after:
+            try:
+                conn.raw.cursor().execute(self.health_check)
+            except Exception:
+                return False
+        return True
+
+    def _fill(self):
+        while True:
+            with self._lock:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                conn = PooledConnection(self, self.connect())
+            except Exception:
+                with self._lock:
+                    self.size -= 1
+                return
+            with self._lock:
+                self.created += 1
+                self.idle.insert(0, conn)
+                self._lock.notify()
+
+    def release(self, conn):
+        """Returns `conn` to the pool. Called by `conn.close()`."""
+        conn.checked_out = False
+        conn.idle_since = time.monotonic()
+        expired = self.max_lifetime and conn.idle_since - conn.created > self.max_lifetime
+        with self._lock:
+            self.in_use -= 1
+            if not self.closed and not expired:
+                # most recently used last, so that they are reused first and the others can expire.
+                self.idle.append(conn)
+                self._lock.notify()
+                return
+        self._close(conn)
+
+    def _close(self, conn, keep_slot=False):
+        """Closes `conn` and forgets it, making room for another connection unless `keep_slot`."""
+        with self._lock:
+            self.discarded += 1
+            if not keep_slot:
+                self.size -= 1
+                self._lock.notify()
+        try:
+            conn.raw.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Closes the idle connections, and the others once they are released."""
+        with self._lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Returns the counters of the pool."""
+        with self._lock:
+            return storage(
+                size=self.size,
+                idle=len(self.idle),
+                in_use=self.in_use,
+                waiting=self.waiting,
+                acquired=self.acquired,
+                wait_time=self.wait_time,
+                timeouts=self.timeouts,
+                created=self.created,
+                discarded=self.discarded,
+            )
+
+
 class DB:
     """Database"""
 
@@ -543,17 +837,20 @@ class DB:
         # flag to enable/disable printing queries
         self.printing = config.get("debug_sql", config.get("debug", False))
         self.supports_multiple_insert = False
-
-        try:
-            import DBUtils
-
-            # enable pooling if DBUtils module is available.
-            self.has_pooling = True
-        except ImportError:
-            self.has_pooling = False
-
-        # Pooling can be disabled by passing pooling=False in the keywords.
-        self.has_pooling = self.keywords.pop("pooling", True) and self.has_pooling
+        # most parameters a statement may have, multiple_insert splits larger inserts.
+        self.max_params = 999
+        # whether multiple_insert should send the rows with one executemany.
+        self.bulk_executemany = False
+        # whether query results are read-only `Row`s rather than `storage`s,
+        # enabled by passing compact_rows=True in the keywords.
+        self.compact_rows = self.keywords.pop("compact_rows", False)
+
+        # Pooling can be disabled by passing pooling=False in the keywords,
+        # or configured by passing a dict of `ConnectionPool` arguments.
+        pooling = self.keywords.pop("pooling", True)
+        self.has_pooling = bool(pooling)
+        self.pool_options = pooling if isinstance(pooling, dict) else {}
+        self.pool = None
 
     def _getctx(self):
         if not self._ctx.get("db"):
@@ -570,6 +867,10 @@ class DB:
             ctx.db = self._connect_with_pooling(self.keywords)
         else:
             ctx.db = self._connect(self.keywords)
+            # every request task gets a context of its own, close its connection once the response is sent.
+            cleanups = web_ctx.get("cleanups")
+            if cleanups is not None:
+                cleanups.append(functools.partial(self._close_context, ctx.db))
         ctx.db_execute = self._db_execute
 
         if not hasattr(ctx.db, "commit"):
@@ -585,40 +886,48 @@ class DB:
                 self._unload_context(self._ctx)
 
         def rollback():
-            # do db rollback and release the connection if pooling is enabled.
-            ctx.db.rollback()
-            if self.has_pooling:
-                self._unload_context(self._ctx)
+            # do db rollback and release the connection if pooling is enabled, even a broken one.
+            try:
+                ctx.db.rollback()
+            finally:
+                if self.has_pooling:
+                    self._unload_context(self._ctx)
 
         ctx.commit = commit
         ctx.rollback = rollback
 
     def _unload_context(self, ctx):
+        if isinstance(ctx.db, PooledConnection):
+            ctx.db.close()
         del ctx.db
 
+    def _close_context(self, db):
+        if self._ctx.get("db") is db:
+            del self._ctx.db
+        db.close()
+
     def _connect(self, keywords):
         return self.db_module.connect(**keywords)
 
     def _connect_with_pooling(self, keywords):
-        def get_pooled_db():
-            from DBUtils import PooledDB
-
-            # In DBUtils 0.9.3, `dbapi` argument is renamed as `creator`
-            # see Bug#122112
-
-            if PooledDB.__version__.split(".") < "0.9.3".split("."):
-                return PooledDB.PooledDB(dbapi=self.db_module, **keywords)
-            else:
-                return PooledDB.PooledDB(creator=self.db_module, **keywords)
-
-        if getattr(self, "_pooleddb", None) is None:
-            self._pooleddb = get_pooled_db()
-
-        return self._pooleddb.connection()
+        if self.pool is None:
+            self.pool = ConnectionPool(lambda: self._connect(keywords), **self.pool_options)
+        return self.pool.acquire()
 
     def _db_cursor(self):
         return self.ctx.db.cursor()
 
+    def _stream_cursor(self):
+        """Returns a cursor reading the rows from the server as they are fetched, for `ResultStream`."""
+        return self._db_cursor()
+
+    def _row_factory(self, description):
+        """Returns the function making the result rows out of the tuples of values of `cursor.description`."""
+        names = tuple([x[0] for x in description])
+        if self.compact_rows:
+            return row_class(names)
+        return lambda values: storage(zip(names, values))
+
     def _param_marker(self):
         """Returns parameter marker based on paramstyle attribute if this database."""
         style = getattr(self, "paramstyle", "pyformat")
@@ -631,15 +940,22 @@ class DB:
             return "%s"
         raise UnknownParamstyle(style)
 
-    def _db_execute(self, cur, sql_query):
-        """executes an sql query"""
+    def _db_execute(self, cur, sql_query, rows=None):
+        """executes an sql query, once for each tuple of parameters of `rows` when given"""
         self.ctx.dbq_count += 1
 
         try:
             a = time.time()
             query, params = self._process_query(sql_query)
-            out = cur.execute(query, params)
+            with tracing.child_span("db.query", statement=query), timing.measure("db", "queries"):
+                if rows is None:
+                    out = cur.execute(query, params)
+                else:
+                    out = self._execute_rows(cur, query, rows)
             b = time.time()
+            if metrics.enabled:
+                metrics.DB_QUERIES.inc()
+                metrics.DB_QUERY_SECONDS.observe(b - a)
         except:
             if self.printing:
                 print("ERR:", str(sql_query), file=debug)
@@ -650,9 +966,14 @@ class DB:
             raise
 
         if self.printing:
+            if rows is not None:
+                sql_query = "%s (%d rows)" % (sql_query.query(), len(rows))
             print("%s (%s): %s" % (round(b - a, 2), self.ctx.dbq_count, str(sql_query)), file=debug)
         return out
 
+    def _execute_rows(self, cur, query, rows):
+        return cur.executemany(query, rows)
+
     def _process_query(self, sql_query):
         """Takes the SQLQuery object and returns query string and parameters.
         """
@@ -685,12 +1006,15 @@ class DB:
         else:
             return None
 
-    def query(self, sql_query, vars=None, processed=False, _test=False):
+    def query(self, sql_query, vars=None, processed=False, _test=False, stream=False, batch_size=1000):
         """
         Execute SQL query `sql_query` using dictionary `vars` to interpolate it.
         If `processed=True`, `vars` is a `reparam`-style list to use
         instead of interpolating.
 
+        With `stream=True`, the rows of the query are read as they are
+        iterated, `batch_size` at a time, see `ResultStream`.
+
             >>> db = DB(None, {})
             >>> db.query("SELECT * FROM foo", _test=True)
             <sql: 'SELECT * FROM foo'>
@@ -708,21 +1032,45 @@ class DB:
         if _test:
             return sql_query
 
+        if stream:
+            # outside of a transaction the rows are read in one of their own, so that the
+            # queries run meanwhile neither commit nor give back the connection they come from.
+            transaction = None if self.ctx.transactions else self.transaction()
+            try:
+                db_cursor = self._stream_cursor()
+                self._db_execute(db_cursor, sql_query)
+            except BaseException:
+                if transaction is not None:
+                    transaction.rollback()
+                raise
+            return ResultStream(self, db_cursor, batch_size, transaction)
+
         db_cursor = self._db_cursor()
         self._db_execute(db_cursor, sql_query)
 
         if db_cursor.description:
-            names = [x[0] for x in db_cursor.description]
+            make_row = self._row_factory(db_cursor.description)
+
+            if self.has_pooling and not self.ctx.transactions:
+                # the connection goes back to the pool below, where another
+                # thread may take it or it may be closed: read the rows first.
+                rows = db_cursor.fetchall()
+                remaining = iter(rows)
+                out = iterbetter(map(make_row, remaining))
+                out.__len__ = lambda: len(rows)
+                out.list = lambda: list(map(make_row, remaining))
+                self.ctx.commit()
+                return out
 
             def iterwrapper():
                 row = db_cursor.fetchone()
                 while row:
-                    yield storage(dict(zip(names, row)))
+                    yield make_row(row)
                     row = db_cursor.fetchone()
 
             out = iterbetter(iterwrapper())
             out.__len__ = lambda: int(db_cursor.rowcount)
-            out.list = lambda: [storage(dict(zip(names, x))) for x in db_cursor.fetchall()]
+            out.list = lambda: list(map(make_row, db_cursor.fetchall()))
         else:
             out = db_cursor.rowcount
 
@@ -731,12 +1079,24 @@ class DB:
         return out
 
     def select(
-        self, tables, vars=None, what="*", where=None, order=None, group=None, limit=None, offset=None, _test=False
+        self,
+        tables,
+        vars=None,
+        what="*",
+        where=None,
+        order=None,
+        group=None,
+        limit=None,
+        offset=None,
+        _test=False,
+        stream=False,
+        batch_size=1000,
     ):
         """
         Selects `what` from `tables` with clauses `where`, `order`,
         `group`, `limit`, and `offset`. Uses vars to interpolate.
-        Otherwise, each clause can be a SQLQuery.
+        Otherwise, each clause can be a SQLQuery. `stream` and
+        `batch_size` are passed to `query`.
 
             >>> db = DB(None, {})
             >>> db.select('foo', _test=True)
@@ -753,7 +1113,7 @@ class DB:
         qout = SQLQuery.join(clauses)
         if _test:
             return qout
-        return self.query(qout, processed=True)
+        return self.query(qout, processed=True, stream=stream, batch_size=batch_size)
 
     def where(self, table, what="*", order=None, group=None, limit=None, offset=None, _test=False, **kwargs):
         """
@@ -843,6 +1203,15 @@ class DB:
             return sql_query
 
         db_cursor = self._db_cursor()
+        out = self._execute_insert(db_cursor, sql_query, tablename, seqname)
+
+        if not self.ctx.transactions:
+            self.ctx.commit()
+
+        return out
+
+    def _execute_insert(self, db_cursor, sql_query, tablename, seqname):
+        """Runs the insert statement `sql_query`, returns the id of the last inserted row or None."""
         if seqname is not False:
             sql_query = self._process_insert_query(sql_query, tablename, seqname)
 
@@ -856,14 +1225,9 @@ class DB:
             self._db_execute(db_cursor, sql_query)
 
         try:
-            out = db_cursor.fetchone()[0]
+            return db_cursor.fetchone()[0]
         except Exception:
-            out = None
-
-        if not self.ctx.transactions:
-            self.ctx.commit()
-
-        return out
+            return None
 
     def _get_insert_default_values_query(self, table):
         return "INSERT INTO %s DEFAULT VALUES" % table
@@ -876,15 +1240,28 @@ class DB:
         Set `seqname` to the ID if it's not the default, or to `False`
         if there isn't one.
 
+        The rows are sent with a single `executemany` when the driver runs it
+        efficiently, otherwise in statements of at most `max_params` parameters.
+
             >>> db = DB(None, {})
             >>> db.supports_multiple_insert = True
             >>> values = [{"name": "foo", "email": "foo@example.com"}, {"name": "bar", "email": "bar@example.com"}]
             >>> db.multiple_insert('person', values=values, _test=True)
             <sql: "INSERT INTO person (email, name) VALUES ('foo@example.com', 'foo'), ('bar@example.com', 'bar')">
+            >>> db.max_params = 2
+            >>> [q.values() for q in db.multiple_insert('person', values=values, _test=True)]
+            [['foo@example.com', 'foo'], ['bar@example.com', 'bar']]
         """
         if not values:
             return []
 
+        keys = _insert_keys(values)
+        if not _test and keys and (self.bulk_executemany or seqname is False and not self.supports_multiple_insert):
+            rows = _insert_rows(keys, values)
+            # the ids are worked out from the last one, which only works when the database picks them.
+            if rows is not None and (seqname is False or not self._sets_ids(tablename, keys)):
+                return self._executemany_insert(tablename, keys, rows, seqname)
+
         if not self.supports_multiple_insert:
             out = [self.insert(tablename, seqname=seqname, _test=_test, **v) for v in values]
             if seqname is False:
@@ -892,43 +1269,57 @@ class DB:
             else:
                 return out
 
-        keys = values[0].keys()
-        # @@ make sure all keys are valid
+        if keys is None:
+            raise ValueError("Not all rows have the same keys")
+
+        size = max(1, self.max_params // max(1, len(keys)))
+        chunks = [values[i : i + size] for i in range(0, len(values), size)]
+
+        if _test:
+            queries = [self._multiple_insert_query(tablename, keys, chunk) for chunk in chunks]
+            return queries[0] if len(queries) == 1 else queries
 
-        for v in values:
-            if v.keys() != keys:
-                raise ValueError("Not all rows have the same keys")
+        db_cursor = self._db_cursor()
+        ids = []
+        for chunk in chunks:
+            sql_query = self._multiple_insert_query(tablename, keys, chunk)
+            out = self._execute_insert(db_cursor, sql_query, tablename, seqname)
+            ids.append(None if out is None else self._multiple_insert_ids(out, len(chunk)))
 
-        keys = sorted(keys)  # enforce query order for the above doctest compatibility with Py3
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return _join_ids(ids)
 
+    def _multiple_insert_query(self, tablename, keys, values):
         sql_query = SQLQuery("INSERT INTO %s (%s) VALUES " % (tablename, ", ".join(keys)))
 
         for i, row in enumerate(values):
             if i != 0:
                 sql_query.append(", ")
             SQLQuery.join([SQLParam(row[k]) for k in keys], sep=", ", target=sql_query, prefix="(", suffix=")")
+        return sql_query
 
-        if _test:
-            return sql_query
+    def _multiple_insert_ids(self, last_id, count):
+        """Returns the ids of the `count` rows inserted by one statement, given the id the database returned."""
+        return range(last_id - count + 1, last_id + 1)
 
-        db_cursor = self._db_cursor()
-        if seqname is not False:
-            sql_query = self._process_insert_query(sql_query, tablename, seqname)
+    def _sets_ids(self, tablename, keys):
+        """Returns whether inserting the columns `keys` into `tablename` gives the rows their ids."""
+        return False
 
-        if isinstance(sql_query, tuple):
-            # for some databases, a separate query has to be made to find
-            # the id of the inserted row.
-            q1, q2 = sql_query
-            self._db_execute(db_cursor, q1)
-            self._db_execute(db_cursor, q2)
-        else:
-            self._db_execute(db_cursor, sql_query)
+    def _executemany_insert(self, tablename, keys, rows, seqname):
+        """Inserts the tuples of values `rows` with one `executemany`."""
+        sql_query = self._multiple_insert_query(tablename, keys, [dict(zip(keys, rows[0]))])
+        db_cursor = self._db_cursor()
+        self._db_execute(db_cursor, sql_query, rows)
 
-        try:
-            out = db_cursor.fetchone()[0]
-            out = range(out - len(values) + 1, out + 1)
-        except Exception:
-            out = None
+        out = None
+        if seqname is not False:
+            # only databases querying the last id separately can tell it after an executemany
+            processed = self._process_insert_query(sql_query, tablename, seqname)
+            if isinstance(processed, tuple):
+                self._db_execute(db_cursor, processed[1])
+                out = self._multiple_insert_ids(db_cursor.fetchone()[0], len(rows))
 
         if not self.ctx.transactions:
             self.ctx.commit()
@@ -1026,20 +1417,75 @@ class PostgresDB(DB):
         self.paramstyle = db_module.paramstyle
         super().__init__(db_module, keywords)
         self.supports_multiple_insert = True
+        self.max_params = 65535
+        # multiple_insert uses COPY from this many rows with psycopg2 or psycopg, when the
+        # ids aren't needed: concurrent inserts may take ids in between the copied rows.
+        self.copy_threshold = 1000
         self._sequences = None
 
-    def _process_insert_query(self, query, tablename, seqname):
+    def _sequence(self, tablename, seqname):
         if seqname is None:
             # when seqname is not provided guess the seqname and make sure it exists
             seqname = tablename + "_id_seq"
             if seqname not in self._get_all_sequences():
                 seqname = None
+        return seqname
 
+    def _process_insert_query(self, query, tablename, seqname):
+        seqname = self._sequence(tablename, seqname)
         if seqname:
             query += "; SELECT currval('%s')" % seqname
 
         return query
 
+    def multiple_insert(self, tablename, values, seqname=None, _test=False):
+        if not _test and seqname is False and len(values) >= self.copy_threshold:
+            keys = _insert_keys(values)
+            rows = keys and self._copy_rows(keys, values)
+            if rows:
+                return self._copy_insert(tablename, keys, rows)
+        return super().multiple_insert(tablename, values, seqname=seqname, _test=_test)
+
+    def _copy_rows(self, keys, values):
+        """Returns `values` as tuples for COPY, or None when the driver can't copy them."""
+        driver = self.db_module.__name__
+        if driver == "psycopg":
+            # adapts every type like execute does
+            return _insert_rows(keys, values)
+        if driver == "psycopg2":
+            rows = [tuple([row[k] for k in keys]) for row in values]
+            for row in rows:
+                for v in row:
+                    if type(v) not in _copy_types:
+                        return None
+            return rows
+        return None
+
+    def _copy_insert(self, tablename, keys, rows):
+        sql_query = SQLQuery("COPY %s (%s) FROM STDIN" % (tablename, ", ".join(keys)))
+        db_cursor = self._db_cursor()
+        self._db_execute(db_cursor, sql_query, rows)
+
+        if not self.ctx.transactions:
+            self.ctx.commit()
+        return None
+
+    def _execute_rows(self, cur, query, rows):
+        if not query.startswith("COPY "):
+            return super()._execute_rows(cur, query, rows)
+        if self.db_module.__name__ == "psycopg":
+            with cur.copy(query) as copy:
+                for row in rows:
+                    copy.write_row(row)
+        else:
+            cur.copy_expert(query, _CopyReader(rows))
+
+    def _stream_cursor(self):
+        if self.db_module.__name__ in ["psycopg2", "psycopg"]:
+            # named cursors are server-side cursors
+            return self.ctx.db.cursor(name="web_stream_%d" % next(_stream_ids))
+        return super()._stream_cursor()
+
     def _get_all_sequences(self):
         """Query postgres to find names of all sequences used in this database."""
         if self._sequences is None:
@@ -1056,10 +1502,55 @@ class PostgresDB(DB):
             conn.cursor().execute("set client_encoding to 'UTF-8'")
         return conn
 
-    def _connect_with_pooling(self, keywords):
-        conn = super()._connect_with_pooling(keywords)
-        conn._con._con.set_client_encoding("UTF8")
-        return conn
+
+_copy_types = {
+    type(None),
+    bool,
+    int,
+    float,
+    str,
+    decimal.Decimal,
+    datetime.date,
+    datetime.datetime,
+    datetime.time,
+    uuid.UUID,
+    bytes,
+}
+_copy_escapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    elif value is True:
+        return "t"
+    elif value is False:
+        return "f"
+    elif isinstance(value, bytes):
+        return "\\\\x" + value.hex()
+    return str(value).translate(_copy_escapes)
+
+
+class _CopyReader:
+    """File-like object reading tuples of values in the text format of COPY, for psycopg2's copy_expert."""
+
+    def __init__(self, rows):
+        self.lines = ("\t".join([_copy_value(v) for v in row]) + "\n" for row in rows)
+        self.rest = ""
+
+    def read(self, size=-1):
+        chunks = [self.rest]
+        length = len(self.rest)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = "".join(chunks)
+        if size < 0:
+            size = len(data)
+        self.rest = data[size:]
+        return data[:size]
 
 
 class MySQLDB(DB):
@@ -1088,10 +1579,21 @@ class MySQLDB(DB):
         self.dbname = "mysql"
         super().__init__(db, keywords)
         self.supports_multiple_insert = True
+        self.max_params = 65535
 
     def _process_insert_query(self, query, tablename, seqname):
         return query, SQLQuery("SELECT last_insert_id();")
 
+    def _multiple_insert_ids(self, last_id, count):
+        # last_insert_id() is the id of the first row of a multiple-row insert
+        return range(last_id, last_id + count)
+
+    def _stream_cursor(self):
+        driver = self.db_module.__name__
+        if driver == "mysql.connector":
+            return self.ctx.db.cursor(buffered=False)
+        return self.ctx.db.cursor(importlib.import_module(driver + ".cursors").SSCursor)
+
     def _get_insert_default_values_query(self, table):
         return "INSERT INTO %s () VALUES()" % table
 
@@ -1104,7 +1606,7 @@ def import_driver(drivers, preferred=None):
 
     for d in drivers:
         try:
-            return importlib.import_module(d, None, None, ["x"])
+            return importlib.import_module(d)
         except ImportError:
             pass
     raise ImportError("Unable to import " + " or ".join(drivers))
@@ -1116,6 +1618,8 @@ class SqliteDB(DB):
 
         if db.__name__ in ["sqlite3", "pysqlite2.dbapi2"]:
             db.paramstyle = "qmark"
+            # the driver prepares each distinct SQL text once per connection, keep more of them.
+            keywords.setdefault("cached_statements", 256)
 
         # sqlite driver doesn't create datatime objects for timestamp columns unless `detect_types` option is passed.
         # It seems to be supported in sqlite3 and pysqlite2 drivers, not surte about sqlite.
@@ -1126,10 +1630,30 @@ class SqliteDB(DB):
         keywords["pooling"] = False  # sqlite don't allows connections to be shared by threads
         self.dbname = "sqlite"
         super().__init__(db, keywords)
+        # executemany runs the prepared insert for each row without leaving the driver.
+        self.bulk_executemany = True
+        # table -> the names of its rowid, for `_sets_ids`
+        self._rowid_names = {}
+        if getattr(db, "sqlite_version_info", (0,)) >= (3, 32, 0):
+            self.max_params = 32766
 
     def _process_insert_query(self, query, tablename, seqname):
         return query, SQLQuery("SELECT last_insert_rowid();")
 
+    def _sets_ids(self, tablename, keys):
+        names = self._rowid_names.get(tablename)
+        if names is None:
+            names = {"rowid", "oid", "_rowid_"}
+            db_cursor = self._db_cursor()
+            db_cursor.execute("PRAGMA table_info(%s)" % tablename)
+            # (cid, name, type, notnull, dflt_value, pk)
+            pk = [c for c in db_cursor.fetchall() if c[5]]
+            if len(pk) == 1 and pk[0][2].upper() == "INTEGER":
+                # an INTEGER PRIMARY KEY is the rowid.
+                names.add(pk[0][1].lower())
+            names = self._rowid_names[tablename] = frozenset(names)
+        return any(k.lower() in names for k in keys)
+
     def query(self, *a, **kw):
         out = super().query(*a, **kw)
         if isinstance(out, iterbetter):
@@ -1233,7 +1757,7 @@ class OracleDB(DB):
         self.paramstyle = db.paramstyle
 
         # oracle doesn't support pooling
-        keywords.pop("pooling", None)
+        keywords["pooling"] = False
         super().__init__(db, keywords)
 
     def _process_insert_query(self, query, tablename, seqname):
@@ -1244,6 +1768,453 @@ class OracleDB(DB):
             return query + "; SELECT %s.currval FROM dual" % seqname
 
 
+class Row(Mapping):
+    """
+    Row of a query result. Reads like a `storage` of the columns, with
+    `row.name` or `row["name"]`, but holds only the tuple of values read by
+    the driver: the names are kept once, in the class shared by the rows of
+    the same columns, see `row_class`. Rows are read-only, `row.copy()`
+    returns a `storage` which can be modified.
+
+        >>> row = row_class(("id", "name"))((1, "bob"))
+        >>> row.name, row["id"], row.get("email"), "name" in row
+        ('bob', 1, None, True)
+        >>> row
+        <Row {'id': 1, 'name': 'bob'}>
+        >>> row == {"id": 1, "name": "bob"}
+        True
+    """
+
+    __slots__ = ("_values",)
+
+    # column name -> position of its value, set in the subclasses
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __getattr__(self, key):
+        # columns which aren't identifiers, the others are properties
+        try:
+            return self._values[self._index[key]]
+        except KeyError as k:
+            raise AttributeError(k)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        values = self._values
+        return [values[i] for i in self._index.values()]
+
+    def items(self):
+        values = self._values
+        return [(k, values[i]) for k, i in self._index.items()]
+
+    def copy(self):
+        return storage(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Row) and self._index == other._index:
+            return self.values() == other.values()
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Row %r>" % dict(self.items())
+
+    def __reduce__(self):
+        return _row, (tuple(self._index), tuple(self.values()))
+
+
+def _row_class(names):
+    index = {}
+    for i, name in enumerate(names):
+        # like dict(zip(names, values)): the first position of the name, the last value
+        index[name] = i
+    namespace = {"__slots__": (), "_index": index}
+    for name, i in index.items():
+        # the methods take precedence, like with storage
+        if name.isidentifier() and not hasattr(Row, name):
+            namespace[name] = property(_value_getter(i))
+    return type("Row", (Row,), namespace)
+
+
+def _value_getter(i):
+    def get(row):
+        return row._values[i]
+
+    return get
+
+
+row_class = memoize(_row_class, maxsize=1024)
+row_class.__doc__ = """
+Returns the subclass of `Row` for the column names `names`, a tuple,
+shared by all the queries returning these columns.
+"""
+
+
+def _row(names, values):
+    # unpickles rows
+    return row_class(names)(values)
+
+
+_stream_ids = itertools.count()
+
+
+class ResultStream:
+    """
+    Rows of a query run with `stream=True`, read from the database
+    `batch_size` at a time as they are iterated, so that the memory used
+    doesn't grow with the number of rows. PostgreSQL (psycopg2 and psycopg)
+    and MySQL use server-side cursors, SQLite reads its rows lazily anyway.
+
+        with db.select("events", stream=True) as rows:
+            for row in rows:
+                ...
+
+    Outside of a transaction, the stream runs in a `transaction` of its
+    own, which keeps its connection until all the rows are read, it is
+    closed or a loop over it is left, and is only committed then. The
+    queries run meanwhile in the same thread or task take part in it, and
+    transactions become nested ones. Close it from the thread or task which
+    ran the query.
+    """
+
+    def __init__(self, db, cursor, batch_size=1000, transaction=None):
+        self.db = db
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.transaction = transaction
+        self.make_row = None
+        self.closed = False
+
+    def fetch(self):
+        """Returns the next batch of rows, or an empty list once all of them are read."""
+        if self.closed:
+            return []
+        try:
+            rows = self.cursor.fetchmany(self.batch_size)
+        except BaseException:
+            self.close(commit=False)
+            raise
+        if not rows:
+            self.close()
+            return []
+        if self.make_row is None:
+            # the description is only known after the first fetch with some server-side cursors
+            self.make_row = self.db._row_factory(self.cursor.description)
+        return list(map(self.make_row, rows))
+
+    def __iter__(self):
+        # leaving the loop early must not keep the connection
+        try:
+            while True:
+                rows = self.fetch()
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            self.close()
+
+    def list(self):
+        """Returns the rows left to read."""
+        return list(self)
+
+    def close(self, commit=True):
+        """Stops reading the rows, and ends the query."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.cursor.close()
+        finally:
+            # otherwise the transaction around the query ends it
+            if self.transaction is not None:
+                if commit:
+                    self.transaction.commit()
+                else:
+                    self.transaction.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        self.close(commit=exctype is None)
+
+
+class ResultSet(list):
+    """Rows returned by `AsyncDB`: a list which can also be iterated with `async for`."""
+
+    async def __aiter__(self):
+        for row in list.__iter__(self):
+            yield row
+
+    def first(self, default=None):
+        """Returns the first row, or `default` when there are none."""
+        return self[0] if self else default
+
+    def list(self):
+        return list(self)
+
+
+class AsyncDB:
+    """
+    Asynchronous interface to the database `db`, for coroutines.
+
+        db = web.asyncdatabase(dbn="postgres", db="app", user="joe", pw="secret")
+
+        rows = await db.select("person", where="name = $name", vars={"name": name})
+        async for row in rows:
+            ...
+        async with db.transaction():
+            await db.insert("person", name="bob")
+
+    Queries are built exactly like with `DB`, and run with its driver in a
+    pool of `max_workers` threads dedicated to the database, so that they
+    never block the event loop. Each thread keeps its own connection, and
+    all the queries of a transaction run in the same thread.
+    """
+
+    def __init__(self, db, max_workers=4):
+        self.db = db
+        self.max_workers = max_workers
+        self.executors = []
+        self._idle = None
+        # the executor a transaction of the current task is bound to
+        self._bound = contextvars.ContextVar("web.db.AsyncDB.bound", default=None)
+
+    async def _acquire(self):
+        """Returns an executor, and whether it must be released once done with."""
+        bound = self._bound.get()
+        if bound is not None:
+            return bound, False
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for i in range(self.max_workers):
+                executor = ThreadPoolExecutor(1, thread_name_prefix="web.AsyncDB")
+                self.executors.append(executor)
+                self._idle.put_nowait(executor)
+        return await self._idle.get(), True
+
+    def _release(self, executor):
+        self._idle.put_nowait(executor)
+
+    async def _run(self, f, *a, **kw):
+        executor, release = await self._acquire()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(executor, functools.partial(f, *a, **kw))
+        finally:
+            if release:
+                self._release(executor)
+
+    async def _call(self, f, *a, **kw):
+        with tracing.child_span("db." + f.__name__), timing.measure("db", "queries"):
+            return await self._run(_fetch, f, *a, **kw)
+
+    async def _stream(self, f, *a, **kw):
+        executor, release = await self._acquire()
+        try:
+            with tracing.child_span("db." + f.__name__, stream=True), timing.measure("db", "queries"):
+                stream = await asyncio.get_event_loop().run_in_executor(executor, functools.partial(f, *a, **kw))
+        except BaseException:
+            if release:
+                self._release(executor)
+            raise
+        return AsyncResultStream(stream, executor, self._release if release else None)
+
+    async def query(self, *a, **kw):
+        """
+        Like `DB.query`, returning a `ResultSet` for the queries returning
+        rows, or an `AsyncResultStream` with `stream=True`.
+        """
+        if kw.get("stream"):
+            return await self._stream(self.db.query, *a, **kw)
+        return await self._call(self.db.query, *a, **kw)
+
+    async def select(self, *a, **kw):
+        """Like `DB.select`, returning a `ResultSet`, or an `AsyncResultStream` with `stream=True`."""
+        if kw.get("stream"):
+            return await self._stream(self.db.select, *a, **kw)
+        return await self._call(self.db.select, *a, **kw)
+
+    async def where(self, *a, **kw):
+        """Like `DB.where`, returning a `ResultSet`."""
+        return await self._call(self.db.where, *a, **kw)
+
+    async def insert(self, *a, **kw):
+        """Like `DB.insert`."""
+        return await self._call(self.db.insert, *a, **kw)
+
+    async def multiple_insert(self, *a, **kw):
+        """Like `DB.multiple_insert`."""
+        return await self._call(self.db.multiple_insert, *a, **kw)
+
+    async def update(self, *a, **kw):
+        """Like `DB.update`."""
+        return await self._call(self.db.update, *a, **kw)
+
+    async def delete(self, *a, **kw):
+        """Like `DB.delete`."""
+        return await self._call(self.db.delete, *a, **kw)
+
+    def transaction(self):
+        """
+        Returns a transaction, used with `async with`. It is committed at
+        the end of the block, or rolled back if the block raises. Nested
+        transactions use savepoints, like with `DB`.
+        """
+        return AsyncTransaction(self)
+
+    async def close(self):
+        """Closes the connections and stops the threads."""
+        for executor in self.executors:
+            await asyncio.get_event_loop().run_in_executor(executor, self._close_connection)
+            executor.shutdown(wait=False)
+        self.executors = []
+        self._idle = None
+
+    def _close_connection(self):
+        ctx = self.db._ctx
+        if ctx.get("db"):
+            ctx.db.close()
+            del ctx.db
+
+
+def _fetch(f, *a, **kw):
+    # reads the rows in the worker thread, while the cursor is at hand.
+    out = f(*a, **kw)
+    if isinstance(out, iterbetter):
+        return ResultSet(out)
+    return out
+
+
+class AsyncTransaction:
+    """Transaction of an `AsyncDB`, see `AsyncDB.transaction`."""
+
+    def __init__(self, adb):
+        self.adb = adb
+        self.executor = None
+        self.transaction = None
+
+    async def __aenter__(self):
+        adb = self.adb
+        self.executor, self.release = await adb._acquire()
+        self.token = adb._bound.set(self.executor)
+        try:
+            self.transaction = await adb._run(adb.db.transaction)
+        except BaseException:
+            self._unbind()
+            raise
+        return self
+
+    async def __aexit__(self, exctype, excvalue, traceback):
+        if exctype is not None:
+            await self.rollback()
+        else:
+            await self.commit()
+
+    async def commit(self):
+        if self.executor is None:
+            return
+        try:
+            await self.adb._run(self.transaction.commit)
+        finally:
+            self._unbind()
+
+    async def rollback(self):
+        if self.executor is None:
+            return
+        try:
+            await self.adb._run(self.transaction.rollback)
+        finally:
+            self._unbind()
+
+    def _unbind(self):
+        if self.executor is not None:
+            self.adb._bound.reset(self.token)
+            if self.release:
+                self.adb._release(self.executor)
+            self.executor = None
+
+
+class AsyncResultStream:
+    """
+    Rows of a query of an `AsyncDB` run with `stream=True`, read in the
+    thread of its connection as they are iterated with `async for`. The
+    thread is kept by the stream until all the rows are read or it is
+    closed, see `ResultStream`.
+
+        async with await db.select("events", stream=True) as rows:
+            async for row in rows:
+                ...
+    """
+
+    def __init__(self, stream, executor, release=None):
+        self.stream = stream
+        self.executor = executor
+        self.release = release
+
+    async def fetch(self):
+        """Returns the next batch of rows, or an empty list once all of them are read."""
+        if self.executor is None:
+            return []
+        rows = await asyncio.get_event_loop().run_in_executor(self.executor, self.stream.fetch)
+        if not rows:
+            await self.close()
+        return rows
+
+    async def __aiter__(self):
+        # an abandoned loop is closed by the event loop once the generator is collected
+        try:
+            while True:
+                rows = await self.fetch()
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            await self.close()
+
+    async def list(self):
+        """Returns the rows left to read."""
+        return [row async for row in self]
+
+    async def close(self, commit=True):
+        """Stops reading the rows, ends the query and gives the thread back."""
+        executor, self.executor = self.executor, None
+        if executor is None:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(executor, self.stream.close, commit)
+        finally:
+            if self.release is not None:
+                self.release(executor)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exctype, excvalue, traceback):
+        await self.close(commit=exctype is None)
+
+
 def dburl2dict(url):
     """
     Takes a URL to a database and parses it into an equivalent dictionary.
@@ -1277,8 +2248,10 @@ _databases = {}
 def database(dburl=None, **params):
     """Creates appropriate database using params.
 
-    Pooling will be enabled if DBUtils module is available.
-    Pooling can be disabled by passing pooling=False in params.
+    Connections are pooled, see `ConnectionPool`. Pooling can be disabled
+    by passing pooling=False in params, or configured by passing a dict of
+    `ConnectionPool` arguments. With compact_rows=True, the rows of the
+    results are read-only `Row`s rather than `storage`s.
     """
     if not dburl and not params:
         dburl = os.environ["DATABASE_URL"]
@@ -1291,6 +2264,11 @@ def database(dburl=None, **params):
         raise UnknownDB(dbn)
 
 
+def asyncdatabase(dburl=None, max_workers=4, **params):
+    """Creates an `AsyncDB` for the database `database(dburl, **params)` would create."""
+    return AsyncDB(database(dburl, **params), max_workers=max_workers)
+
+
 def register_database(name, clazz):
     """
     Register a database.
@@ -1495,13 +2473,42 @@ class Parser:
         return expr
 
 
+class _Template:
+    """The parse tree of a `reparam` string, and the SQL text of its queries per paramstyle."""
+
+    __slots__ = ["nodes", "texts"]
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.texts = {}
+
+
+def _parse(text):
+    return _Template(tuple(Parser().parse(text)))
+
+
+# queries are mostly built from a small set of literal strings, parse each once.
+_parse_cached = memoize(_parse, maxsize=1024)
+
+
 class SafeEval(object):
     """Safe evaluator for binding params to db queries.
+
+    The parse trees of the last 1024 distinct strings are cached, see
+    `_parse_cached.stats()`, with the text of their queries.
     """
 
     def safeeval(self, text, mapping):
-        nodes = Parser().parse(text)
-        return SQLQuery.join([self.eval_node(node, mapping) for node in nodes], "")
+        template = _parse_cached(text)
+        parts = [self.eval_node(node, mapping) for node in template.nodes]
+        query = SQLQuery.join(parts, "")
+        # the text only depends on the string when each value is a single parameter.
+        if len(query.items) == len(parts):
+            for part in parts:
+                if type(part) is SQLQuery and type(part.items[0]) is not SQLParam:
+                    return query
+            query.template = template
+        return query
 
     def eval_node(self, node, mapping):
         if node.type == "text":
@@ -3,14 +3,28 @@ HTTP Utilities
 (from asyncio-web.py)
 """
 
-__all__ = ["expires", "lastmodified", "prefixurl", "modified", "changequery", "url", "profiler"]
+__all__ = [
+    "expires",
+    "lastmodified",
+    "prefixurl",
+    "modified",
+    "autoetag",
+    "byteranges",
+    "changequery",
+    "url",
+    "profiler",
+]
 
 import datetime
+import hashlib
+import itertools
+import uuid
 from urllib.parse import urlencode as urllib_urlencode
 
 from . import net, types, utils
 from . import webapi as web
-from .py3helpers import iteritems
+from .asgi import request_header
+from .py3helpers import is_iter, iteritems
 
 
 def prefixurl(base=""):
@@ -61,8 +75,11 @@ def modified(date=None, etag=None):
     `Last-Modified` and `ETag` output headers.
     """
 
-    n = set([x.strip('" ') for x in web.ctx.env.get("HTTP_IF_NONE_MATCH", "").split(",")])
-    m = net.parsehttpdate(web.ctx.env.get("HTTP_IF_MODIFIED_SINCE", "").split(";")[0])
+    n = set()
+    for x in request_header(web.ctx.scope, "If-None-Match", "").split(","):
+        x = x.strip()
+        n.add((x[2:] if x.startswith("W/") else x).strip('"'))
+    m = net.parsehttpdate(request_header(web.ctx.scope, "If-Modified-Since", "").split(";")[0])
     validate = False
     if etag:
         if "*" in n or etag in n:
@@ -83,6 +100,210 @@ def modified(date=None, etag=None):
         return True
 
 
+async def autoetag(handler):
+    """
+    Processor adding a strong `ETag` computed from the response body to
+    successful `GET` and `HEAD` responses, and answering a matching
+    `If-None-Match` with `304 Not Modified` before anything is sent.
+
+        app.add_processor(web.autoetag)
+
+    Streamed bodies are buffered while they are hashed, up to
+    `config.etag_max_buffer` bytes (1MB by default); larger ones are sent
+    without an `ETag`. A handler which already knows the version of its
+    response can call `modified(etag=version)` before building it, which
+    skips both the body and the hashing when the client is up to date.
+    """
+    result = await handler()
+    if web.ctx.method not in ("GET", "HEAD") or "ETag" in web.ctx.headers:
+        return result
+    if str(web.ctx.status).split(" ", 1)[0] != "200":
+        return result
+
+    if hasattr(result, "__body__"):
+        result = result.__body__()
+
+    digest = hashlib.blake2b(digest_size=16)
+    if is_iter(result):
+        chunks, size, limit = [], 0, web.config.get("etag_max_buffer", 1024 * 1024)
+        for chunk in result:
+            chunk = utils.safebytes(chunk)
+            chunks.append(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+            if size > limit:
+                return itertools.chain(chunks, result)
+        result = iter(chunks)
+    else:
+        digest.update(utils.safebytes(result))
+
+    modified(etag=digest.hexdigest())
+    return result
+
+
+def parse_range(value, size, max_ranges=16):
+    """
+    Parses the `Range` header `value` for a body of `size` bytes into a list
+    of `(start, stop)` offsets, `stop` excluded.
+
+    Returns None when the header is missing, malformed, not in bytes, asks
+    for more than `max_ranges` ranges or for more bytes than the body has;
+    the whole body should be sent then. Returns an empty list when no range
+    overlaps the body. Overlapping and adjacent ranges are merged.
+
+        >>> parse_range("bytes=0-9, -5", 100)
+        [(0, 10), (95, 100)]
+        >>> parse_range("bytes=90-", 100)
+        [(90, 100)]
+        >>> parse_range("bytes=0-999", 100)
+        [(0, 100)]
+        >>> parse_range("bytes=20-29, 0-9, 5-14", 100)
+        [(0, 15), (20, 30)]
+        >>> parse_range("bytes=0-, 0-", 100) is None
+        True
+        >>> parse_range("items=0-9", 100) is None
+        True
+        >>> parse_range("bytes=100-", 100)
+        []
+    """
+    unit, _, spec = (value or "").partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    specs = spec.split(",")
+    if len(specs) > max_ranges:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start, stop = int(first), size
+                if last:
+                    stop = int(last) + 1
+                    if stop <= start:
+                        return None
+            else:
+                start, stop = max(size - int(last), 0), size
+        except ValueError:
+            return None
+        if start < size and stop > start:
+            ranges.append((start, min(stop, size)))
+
+    if sum(stop - start for start, stop in ranges) > size:
+        return None
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def if_range(value, etag=None, date=None):
+    """
+    Checks the `If-Range` header `value` against the representation's strong
+    `etag` (without quotes) and last modification `date`. Returns True when
+    the ranges may be sent, False when the whole body must be sent instead.
+    """
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"'):
+        return etag is not None and value.strip('"') == etag
+    if value.startswith("W/"):
+        return False
+    d = net.parsehttpdate(value)
+    return date is not None and d is not None and date.replace(microsecond=0) == d
+
+
+def byteranges_body(ranges, size, content_type, read):
+    """
+    Builds a `multipart/byteranges` body for `ranges` of a representation of
+    `size` bytes. `read(start, stop)` returns the bytes of one range, or an
+    iterable of chunks of them, which the iterator yields as they come.
+
+    Returns the `Content-Type` header, the length of the body and an
+    iterator over it.
+    """
+    boundary = uuid.uuid4().hex
+    heads = [
+        utils.safebytes(
+            "--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+            % (boundary, content_type, start, stop - 1, size)
+        )
+        for start, stop in ranges
+    ]
+    tail = utils.safebytes("\r\n--%s--\r\n" % boundary)
+    length = (
+        sum(len(h) for h in heads) + sum(stop - start for start, stop in ranges) + 2 * (len(ranges) - 1) + len(tail)
+    )
+
+    def body():
+        for i, (head, (start, stop)) in enumerate(zip(heads, ranges)):
+            yield (b"\r\n" + head) if i else head
+            data = read(start, stop)
+            if isinstance(data, bytes):
+                yield data
+            else:
+                yield from data
+        yield tail
+
+    return "multipart/byteranges; boundary=" + boundary, length, body()
+
+
+async def byteranges(handler):
+    """
+    Processor answering `Range` requests for bodies which are built in
+    memory, with `206 Partial Content` for one range and a
+    `multipart/byteranges` body for several. `If-Range` is checked against
+    the `ETag` and `Last-Modified` headers of the response.
+
+        app.add_processor(web.byteranges)
+
+    Streamed bodies, whose length isn't known beforehand, are sent whole.
+    """
+    result = await handler()
+    if web.ctx.method != "GET" or str(web.ctx.status).split(" ", 1)[0] != "200":
+        return result
+    if hasattr(result, "__body__"):
+        result = result.__body__()
+    if not isinstance(result, (str, bytes)):
+        return result
+
+    body = utils.safebytes(result)
+    size = len(body)
+    web.header("Accept-Ranges", "bytes")
+    scope = web.ctx.scope
+    headers = web.ctx.headers
+    etag = headers.get("ETag")
+    date = net.parsehttpdate(headers.get("Last-Modified", ""))
+    if etag is not None and not etag.startswith("W/"):
+        etag = etag.strip('"')
+    if not if_range(request_header(scope, "If-Range"), etag, date):
+        return body
+    ranges = parse_range(request_header(scope, "Range"), size)
+    if ranges is None:
+        return body
+    if not ranges:
+        raise web.rangenotsatisfiable(size)
+
+    web.ctx.status = "206 Partial Content"
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        web.header("Content-Range", "bytes %d-%d/%d" % (start, stop - 1, size))
+        return body[start:stop]
+
+    content_type = headers.get("Content-Type", "application/octet-stream")
+    content_type, length, parts = byteranges_body(ranges, size, content_type, lambda start, stop: body[start:stop])
+    web.header("Content-Type", content_type)
+    web.header("Content-Length", str(length))
+    return parts
+
+
 def urlencode(query, doseq=0):
     """
     Same as urllib.urlencode, but supports unicode strings.
@@ -142,7 +363,7 @@ def url(path=None, doseq=False, **kw):
 
 def profiler(app):
     """Outputs basic profiling information at the bottom of each response."""
-    from utils import profile
+    from .utils import profile
 
     def profile_internal(e, o):
         out, result = profile(app)(e, o)
@@ -181,6 +181,7 @@ class StaticApp(SimpleHTTPRequestHandler):
         self.headers = []
         self.environ = environ
         self.start_response = start_response
+        self.directory = os.getcwd()
 
     def send_response(self, status, msg=""):
         # the int(status) call is needed because in Py3 status is an enum.IntEnum and we need the integer behind
@@ -212,11 +213,17 @@ class StaticApp(SimpleHTTPRequestHandler):
             if etag == client_etag:
                 self.send_response(304, "Not Modified")
                 self.start_response(self.status, self.headers)
-                raise StopIteration()
+                return
         except OSError:
-            pass  # Probably a 404
+            etag = None  # Probably a 404
 
         f = self.send_head()
+        if f and self.command == "GET":
+            self.send_header("Accept-Ranges", "bytes")
+            ranges = self.ranges(f, etag)
+            if ranges is not None:
+                yield from ranges
+                return
         self.start_response(self.status, self.headers)
 
         if f:
@@ -231,6 +238,54 @@ class StaticApp(SimpleHTTPRequestHandler):
             value = self.wfile.getvalue()
             yield value
 
+    def ranges(self, f, etag):
+        """Returns an iterator over the parts of `f` asked for by the `Range` header, or None."""
+        from . import http
+
+        size = os.fstat(f.fileno()).st_size
+        headers = dict(self.headers)
+        date = net.parsehttpdate(headers.get("Last-Modified", ""))
+        if not http.if_range(self.environ.get("HTTP_IF_RANGE"), etag and etag.strip('"'), date):
+            return None
+        ranges = http.parse_range(self.environ.get("HTTP_RANGE"), size)
+        if ranges is None:
+            return None
+        if not ranges:
+            f.close()
+            self.start_response("416 Range Not Satisfiable", [("Content-Range", "bytes */%d" % size)])
+            return iter([b""])
+
+        def read(start, stop, block_size=16 * 1024):
+            while start < stop:
+                buf = os.pread(f.fileno(), min(block_size, stop - start), start)
+                if not buf:
+                    break
+                start += len(buf)
+                yield buf
+
+        self.headers = [(k, v) for k, v in self.headers if k not in ("Content-Length", "Content-type")]
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            self.send_header("Content-type", headers.get("Content-type", "application/octet-stream"))
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, stop - 1, size))
+            self.send_header("Content-Length", str(stop - start))
+            body = read(start, stop)
+        else:
+            content_type, length, body = http.byteranges_body(
+                ranges, size, headers.get("Content-type", "application/octet-stream"), read
+            )
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(length))
+
+        def parts():
+            try:
+                self.start_response("206 Partial Content", self.headers)
+                yield from body
+            finally:
+                f.close()
+
+        return parts()
+
 
 class StaticMiddleware:
     """WSGI middleware for serving static files."""
@@ -0,0 +1,244 @@
+"""
+JSON Utilities
+(from asyncio-webpy)
+
+Uses [orjson][] when it is installed and falls back to the standard `json` module otherwise.
+
+  [orjson]: https://github.com/ijl/orjson
+"""
+
+__all__ = ["JSONResponse", "jsonresponse"]
+
+import re
+import datetime
+import json as _json
+from collections.abc import Mapping
+
+from . import webapi as web
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, Mapping):
+        # like the rows of db queries
+        return dict(obj)
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+if orjson is not None:
+
+    def dumps(obj):
+        """Serializes `obj` to compact UTF-8 encoded JSON bytes."""
+        return orjson.dumps(obj, default=_default)
+
+    def loads(data):
+        """Deserializes JSON from `bytes` or `str`. Raises `ValueError` on invalid input."""
+        return orjson.loads(data)
+
+
+else:
+    _encoder = _json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_default)
+
+    def dumps(obj):
+        """Serializes `obj` to compact UTF-8 encoded JSON bytes."""
+        return _encoder.encode(obj).encode("utf-8")
+
+    def loads(data):
+        """Deserializes JSON from `bytes` or `str`. Raises `ValueError` on invalid input."""
+        return _json.loads(data)
+
+
+def iterencode(items, chunk_size=64 * 1024):
+    """
+    Encodes the iterable `items` as a JSON array, one element at a time,
+    yielding chunks of roughly `chunk_size` bytes.
+
+        >>> b"".join(iterencode(x * x for x in range(4)))
+        b'[0,1,4,9]'
+    """
+    buf = [b"["]
+    size = 1
+    for i, item in enumerate(items):
+        data = dumps(item)
+        if i:
+            buf.append(b",")
+        buf.append(data)
+        size += len(data) + 1
+        if size >= chunk_size:
+            yield b"".join(buf)
+            buf = []
+            size = 0
+    buf.append(b"]")
+    yield b"".join(buf)
+
+
+class JSONResponse:
+    """
+    Response body serialized as JSON.
+
+    Return it from a handler to send `obj` as `application/json`. Lists, tuples
+    with more than `stream_threshold` elements and any other iterable which is
+    not a mapping (such as a db row) or a string are streamed to the client
+    chunk by chunk.
+
+        class items:
+            def GET(self):
+                return web.JSONResponse(row for row in db.select("items"))
+    """
+
+    def __init__(self, obj, stream_threshold=1000, chunk_size=64 * 1024):
+        self.obj = obj
+        self.stream_threshold = stream_threshold
+        self.chunk_size = chunk_size
+        web.header("Content-Type", "application/json", unique=True)
+
+    def _streaming(self):
+        obj = self.obj
+        if isinstance(obj, (list, tuple)):
+            return len(obj) > self.stream_threshold
+        return not isinstance(obj, (Mapping, str, bytes)) and hasattr(obj, "__iter__")
+
+    def __body__(self):
+        if self._streaming():
+            return iterencode(self.obj, self.chunk_size)
+        return dumps(self.obj)
+
+
+jsonresponse = JSONResponse
+
+
+class ItemParser:
+    """
+    Incremental JSON parser yielding the elements of one array as soon as each is complete.
+
+    `path` selects the array: `None` for a top-level array, or a dotted path of
+    object keys, e.g. `"data.records"` for `{"data": {"records": [...]}}`. Only
+    the element currently being parsed is buffered, so memory stays
+    proportional to the largest element rather than to the whole document.
+
+        >>> p = ItemParser("records")
+        >>> list(p.feed(b'{"n": 2, "records": [{"a": "]"}, [2, '))
+        [{'a': ']'}]
+        >>> list(p.feed(b'3]]}'))
+        [[2, 3]]
+        >>> p.close()
+    """
+
+    _token = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{},"]', re.DOTALL)
+    # the rest of a string up to its closing quote, if any
+    _string_rest = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+
+    def __init__(self, path=None):
+        self.target = path.split(".") if path else []
+        self.buf = bytearray()
+        # where to scan from, and where the string left open by the last chunk starts
+        self.pos = 0
+        self.string = None
+        # one [kind, key, expects_key] entry per open object or array
+        self.stack = []
+        self.depth = None
+        self.start = None
+        # whether an element of the target array has been separated by a ','
+        self.separated = False
+        self.done = False
+        self.closed = False
+
+    def _at_target(self):
+        if self.done or len(self.stack) != len(self.target):
+            return False
+        return all(kind == 0x7B and key == name for (kind, key, _), name in zip(self.stack, self.target))
+
+    def feed(self, chunk):
+        """Feeds the next `chunk` of the document, returning the list of elements it completed."""
+        buf, stack, items = self.buf, self.stack, []
+        buf += chunk
+        pos = prev = self.pos
+        if self.string is not None:
+            # carry on scanning the open string where the last chunk stopped.
+            end = self._string_rest.match(buf, pos).end()
+            if end == len(buf) or buf[end] != 0x22:
+                return self._trim(end, items)
+            self._string(self.string, end + 1)
+            self.string = None
+            pos = prev = end + 1
+        end = len(buf)
+        for m in self._token.finditer(buf, pos):
+            start = m.start()
+            c = buf[start]
+            if not stack and (self.closed or (c != 0x7B and c != 0x5B) or buf[prev:start].strip()):
+                raise ValueError("invalid JSON document")
+            prev = m.end()
+            if c == 0x22:  # '"'
+                if m.end() - start == 1:
+                    # unterminated string, wait for more data
+                    self.string = start
+                    end = self._string_rest.match(buf, m.end()).end()
+                    break
+                self._string(start, m.end())
+            elif c == 0x7B or c == 0x5B:  # '{' or '['
+                if c == 0x5B and self._at_target():
+                    self.depth, self.start = len(stack) + 1, m.end()
+                stack.append([c, None, c == 0x7B])
+            elif c == 0x7D or c == 0x5D:  # '}' or ']'
+                # '{' + 2 == '}', '[' + 2 == ']'
+                if not stack or stack[-1][0] + 2 != c:
+                    raise ValueError("unbalanced JSON document")
+                if len(stack) == self.depth:
+                    self._emit(self.start, start, items, self.separated)
+                    self.depth = self.start = None
+                    self.done = True
+                stack.pop()
+                self.closed = not stack
+            else:  # ','
+                if len(stack) == self.depth:
+                    self._emit(self.start, start, items, True)
+                    self.start = m.end()
+                    self.separated = True
+                elif stack and stack[-1][0] == 0x7B:
+                    stack[-1][2] = True
+        else:
+            if not stack and buf[prev:].strip():
+                raise ValueError("invalid JSON document")
+        return self._trim(end, items)
+
+    def _string(self, start, end):
+        stack = self.stack
+        if stack and stack[-1][2]:
+            frame = stack[-1]
+            frame[2] = False
+            if len(stack) <= len(self.target):
+                frame[1] = _json.loads(bytes(self.buf[start:end]))
+
+    def _trim(self, pos, items):
+        # drop everything that is no longer needed, and carry on from `pos` with the next chunk.
+        cut = pos
+        for start in (self.start, self.string):
+            if start is not None:
+                cut = min(cut, start)
+        del self.buf[:cut]
+        self.pos = pos - cut
+        if self.start is not None:
+            self.start -= cut
+        if self.string is not None:
+            self.string -= cut
+        return items
+
+    def _emit(self, start, end, items, required):
+        data = bytes(self.buf[start:end]).strip()
+        if data:
+            items.append(loads(data))
+        elif required:
+            raise ValueError("missing array element")
+
+    def close(self):
+        """Checks that the whole document has been fed. Raises `ValueError` if it hasn't."""
+        if not self.closed or self.buf[self.pos :].strip():
+            raise ValueError("incomplete JSON document")
@@ -0,0 +1,389 @@
+"""
+Metrics
+(from asyncio-webpy)
+
+Counters, gauges and histograms exported in the Prometheus text format.
+
+    web.metrics.enable()
+    app.add_processor(web.metrics.processor)
+    urls = ("/metrics", web.metrics.handler(), ...)
+
+Each process only updates its own values. With prefork servers set
+`web.config.metrics_dir` to a directory shared by the workers: every worker
+writes its values there, and the `/metrics` page served by any of them adds
+up the counters and histograms of all the live ones. Gauges are merged as
+their `multiprocess` mode says.
+"""
+
+import asyncio
+import bisect
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+from . import webapi as web
+from .utils import intget
+
+__all__ = ["Counter", "Gauge", "Histogram", "Registry", "REGISTRY", "enable", "disable", "processor", "handler"]
+
+# set by `enable()`, checked by the instrumented code paths before measuring anything.
+enabled = False
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """A collection of metrics, exported together."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("metric %r is already registered" % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """Returns the current values as a JSON-serializable dict."""
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def write_snapshot(self, directory):
+        """Writes the values of this process to `directory`, for `collect` in other processes."""
+        path = os.path.join(directory, "metrics-%d.json" % os.getpid())
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def collect(self, directory=None):
+        """
+        Returns the merged snapshots of every process which wrote to
+        `directory`, or the snapshot of this process when it's None.
+        """
+        if directory is None:
+            return self.snapshot()
+        self.write_snapshot(directory)
+        merged = {}
+        for path in sorted(glob.glob(os.path.join(directory, "metrics-*.json"))):
+            pid = intget(os.path.basename(path)[len("metrics-") : -len(".json")])
+            if pid is None or not _alive(pid):
+                # left behind by a worker which exited.
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # being replaced or removed
+            for name, data in snapshot.items():
+                mode = data.get("multiprocess")
+                if name not in merged:
+                    merged[name] = dict(data, values={})
+                    if mode == "all":
+                        merged[name]["labelnames"] = list(data["labelnames"]) + ["pid"]
+                values = merged[name]["values"]
+                for key, value in data["values"].items():
+                    if mode == "all":
+                        key = json.dumps(json.loads(key) + [str(pid)])
+                    if key not in values:
+                        values[key] = value
+                    elif isinstance(value, list):
+                        values[key] = [a + b for a, b in zip(values[key], value)]
+                    elif mode == "max":
+                        values[key] = max(values[key], value)
+                    elif mode == "min":
+                        values[key] = min(values[key], value)
+                    else:
+                        values[key] += value
+        return merged
+
+    def exposition(self, directory=None):
+        """Returns the metrics in the Prometheus text exposition format."""
+        out = []
+        for name, data in sorted(self.collect(directory).items()):
+            out.append("# HELP %s %s" % (name, data["documentation"].replace("\\", "\\\\").replace("\n", "\\n")))
+            out.append("# TYPE %s %s" % (name, data["type"]))
+            labelnames = data["labelnames"]
+            for key, value in sorted(data["values"].items()):
+                labels = list(zip(labelnames, json.loads(key)))
+                if data["type"] == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(data["buckets"] + [math.inf], value[:-1]):
+                        cumulative += count
+                        out.append(_sample(name + "_bucket", labels + [("le", _number(bound))], cumulative))
+                    out.append(_sample(name + "_sum", labels, value[-1]))
+                    out.append(_sample(name + "_count", labels, cumulative))
+                else:
+                    out.append(_sample(name, labels, value))
+        return "\n".join(out) + "\n"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by someone else
+    return True
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _sample(name, labels, value):
+    if labels:
+        escaped = ('%s="%s"' % (k, _escape(v)) for k, v in labels)
+        name = "%s{%s}" % (name, ",".join(escaped))
+    return "%s %s" % (name, _number(value))
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        # held while labels are added, so that `snapshot` can copy them from another thread.
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+        registry.register(self)
+
+    def labels(self, *values):
+        """Returns the child metric for the given label values, creating it on first use."""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s expects labels %s" % (self.name, self.labelnames))
+            with self._lock:
+                # another thread may have created it meanwhile.
+                child = self.children.setdefault(values, self._child())
+        return child
+
+    def snapshot(self):
+        with self._lock:
+            children = list(self.children.items())
+        return {
+            "type": self.type,
+            "documentation": self.documentation,
+            "labelnames": self.labelnames,
+            "values": {json.dumps([str(v) for v in key]): child.get() for key, child in children},
+        }
+
+
+class _Value:
+    # updated from the worker threads of `AsyncDB` and executors as well as the event loop.
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class Counter(_Metric):
+    """A value which only goes up, like the number of requests served."""
+
+    type = "counter"
+    _child = _Value
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    A value which goes up and down, like the number of requests in flight.
+
+    `multiprocess` tells how the values of the workers sharing a
+    `metrics_dir` are merged: "all" exports each of them with a `pid`
+    label, "sum", "max" and "min" combine them into one.
+    """
+
+    type = "gauge"
+    _child = _Value
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY, multiprocess="all"):
+        if multiprocess not in ("all", "sum", "max", "min"):
+            raise ValueError("unknown multiprocess mode %r" % multiprocess)
+        self.multiprocess = multiprocess
+        super().__init__(name, documentation, labelnames, registry)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def snapshot(self):
+        return dict(super().snapshot(), multiprocess=self.multiprocess)
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Returns a context manager observing the time spent in it."""
+        return _Timer(self)
+
+    def get(self):
+        with self.lock:
+            return self.counts + [self.sum]
+
+
+class Histogram(_Metric):
+    """Counts observed values, like durations, in fixed buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return _Timer(self._default)
+
+    def snapshot(self):
+        return dict(super().snapshot(), buckets=list(self.buckets))
+
+
+REQUEST_SECONDS = Histogram(
+    "web_request_duration_seconds", "Time spent handling requests.", ["method", "route", "status"]
+)
+REQUESTS_IN_FLIGHT = Gauge("web_requests_in_flight", "Requests being handled.", multiprocess="sum")
+PROCESSOR_SECONDS = Histogram(
+    "web_processor_duration_seconds", "Time spent in each processor, including the ones it calls.", ["processor"]
+)
+DB_QUERIES = Counter("web_db_queries_total", "Database queries executed.")
+DB_QUERY_SECONDS = Histogram("web_db_query_duration_seconds", "Time spent executing database queries.")
+TEMPLATE_SECONDS = Histogram("web_template_render_seconds", "Time spent rendering templates.", ["template"])
+SESSION_STORE_SECONDS = Histogram(
+    "web_session_store_duration_seconds", "Time spent loading and saving sessions.", ["operation"]
+)
+LOOP_LAG_SECONDS = Histogram("web_event_loop_lag_seconds", "Delay of the event loop in running a periodic callback.")
+LOOP_BLOCKS = Counter(
+    "web_event_loop_blocked_total", "Times the event loop was blocked beyond the threshold.", ["route", "handler"]
+)
+
+
+def enable():
+    """Turns on the measurements of the framework's code paths."""
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+_last_write = [0.0]
+
+
+async def processor(handler):
+    """Processor measuring the number, duration and outcome of requests."""
+    if not enabled:
+        return await handler()
+
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = "500"
+    try:
+        result = await handler()
+        status = str(web.ctx.status).split(" ", 1)[0]
+        return result
+    except web.HTTPError:
+        status = str(web.ctx.status).split(" ", 1)[0]
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        route = web.ctx.get("route") or "<unmatched>"
+        REQUEST_SECONDS.labels(web.ctx.method, route, status).observe(time.perf_counter() - start)
+        _write_periodically()
+
+
+def _write_periodically():
+    directory = web.config.get("metrics_dir")
+    now = time.monotonic()
+    if directory and now - _last_write[0] > web.config.get("metrics_write_interval", 5):
+        _last_write[0] = now
+        asyncio.get_event_loop().run_in_executor(None, REGISTRY.write_snapshot, directory)
+
+
+def handler(registry=REGISTRY):
+    """Returns a handler class serving the metrics of `registry` in the Prometheus text format."""
+
+    class metrics:
+        def GET(self):
+            web.header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            return registry.exposition(web.config.get("metrics_dir"))
+
+    return metrics
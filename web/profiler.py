@@ -0,0 +1,557 @@
+"""
+Profiling
+(from asyncio-webpy)
+"""
+
+import asyncio
+import gc
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter, deque
+
+from . import metrics
+from . import webapi as web
+from .asgi import request_header
+
+__all__ = ["SamplingProfiler", "BlockingDetector", "MemoryProfiler"]
+
+logger = logging.getLogger("web.profiler")
+
+
+class _RequestSamples:
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = Counter()
+
+
+def _label(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the requests of an application, used as a processor.
+
+    While it is started, a thread looks at the event loop every `interval`
+    seconds and counts the stack of the request that is running, grouped
+    by the route the request was matched with. As requests are told apart by
+    their task, the samples of a request are attributed to it on both sides
+    of an `await`. With `wall=True` the stacks of the requests waiting in an
+    `await` are sampled as well, showing where time is spent rather than
+    where the CPU is spent.
+
+        profiler = web.SamplingProfiler()
+        app.add_processor(profiler)
+
+        profiler.start()
+        ...
+        profiler.stop()
+        print(profiler.top(20))
+        open("out.folded", "w").write(profiler.collapsed())  # for flamegraph.pl
+
+    When stopped, the processor only costs an attribute lookup per request.
+    """
+
+    def __init__(self, interval=0.005, wall=False, max_stacks=10000, max_depth=64):
+        self.interval = interval
+        self.wall = wall
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.enabled = False
+        self.thread = None
+        self.loop = None
+        self.loop_thread = None
+        self.active = {}
+        self.stacks = Counter()
+        self.dropped = 0
+        self._code = SamplingProfiler.__call__.__code__
+
+    def start(self):
+        """Starts sampling."""
+        self.enabled = True
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="web.SamplingProfiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops sampling. The samples taken so far are kept."""
+        self.enabled = False
+
+    def reset(self):
+        self.stacks = Counter()
+        self.dropped = 0
+
+    async def __call__(self, handler):
+        if not self.enabled:
+            return await handler()
+
+        if self.loop_thread is None:
+            self.loop = asyncio.get_event_loop()
+            self.loop_thread = threading.get_ident()
+        task = asyncio.current_task()
+        samples = self.active[task] = _RequestSamples()
+        try:
+            return await handler()
+        finally:
+            del self.active[task]
+            route = web.ctx.get("route") or web.ctx.get("path", "")
+            for stack, count in list(samples.counts.items()):
+                key = (route,) + stack
+                if key in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[key] += count
+                else:
+                    self.dropped += count
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if self.loop_thread is not None and self.active:
+                try:
+                    self.sample()
+                except Exception:
+                    pass  # a task finished while it was being looked at
+
+    def sample(self):
+        """Takes one sample of the running request, and of the waiting ones with `wall`."""
+        running = asyncio.tasks._current_tasks.get(self.loop)
+        samples = self.active.get(running)
+        if samples is not None:
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = self._frame_stack(frame)
+            if stack:
+                samples.counts[stack] += 1
+
+        if self.wall:
+            for task, samples in list(self.active.items()):
+                if task is not running:
+                    stack = self._await_stack(task)
+                    if stack:
+                        samples.counts[stack + ("(waiting)",)] += 1
+
+    def _frame_stack(self, frame):
+        """Returns the labels of the frames above this processor, outermost first."""
+        stack = []
+        while frame is not None and frame.f_code is not self._code:
+            stack.append(_label(frame.f_code))
+            frame = frame.f_back
+        if frame is None:
+            return None
+        return tuple(reversed(stack[-self.max_depth :]))
+
+    def _await_stack(self, task):
+        """Returns the labels along the chain of awaits of a suspended task, outermost first."""
+        stack = []
+        coro = task._coro
+        inside = False
+        while coro is not None and len(stack) < self.max_depth:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                break
+            if inside:
+                stack.append(_label(frame.f_code))
+            elif frame.f_code is self._code:
+                inside = True
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        return tuple(stack)
+
+    def collapsed(self):
+        """Returns the samples in the collapsed stack format read by flamegraph.pl and speedscope."""
+        return "".join("%s %d\n" % (";".join(stack), count) for stack, count in sorted(self.stacks.items()))
+
+    def top(self, n=20):
+        """Returns a table of the `n` functions with the most samples per route, by self and total samples."""
+        routes = {}
+        for (route, *stack), count in self.stacks.items():
+            total, own, inclusive = routes.setdefault(route, [0, Counter(), Counter()])
+            routes[route][0] += count
+            if stack:
+                own[stack[-1]] += count
+                for label in set(stack):
+                    inclusive[label] += count
+
+        out = []
+        for route, (total, own, inclusive) in sorted(routes.items(), key=lambda r: -r[1][0]):
+            out.append("%s (%d samples)" % (route, total))
+            out.append("  %6s %6s  %s" % ("self%", "total%", "function"))
+            for label, count in own.most_common(n):
+                out.append("  %6.1f %6.1f  %s" % (100.0 * count / total, 100.0 * inclusive[label] / total, label))
+            out.append("")
+        if self.dropped:
+            out.append("%d samples dropped, more than %d stacks" % (self.dropped, self.max_stacks))
+        return "\n".join(out)
+
+    def handler(self, token):
+        """
+        Returns a handler class for viewing and controlling the profiler over
+        HTTP. Requests must pass `token` in the `X-Profiler-Token` header or
+        the `token` query parameter, or get a 404.
+
+            urls = ("/_profile", profiler.handler(token=os.environ["PROFILER_TOKEN"]), ...)
+
+        `?action=start|stop|reset` controls sampling, `?format=collapsed`
+        returns collapsed stacks instead of the top table.
+        """
+        profiler = self
+
+        class profile:
+            def GET(self):
+                i = web.input(token="", action="", format="top")
+                _check_token(token, i.token)
+                if i.action in ("start", "stop", "reset"):
+                    getattr(profiler, i.action)()
+                web.header("Content-Type", "text/plain; charset=utf-8")
+                if i.format == "collapsed":
+                    return profiler.collapsed()
+                return profiler.top()
+
+        return profile
+
+
+def _check_token(token, given):
+    """Raises a 404 unless `token` is given in the `X-Profiler-Token` header or as `given`."""
+    given = request_header(web.ctx.scope, "X-Profiler-Token") or given
+    if not token or not hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+        raise web.notfound()
+
+
+_web_dir = os.path.dirname(os.path.abspath(__file__))
+_asyncio_dir = os.path.dirname(os.path.abspath(asyncio.__file__))
+
+
+class _Stall:
+    __slots__ = ("since", "task", "stack", "handler", "duration", "route", "claimed")
+
+    def __init__(self, since, task, stack, handler):
+        self.since = since
+        self.task = task
+        self.stack = stack
+        self.handler = handler
+        self.duration = None
+        self.route = None
+        self.claimed = False
+
+
+class BlockingDetector:
+    """
+    Watchdog reporting the code which blocks the event loop, used as a processor.
+
+    A callback on the event loop beats every `interval` seconds, and a
+    thread checks the beats. When the loop hasn't beaten for `threshold`
+    seconds, the thread captures the stack the loop is stuck in. Once the
+    loop is free again, the stall is logged as a warning on the
+    `web.profiler` logger with its duration, stack, the route of the
+    request it happened in and the handler: the outermost function outside
+    of this package. With `web.metrics` enabled, stalls are counted in
+    `web_event_loop_blocked_total` and every beat's lag is observed in
+    `web_event_loop_lag_seconds`.
+
+        detector = web.BlockingDetector(threshold=0.1)
+        app.add_processor(detector)
+        detector.start()
+
+    The last `max_reports` stalls are kept in `reports`.
+    """
+
+    def __init__(self, threshold=0.1, interval=0.01, max_depth=32, max_reports=100):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_depth = max_depth
+        self.enabled = False
+        self.loop = None
+        self.loop_thread = None
+        self.thread = None
+        self.active = {}
+        self.reports = deque(maxlen=max_reports)
+        self._beat_at = None
+        self._stall = None
+        self._timer = None
+        self._code = BlockingDetector.__call__.__code__
+
+    def start(self):
+        """Starts watching the event loop, right away when called from it or else on the first request."""
+        self.enabled = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._watch_loop()
+
+    def stop(self):
+        self.enabled = False
+        if self._timer is not None:
+            self._timer.cancel()
+        self.loop = self._timer = None
+
+    def _watch_loop(self):
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread = threading.get_ident()
+        self._beat_at = time.monotonic()
+        self._timer = self.loop.call_later(self.interval, self._beat)
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._watch, name="web.BlockingDetector", daemon=True)
+            self.thread.start()
+
+    async def __call__(self, handler):
+        if not self.enabled:
+            return await handler()
+        if self.loop is None:
+            self._watch_loop()
+
+        task = asyncio.current_task()
+        stalls = self.active[task] = []
+        try:
+            return await handler()
+        finally:
+            del self.active[task]
+            stall = self._stall
+            if stall is not None and stall.task is task and not stall.claimed:
+                # the request finished in the step which blocked, before the next beat.
+                # The stall stays in place until then, so that it isn't captured again.
+                stall.claimed = True
+                stall.duration = time.monotonic() - stall.since - self.interval
+                stalls.append(stall)
+            route = web.ctx.get("route") or web.ctx.get("path")
+            for stall in stalls:
+                stall.route = route
+                self._report(stall)
+
+    def _beat(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self._beat_at - self.interval)
+        if metrics.enabled:
+            metrics.LOOP_LAG_SECONDS.observe(lag)
+        stall = self._stall
+        self._stall = None
+        if stall is not None and stall.since == self._beat_at and not stall.claimed:
+            stall.duration = lag
+            stalls = self.active.get(stall.task)
+            if stalls is not None:
+                stalls.append(stall)
+            else:
+                self._report(stall)
+        self._beat_at = now
+        if self.enabled:
+            self._timer = self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            since = self._beat_at
+            if self._stall is None and since is not None and time.monotonic() - since > self.threshold:
+                try:
+                    self._capture(since)
+                except Exception:
+                    pass  # the loop moved on while it was being looked at
+
+    def _capture(self, since):
+        """Captures the stack the loop is stuck in, up to this processor or the event loop."""
+        task = asyncio.tasks._current_tasks.get(self.loop)
+        frame = sys._current_frames().get(self.loop_thread)
+        frames = []
+        while (
+            frame is not None
+            and frame.f_code is not self._code
+            and not frame.f_code.co_filename.startswith(_asyncio_dir)
+        ):
+            frames.append(frame)
+            frame = frame.f_back
+        handler = None
+        for frame in reversed(frames):
+            if not frame.f_code.co_filename.startswith(_web_dir):
+                handler = _label(frame.f_code)
+                break
+        stack = traceback.StackSummary.extract((f, f.f_lineno) for f in reversed(frames[: self.max_depth]))
+        self._stall = _Stall(since, task if task in self.active else None, "".join(stack.format()), handler)
+
+    def _report(self, stall):
+        self.reports.append(stall)
+        if metrics.enabled:
+            metrics.LOOP_BLOCKS.labels(stall.route or "", stall.handler or "").inc()
+        logger.getChild("BlockingDetector").warning(
+            "event loop blocked for %.3fs in %s (route %s)\n%s",
+            stall.duration,
+            stall.handler or "?",
+            stall.route or "-",
+            stall.stack,
+        )
+
+
+def _format_size(size):
+    if abs(size) < 1024:
+        return "%+d B" % size
+    if abs(size) < 1024 * 1024:
+        return "%+.1f KiB" % (size / 1024)
+    return "%+.1f MiB" % (size / (1024 * 1024))
+
+
+class _RouteMemory:
+    __slots__ = ("requests", "size", "count", "sites")
+
+    def __init__(self):
+        self.requests = 0
+        self.size = 0
+        self.count = 0
+        self.sites = Counter()
+
+
+class MemoryProfiler:
+    """
+    Memory profiler for the requests of an application, used as a processor.
+
+    While it is started, a `rate` fraction of the requests run between two
+    `tracemalloc` snapshots, the second one taken after a garbage collection
+    when `collect` is true. What is still allocated then has survived the
+    request: it is added up by route and by allocation site, and
+    `leaks()` lists the routes retaining the most memory per request.
+
+        memory = web.MemoryProfiler(rate=0.01)
+        app.add_processor(memory)
+        memory.start()
+        ...
+        print(memory.leaks())
+
+    `mark()` and `diff()` compare the whole process between two points in
+    time instead.
+
+    Snapshots are slow and block the event loop, so keep `rate` low in
+    production. One request is sampled at a time, but the allocations of
+    the requests running concurrently are counted along with its own.
+    """
+
+    def __init__(self, rate=0.01, frames=1, collect=True, max_sites=100):
+        self.rate = rate
+        self.frames = frames
+        self.collect = collect
+        self.max_sites = max_sites
+        self.enabled = False
+        self.routes = {}
+        self.marked = None
+        self._sampling = False
+        self._started = False
+        self._filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ]
+
+    def start(self):
+        """Starts tracing allocations, unless `tracemalloc` already does, and sampling requests."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started = True
+        self.enabled = True
+
+    def stop(self):
+        """Stops sampling, and tracing allocations if `start` began it. The results so far are kept."""
+        self.enabled = False
+        self.marked = None
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def reset(self):
+        self.routes = {}
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(self._filters)
+
+    def _key_type(self):
+        return "traceback" if self.frames > 1 else "lineno"
+
+    async def __call__(self, handler):
+        if not self.enabled or self._sampling or random.random() >= self.rate:
+            return await handler()
+
+        self._sampling = True
+        try:
+            before = self._snapshot()
+            try:
+                return await handler()
+            finally:
+                if self.collect:
+                    gc.collect()
+                diffs = self._snapshot().compare_to(before, self._key_type())
+                self._record(web.ctx.get("route") or web.ctx.get("path", ""), diffs)
+        finally:
+            self._sampling = False
+
+    def _record(self, route, diffs):
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = _RouteMemory()
+        stats.requests += 1
+        for diff in diffs:
+            stats.size += diff.size_diff
+            stats.count += diff.count_diff
+            if diff.size_diff > 0:
+                stats.sites[_site(diff.traceback)] += diff.size_diff
+        if len(stats.sites) > self.max_sites:
+            stats.sites = Counter(dict(stats.sites.most_common(self.max_sites)))
+
+    def leaks(self, n=10):
+        """Returns a report of the routes retaining the most memory per request, with their top `n` sites."""
+        out = []
+        ranked = sorted(self.routes.items(), key=lambda r: -r[1].size / r[1].requests)
+        for route, stats in ranked:
+            out.append(
+                "%s: %s, %+d objects retained per request (%d sampled)"
+                % (route, _format_size(stats.size / stats.requests), stats.count // stats.requests, stats.requests)
+            )
+            for site, size in stats.sites.most_common(n):
+                out.append("  %12s  %s" % (_format_size(size / stats.requests), site))
+            out.append("")
+        return "\n".join(out)
+
+    def mark(self):
+        """Snapshots the allocations of the whole process, for `diff`."""
+        self.marked = self._snapshot()
+
+    def diff(self, n=20):
+        """Returns the `n` allocation sites which grew the most since the last `mark`."""
+        if self.marked is None:
+            raise ValueError("mark() must be called first")
+        diffs = self._snapshot().compare_to(self.marked, self._key_type())
+        total = sum(d.size_diff for d in diffs)
+        out = ["%s in total since the mark" % _format_size(total)]
+        for d in diffs[:n]:
+            out.append("  %12s %+8d objects  %s" % (_format_size(d.size_diff), d.count_diff, _site(d.traceback)))
+        return "\n".join(out)
+
+    def handler(self, token):
+        """
+        Returns a handler class for viewing and controlling the profiler over
+        HTTP, protected by `token` like `SamplingProfiler.handler`.
+
+        `?action=start|stop|reset|mark` controls it, `?format=diff` returns
+        the difference since the mark instead of the leaks report.
+        """
+        profiler = self
+
+        class memory:
+            def GET(self):
+                i = web.input(token="", action="", format="leaks")
+                _check_token(token, i.token)
+                if i.action in ("start", "stop", "reset", "mark"):
+                    getattr(profiler, i.action)()
+                web.header("Content-Type", "text/plain; charset=utf-8")
+                if i.format == "diff":
+                    if profiler.marked is None:
+                        raise web.badrequest("no mark")
+                    return profiler.diff()
+                return profiler.leaks()
+
+        return memory
+
+
+def _site(tb):
+    """Formats the allocation site `tb`, innermost frame first."""
+    return " <- ".join("%s:%d" % (os.path.basename(f.filename), f.lineno) for f in reversed(tb))
@@ -13,7 +13,7 @@ import time
 from copy import deepcopy
 from hashlib import sha1
 
-from . import utils
+from . import metrics, utils
 from . import webapi as web
 
 __all__ = ["Session", "SessionExpired", "Store", "DiskStore", "DBStore"]
@@ -108,7 +108,11 @@ class Session(object):
 
         self._check_expiry()
         if self.session_id:
-            d = self.store[self.session_id]
+            if metrics.enabled:
+                with metrics.SESSION_STORE_SECONDS.labels("load").time():
+                    d = self.store[self.session_id]
+            else:
+                d = self.store[self.session_id]
             self.update(d)
             self._validate_ip()
 
@@ -140,7 +144,11 @@ class Session(object):
     def _save(self):
         if not self.get("_killed"):
             self._setcookie(self.session_id)
-            self.store[self.session_id] = dict(self._data)
+            if metrics.enabled:
+                with metrics.SESSION_STORE_SECONDS.labels("save").time():
+                    self.store[self.session_id] = dict(self._data)
+            else:
+                self.store[self.session_id] = dict(self._data)
         else:
             self._setcookie(self.session_id, expires=-1)
 
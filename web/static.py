@@ -0,0 +1,123 @@
+"""
+Static Assets
+(from asyncio-webpy)
+
+Fingerprints the files of the static directory, so they can be cached by
+browsers forever:
+
+    $ python -m web.static static/
+
+writes `static/manifest.json`, after which templates can use
+`$static_url('app.js')` to link to `/static/app.<hash>.js`.
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+
+from . import template
+from .webapi import config
+
+__all__ = ["StaticManifest", "static_url"]
+
+
+class StaticManifest:
+    """
+    Maps the files under `directory` to names carrying a hash of their content.
+
+        manifest = web.StaticManifest("static")
+        manifest.build()
+        manifest.url("app.js")  # "/static/app.3f2a1b9c0d4e.js"
+
+    The manifest is kept in `directory/filename` and loaded when it exists.
+    Set it as `web.config.static_manifest` to have `$static_url()` use it, and
+    pass it to `StaticMiddleware` to serve the fingerprinted names.
+    """
+
+    def __init__(self, directory="static", prefix="/static/", filename="manifest.json"):
+        self.directory = directory
+        self.prefix = prefix
+        self.path = os.path.join(directory, filename)
+        self.files = {}
+        self.originals = {}
+        if os.path.exists(self.path):
+            self.load()
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            self._set(json.load(f))
+
+    def _set(self, files):
+        self.files = files
+        self.originals = {v: k for k, v in files.items()}
+
+    def build(self, hash_length=12):
+        """Hashes every file under the directory and writes the manifest. Returns the mapping."""
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if path == self.path or filename.endswith(".gz"):
+                    # .gz siblings are found through the file they compress.
+                    continue
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                root, ext = posixpath.splitext(name)
+                files[name] = "%s.%s%s" % (root, _digest(path)[:hash_length], ext)
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(files, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+        self._set(files)
+        return files
+
+    def url(self, name):
+        """Returns the URL of the static file `name`, fingerprinted when it is in the manifest."""
+        return self.prefix + self.files.get(name, name)
+
+    def original(self, name):
+        """Returns the file name behind the fingerprinted `name`, or None."""
+        return self.originals.get(name)
+
+    def matches(self, name, path):
+        """Returns whether the fingerprinted `name` still carries the hash of the content of the file at `path`."""
+        original = self.originals.get(name)
+        if original is None:
+            return False
+        root, ext = posixpath.splitext(original)
+        digest = name[len(root) + 1 : len(name) - len(ext)]
+        return bool(digest) and _digest(path).startswith(digest)
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def static_url(name):
+    """
+    Returns the URL of the static file `name`, using `config.static_manifest`
+    when it is set. Available in templates as `$static_url(name)`.
+
+        >>> static_url("app.js")
+        '/static/app.js'
+    """
+    manifest = config.get("static_manifest")
+    if manifest is None:
+        return "/static/" + name
+    return manifest.url(name)
+
+
+template.Template.globals.setdefault("static_url", static_url)
+
+
+if __name__ == "__main__":
+    import sys
+
+    files = StaticManifest(sys.argv[1] if len(sys.argv) > 1 else "static").build()
+    print("%d files fingerprinted" % len(files))
@@ -38,6 +38,7 @@ import tokenize
 from collections import MutableMapping
 from io import open
 
+from . import metrics, timing, tracing
 from .net import websafe
 from .utils import re_compile, safestr, storage
 from .webapi import config
@@ -864,7 +865,11 @@ class BaseTemplate:
 
     def __call__(self, *a, **kw):
         __hidetraceback__ = True
-        return self.t(*a, **kw)
+        with tracing.child_span("template", template=self.filename), timing.measure("tpl", "templates"):
+            if metrics.enabled:
+                with metrics.TEMPLATE_SECONDS.labels(self.filename).time():
+                    return self.t(*a, **kw)
+            return self.t(*a, **kw)
 
     def make_env(self, globals, builtins):
         return dict(
@@ -0,0 +1,134 @@
+"""
+Server Timing
+(from asyncio-webpy)
+
+Breaks down the time spent on each request in a `Server-Timing` response
+header, readable in the network panel of browsers:
+
+    web.timing.enable()
+    app.add_processor(web.timing.processor)
+
+    Server-Timing: loadhook__load_;dur=0.1;desc="loadhook(_load)", handler;dur=12.3,
+        db;dur=8.2;desc="queries x3", tpl;dur=1.5;desc="templates", total;dur=22.4
+
+Each entry is the time spent in that part alone, in milliseconds: the time
+of a processor doesn't include the processors, handler, queries and
+templates it calls.
+"""
+
+import re
+import time
+
+from . import webapi as web
+
+__all__ = []
+
+# set by `enable()`, checked by the instrumented code paths before measuring anything.
+enabled = False
+
+_not_token = re.compile(r"[^!#$%&'*+\-.^_`|~0-9A-Za-z]")
+
+
+class _Timings:
+    __slots__ = ("entries", "nested")
+
+    def __init__(self):
+        # key -> [seconds, count, description]
+        self.entries = {}
+        self.nested = 0.0
+
+    def header(self):
+        values = []
+        for key, (seconds, count, desc) in self.entries.items():
+            value = "%s;dur=%.1f" % (key, seconds * 1000)
+            if count > 1:
+                desc = "%s x%d" % (desc or key, count)
+            if desc:
+                value += ';desc="%s"' % desc.replace("\\", "\\\\").replace('"', '\\"')
+            values.append(value)
+        return ", ".join(values)
+
+
+class _Measure:
+    __slots__ = ("timings", "key", "desc", "start", "outer")
+
+    def __init__(self, timings, key, desc):
+        self.timings = timings
+        self.key = key
+        self.desc = desc
+
+    def __enter__(self):
+        timings = self.timings
+        self.outer = timings.nested
+        timings.nested = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        timings = self.timings
+        entry = timings.entries.get(self.key)
+        if entry is None:
+            entry = timings.entries[self.key] = [0.0, 0, self.desc]
+        entry[0] += duration - timings.nested
+        entry[1] += 1
+        timings.nested = self.outer + duration
+
+
+class _Nothing:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_nothing = _Nothing()
+
+
+def measure(key, desc=None):
+    """
+    Returns a context manager adding the time spent in it to the `key` entry
+    of the current request's `Server-Timing` header. Does nothing unless
+    the request is timed.
+
+        with web.timing.measure("cache", "memcached"):
+            ...
+    """
+    if not enabled:
+        return _nothing
+    timings = web.ctx.get("server_timing")
+    if timings is None:
+        return _nothing
+    token = _not_token.sub("_", key)
+    if desc is None and token != key:
+        desc = key
+    return _Measure(timings, token, desc)
+
+
+def enable():
+    """Turns on the measurements of the framework's code paths."""
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+async def processor(handler):
+    """Processor timing the request and sending the `Server-Timing` header. Add it first to time every other one."""
+    if not enabled:
+        return await handler()
+
+    timings = web.ctx.server_timing = _Timings()
+    start = time.perf_counter()
+    try:
+        return await handler()
+    finally:
+        web.ctx.server_timing = None
+        timings.entries["total"] = [time.perf_counter() - start, 1, None]
+        web.header("Server-Timing", timings.header())
@@ -0,0 +1,342 @@
+"""
+Request Tracing
+(from asyncio-webpy)
+
+Spans measure the time spent in each part of a request. They nest through
+a context variable, so a span opened in a handler is the child of the
+processor span around it, across `await`s:
+
+    web.tracing.enable(web.tracing.JSONLinesExporter("traces.jsonl"))
+
+    class report:
+        @web.tracing.traced()
+        async def GET(self):
+            with web.tracing.span("aggregate", rows=len(rows)):
+                ...
+
+Once enabled, the framework opens spans for the request, each processor,
+the handler, database queries and template renders. Finished traces are
+given to the sampler, which by default keeps only the slow and failed ones,
+and the kept ones are written by the exporter.
+"""
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import re
+import time
+from inspect import iscoroutinefunction
+
+from . import webapi as web
+from .utils import BatchWriter
+
+__all__ = ["Span", "span", "traced", "TailSampler", "JSONLinesExporter"]
+
+logger = logging.getLogger("web.tracing")
+
+# set by `enable()`, checked by the instrumented code paths before opening spans.
+enabled = False
+_exporter = None
+_sampler = None
+
+_current = contextvars.ContextVar("web.tracing.span", default=None)
+
+_traceparent = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+def _new_id(nbytes):
+    return os.urandom(nbytes).hex()
+
+
+class _Trace:
+    __slots__ = ("spans", "dropped")
+
+    def __init__(self):
+        self.spans = []
+        self.dropped = 0
+
+
+class Span:
+    """
+    A timed operation within a trace, used as a context manager.
+
+    Exceptions escaping the span, other than `HTTPError`s, are recorded in
+    `error`. Attributes are exported with `str()` unless they are JSON
+    numbers, strings, booleans or None.
+    """
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "duration",
+        "attributes",
+        "error",
+        "_trace",
+        "_token",
+    )
+
+    max_spans = 1000
+
+    def __init__(self, name, parent=None, trace_id=None, parent_id=None, attributes=None):
+        self.name = name
+        self.span_id = _new_id(8)
+        if parent is not None:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self._trace = parent._trace
+        else:
+            self.trace_id = trace_id or _new_id(16)
+            self.parent_id = parent_id
+            self._trace = _Trace()
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = None
+        self.duration = None
+        self._token = None
+
+    @property
+    def is_root(self):
+        """True for the first span of the trace in this process."""
+        trace = self._trace
+        return bool(trace.spans) and trace.spans[0] is self
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        trace = self._trace
+        if len(trace.spans) < self.max_spans:
+            trace.spans.append(self)
+        else:
+            trace.dropped += 1
+        self.start = time.time()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.time() - self.start
+        if exc is not None and not isinstance(exc, web.HTTPError):
+            self.error = "%s: %s" % (exc_type.__name__, exc)
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # exited in another context than it was entered in.
+            _current.set(None)
+        if self.is_root:
+            _finish(self._trace)
+
+    def traceparent(self):
+        """Returns the W3C `traceparent` header value identifying this span."""
+        return "00-%s-%s-01" % (self.trace_id, self.span_id)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": {k: _jsonable(v) for k, v in self.attributes.items()},
+        }
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class _NoSpan:
+    """Stands for a span when tracing is disabled, at the cost of one function call."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def set(self, key, value):
+        pass
+
+
+_nospan = _NoSpan()
+
+
+def current():
+    """Returns the span the caller runs in, or None."""
+    return _current.get()
+
+
+def span(name, **attributes):
+    """
+    Returns a span named `name`, the child of the current span or the root
+    of a new trace when there is none.
+
+        with web.tracing.span("resize", width=640):
+            ...
+    """
+    if not enabled:
+        return _nospan
+    return Span(name, parent=_current.get(), attributes=attributes)
+
+
+def child_span(name, **attributes):
+    """Like `span`, but doesn't start a trace outside of one. Used by the framework's own spans."""
+    if not enabled:
+        return _nospan
+    parent = _current.get()
+    if parent is None:
+        return _nospan
+    return Span(name, parent=parent, attributes=attributes)
+
+
+def traced(name=None, **attributes):
+    """Decorator running every call of the decorated function, sync or async, in a span."""
+
+    def decorator(f):
+        span_name = name or f.__qualname__
+
+        if iscoroutinefunction(f):
+
+            @functools.wraps(f)
+            async def wrapper(*a, **kw):
+                with span(span_name, **attributes):
+                    return await f(*a, **kw)
+
+        else:
+
+            @functools.wraps(f)
+            def wrapper(*a, **kw):
+                with span(span_name, **attributes):
+                    return f(*a, **kw)
+
+        return wrapper
+
+    return decorator
+
+
+def request_span():
+    """
+    Returns the span of the current request: a child of the current span for
+    sub-applications, or the root of a trace continuing the one of the
+    `traceparent` request header, if any.
+    """
+    if not enabled:
+        return _nospan
+    parent = _current.get()
+    if parent is not None:
+        return Span("application", parent=parent)
+
+    from .asgi import request_header
+
+    trace_id = parent_id = None
+    header = request_header(web.ctx.scope, "traceparent")
+    if header:
+        m = _traceparent.match(header.strip().lower())
+        if m and m.group(1) != "0" * 32 and m.group(2) != "0" * 16:
+            trace_id, parent_id = m.group(1), m.group(2)
+    return _RequestSpan(web.ctx.method, trace_id=trace_id, parent_id=parent_id, attributes={"http.path": web.ctx.path})
+
+
+class _RequestSpan(Span):
+    __slots__ = ()
+
+    def __exit__(self, exc_type, exc, tb):
+        ctx = web.ctx
+        route = ctx.get("route")
+        if route:
+            self.name = "%s %s" % (ctx.method, route)
+            self.attributes["http.route"] = route
+        status = str(ctx.get("status", 500)).split(" ", 1)[0]
+        if exc is not None and not isinstance(exc, web.HTTPError):
+            status = "500"
+        self.attributes["http.status"] = status
+        if status.startswith("5"):
+            self.error = "HTTP " + status
+        Span.__exit__(self, exc_type, exc, tb)
+
+
+def traceparent():
+    """Returns the `traceparent` header to send along with outgoing requests, or None outside a trace."""
+    s = _current.get()
+    return s.traceparent() if s is not None else None
+
+
+def _finish(trace):
+    if _sampler is not None and not _sampler.keep(trace.spans):
+        return
+    if _exporter is not None:
+        try:
+            _exporter.export([s.to_dict() for s in trace.spans])
+        except Exception as exc:
+            logger.warning("exporting a trace failed", exc_info=exc)
+
+
+class TailSampler:
+    """
+    Decides which finished traces are kept: the ones whose root span lasted
+    at least `threshold` seconds, the ones with an error, plus a `rate`
+    fraction of the others.
+    """
+
+    def __init__(self, threshold=0.5, keep_errors=True, rate=0.0):
+        self.threshold = threshold
+        self.keep_errors = keep_errors
+        self.rate = rate
+
+    def keep(self, spans):
+        if spans[0].duration >= self.threshold:
+            return True
+        if self.keep_errors and any(s.error for s in spans):
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+
+class JSONLinesExporter(BatchWriter):
+    """
+    Writes traces to the file `path`, or to `stream`, one JSON object per
+    line and per trace, without blocking the event loop.
+
+    Traces are put on a queue of at most `queue_size` traces and written by
+    a background task in batches of up to `batch_size`, waiting up to
+    `flush_interval` seconds for a batch to fill. Traces which don't fit in
+    the queue are counted in `dropped`.
+    """
+
+    what = "traces"
+
+    def __init__(self, path=None, stream=None, queue_size=1000, batch_size=64, flush_interval=1.0):
+        super().__init__(path, stream, queue_size, batch_size, flush_interval)
+
+    def export(self, spans):
+        self.put({"trace_id": spans[0]["trace_id"], "spans": spans})
+
+    def format(self, trace):
+        return json.dumps(trace, separators=(",", ":"))
+
+
+def enable(exporter=None, sampler=None):
+    """
+    Turns on tracing, handing the traces kept by `sampler` (by default a
+    `TailSampler()`) to `exporter` (by default a `JSONLinesExporter()`
+    writing to stderr).
+    """
+    global enabled, _exporter, _sampler
+    _exporter = exporter if exporter is not None else JSONLinesExporter()
+    _sampler = sampler if sampler is not None else TailSampler()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
@@ -1,6 +1,7 @@
 # coding: utf8
 
 import typing
+from urllib.parse import unquote_to_bytes
 
 from .utils import safestr
 
@@ -83,6 +84,159 @@ class ImmutableDict(typing.Mapping):
         return f"<ImmutableDict {dict(self)!r}>"
 
 
+def _unquote(raw, encoding="utf-8"):
+    if b"+" in raw:
+        raw = raw.replace(b"+", b" ")
+    if b"%" in raw:
+        raw = unquote_to_bytes(raw)
+    return raw.decode(encoding, "replace")
+
+
+def _pieces(data):
+    """Yields the non-empty `&`-separated pieces of `data`."""
+    start = 0
+    while start <= len(data):
+        end = data.find(b"&", start)
+        if end < 0:
+            end = len(data)
+        if end > start:
+            yield data[start:end]
+        start = end + 1
+
+
+class QueryDict(typing.MutableMapping):
+    """
+    A multi-valued mapping over `application/x-www-form-urlencoded` data.
+
+    Keys and values are kept as the raw bytes of the request and are only
+    percent-decoded and converted to `str` when they are looked up. Keys are
+    matched exactly. As with `MutableDict`, a key with more than one value
+    returns the list of its values.
+
+        >>> q = QueryDict.parse(b"a=1&b=x%20y&a=2&c=")
+        >>> q["b"]
+        'x y'
+        >>> q["a"]
+        ['1', '2']
+        >>> q.b
+        'x y'
+        >>> list(q)
+        ['a', 'b']
+        >>> QueryDict.parse(b"a=1&b=2&c=3", max_fields=2)
+        Traceback (most recent call last):
+            ...
+        ValueError: too many fields
+    """
+
+    def __init__(self, pairs=(), encoding="utf-8"):
+        self._keys = []
+        self._values = []
+        self._index = None
+        self._encoding = encoding
+        for key, value in pairs:
+            self._keys.append(key)
+            self._values.append(value)
+
+    @classmethod
+    def parse(cls, data, max_fields=None, max_key_length=None, max_value_length=None, encoding="utf-8"):
+        """Splits `data` into raw `key=value` pairs, enforcing the given limits.
+
+        Raises `ValueError` when `data` has more than `max_fields` fields or a key or
+        value longer than `max_key_length` or `max_value_length` bytes (before decoding).
+        """
+        if isinstance(data, str):
+            data = data.encode(encoding)
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        if max_fields is None or data.count(b"&") < max_fields:
+            pieces = data.split(b"&")
+        else:
+            # too many pieces to split them all at once, maybe only empty ones.
+            pieces = _pieces(data)
+
+        self = cls(encoding=encoding)
+        keys, values = self._keys, self._values
+        fields = 0
+        for piece in pieces:
+            if not piece:
+                continue
+            fields += 1
+            if max_fields is not None and fields > max_fields:
+                raise ValueError("too many fields")
+            key, _, value = piece.partition(b"=")
+            # blank values are dropped, like `parse_qsl` does by default.
+            if not key or not value:
+                continue
+            if max_key_length is not None and len(key) > max_key_length:
+                raise ValueError("field name too long")
+            if max_value_length is not None and len(value) > max_value_length:
+                raise ValueError("field value too long")
+            keys.append(key)
+            values.append(value)
+        return self
+
+    def _lookup(self):
+        if self._index is None:
+            index = {}
+            for i, key in enumerate(self._keys):
+                if isinstance(key, bytes):
+                    key = self._keys[i] = _unquote(key, self._encoding)
+                index.setdefault(key, []).append(i)
+            self._index = index
+        return self._index
+
+    def _value(self, i):
+        value = self._values[i]
+        if isinstance(value, bytes):
+            value = self._values[i] = _unquote(value, self._encoding)
+        return value
+
+    def __getitem__(self, key):
+        positions = self._lookup().get(key)
+        if not positions:
+            raise KeyError(repr(key))
+        if len(positions) == 1:
+            return self._value(positions[0])
+        return [self._value(i) for i in positions]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        self._keys.append(key)
+        self._values.append(safestr(value) if isinstance(value, bytes) else value)
+        self._lookup()[key] = [len(self._keys) - 1]
+
+    def __delitem__(self, key):
+        positions = self._lookup().get(key)
+        if not positions:
+            raise KeyError(repr(key))
+        for i in reversed(positions):
+            del self._keys[i]
+            del self._values[i]
+        self._index = None
+
+    def __contains__(self, key):
+        return key in self._lookup()
+
+    def __iter__(self):
+        return iter(self._lookup())
+
+    def __len__(self):
+        return len(self._lookup())
+
+    def __getattr__(self, attr):
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    def __repr__(self):
+        return f"<QueryDict {dict(self)!r}>"
+
+
 class Validator(typing.Generic[Variable], DictValueValidatorMixin):
     pass
 
@@ -28,6 +28,7 @@ __all__ = [
     "iterbetter",
     "safeiter",
     "safewrite",
+    "BatchWriter",
     "dictreverse",
     "dictfind",
     "dictfindall",
@@ -58,6 +59,7 @@ __all__ = [
 import asyncio
 import contextvars
 import datetime
+import logging
 import os
 import re
 import subprocess
@@ -65,6 +67,7 @@ import sys
 import threading
 import time
 import traceback
+from collections import OrderedDict
 from io import StringIO
 
 from async_timeout import timeout as _timeout_ctx
@@ -444,11 +447,37 @@ def timelimit(timeout):
     return _1
 
 
+_missing = object()
+_cancelled = object()
+
+
+class _Call:
+    """A computation of `Memoize` in progress, which other threads can wait for."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
 class Memoize:
     """
     'Memoizes' a function, caching its return values for each input.
     If `expires` is specified, values are recalculated after `expires` seconds.
-    If `background` is specified, values are recalculated in a separate thread.
+    If `background` is specified, values are recalculated in a separate thread
+    (or task, for coroutine functions) while the expired value is returned.
+    If `maxsize` is specified, the least recently used values are dropped
+    beyond that many.
+
+    Concurrent calls with the same arguments share one computation. The
+    numbers of `hits`, `misses`, `evictions` and background `refreshes` are
+    counted.
 
         >>> calls = 0
         >>> def howmanytimeshaveibeencalled():
@@ -493,66 +522,165 @@ class Memoize:
         >>> threading.Thread(target=fastcalls).start()
         >>> time.sleep(.01)
         >>> fastcalls()
-        9
+        8
+        >>> fastcalls.hits, fastcalls.misses
+        (0, 2)
+        >>> square = memoize(lambda x: x * x, maxsize=2)
+        >>> [square(x) for x in (1, 2, 3, 1)]
+        [1, 4, 9, 1]
+        >>> square.evictions
+        2
     """
 
-    def __init__(self, func, expires=None, background=True):
+    def __init__(self, func, expires=None, background=True, maxsize=None):
         self.func = func
-        self.cache = {}
         self.expires = expires
         self.background = background
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
         self.running = {}
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.refreshes = 0
         self._is_async = asyncio.iscoroutinefunction(func)
 
     def __call__(self, *args, **keywords):
         key = (args, tuple(keywords.items()))
+        if self._is_async:
+            return self._async_call(key, args, keywords)
+
+        with self.lock:
+            value = self._lookup(key, args, keywords)
+            if value is not _missing:
+                return value
+            call = self.running.get(key)
+            leader = call is None
+            if leader:
+                call = self.running[key] = _Call()
+        if not leader:
+            return call.wait()
+        return self._compute(key, call, args, keywords)
+
+    def _lookup(self, key, args, keywords):
+        """Returns the cached value for `key`, or `_missing`. Starts a refresh when the value expired."""
+        item = self.cache.get(key)
+        if item is not None:
+            self.cache.move_to_end(key)
+            if not self.expires or time.monotonic() - item[1] <= self.expires:
+                self.hits += 1
+                return item[0]
+            if self.background:
+                self.hits += 1
+                if key not in self.running:
+                    self.refreshes += 1
+                    self._refresh(key, args, keywords)
+                return item[0]
+        self.misses += 1
+        return _missing
+
+    def _refresh(self, key, args, keywords):
+        if self._is_async:
+            self.running[key] = asyncio.get_event_loop().create_future()
+            asyncio.ensure_future(self._async_compute(key, self.running[key], args, keywords, background=True))
+        else:
+            call = self.running[key] = _Call()
 
-        async def async_update(block=False):
-            if self.running[key].locked and not block:
-                return self.cache[key][0]
-            async with self.running[key].acquire():
-                self.cache[key] = (await self.func(*args, **keywords), time.time())
-                return self.cache[key][0]
+            def refresh():
+                try:
+                    self._compute(key, call, args, keywords)
+                except Exception:
+                    pass  # keep serving the old value
 
-        def sync_update(block=False):
-            if self.running[key].acquire(blocking=block):
-                self.cache[key] = (self.func(*args, **keywords), time.time())
-            return self.cache[key][0]
+            threading.Thread(target=refresh, daemon=True).start()
 
-        if self._is_async:
-            lock_class = asyncio.Lock
-            update_func = async_update
+    def _compute(self, key, call, args, keywords):
+        try:
+            call.value = self.func(*args, **keywords)
+        except BaseException as e:
+            call.error = e
+            raise
         else:
-            lock_class = threading.Lock
-            update_func = sync_update
+            self._store(key, call.value)
+            return call.value
+        finally:
+            with self.lock:
+                if self.running.get(key) is call:
+                    del self.running[key]
+            call.event.set()
 
-        if not self.running.get(key):
-            self.running[key] = lock_class()
+    async def _async_call(self, key, args, keywords):
+        while True:
+            with self.lock:
+                value = self._lookup(key, args, keywords)
+                if value is not _missing:
+                    return value
+                future = self.running.get(key)
+                leader = future is None
+                if leader:
+                    future = self.running[key] = asyncio.get_event_loop().create_future()
+            if leader:
+                return await self._async_compute(key, future, args, keywords)
+            value = await asyncio.shield(future)
+            if value is not _cancelled:
+                return value
+            # the call computing it was cancelled, not this one: compute it again.
+
+    async def _async_compute(self, key, future, args, keywords, background=False):
+        try:
+            value = await self.func(*args, **keywords)
+        except asyncio.CancelledError:
+            # the waiters resume after `running` has been cleared below, and one of them computes it again.
+            if not future.done():
+                future.set_result(_cancelled)
+            raise
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+                # only the calls waiting on it care, don't warn when there are none.
+                future.exception()
+            if not background:
+                raise
+        else:
+            self._store(key, value)
+            if not future.done():
+                future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                if self.running.get(key) is future:
+                    del self.running[key]
+
+    def _store(self, key, value):
+        with self.lock:
+            self.cache[key] = (value, time.monotonic())
+            self.cache.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+
+    def invalidate(self, *args, **keywords):
+        """Drops the value cached for the given arguments."""
+        with self.lock:
+            self.cache.pop((args, tuple(keywords.items())), None)
 
-        if key not in self.cache:
-            self._awaitable = update_func(block=True)
-            return self._awaitable
-        elif self.expires and (time.time() - self.cache[key][1]) > self.expires:
-            if self.background:
-                if self._is_async:
-                    asyncio.create_task(update_func())
-                else:
-                    threading.Thread(target=update_func).start()
-            else:
-                self._awaitable = update_func()
-                return self._awaitable
-        return self.cache[key][0]
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
 
-    def __await__(self):
-        if self._awaitable:
-            return self._awaitable
-        else:
-            yield None
+    def stats(self):
+        """Returns the counters as a storage object."""
+        return Storage(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            refreshes=self.refreshes,
+            size=len(self.cache),
+        )
 
 
 memoize = Memoize
 
-re_compile = memoize(re.compile)  # @@ threadsafe?
+re_compile = memoize(re.compile, maxsize=1024)
 re_compile.__doc__ = """
 A memoized version of re.compile.
 """
@@ -797,6 +925,86 @@ def safewrite(filename, content):
     os.rename(f.name, filename)
 
 
+class BatchWriter:
+    """
+    Writes records as lines to the file `path`, or to `stream` (stderr by
+    default), without blocking the event loop.
+
+    `put` puts a record on a queue of at most `queue_size` records. A
+    background task takes up to `batch_size` records at a time, waiting
+    `flush_interval` seconds for a batch to fill, and writes them from a
+    worker thread. Records which don't fit in the queue are counted in
+    `dropped`. Subclasses define `format`, turning a record into a line.
+    """
+
+    # what is written, for the warning logged when writing fails.
+    what = "records"
+
+    def __init__(self, path=None, stream=None, queue_size=10000, batch_size=256, flush_interval=0.5):
+        self.path = path
+        self.stream = stream
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.queue = None
+        self.writer = None
+
+    def format(self, record):
+        raise NotImplementedError
+
+    def put(self, record):
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.queue_size)
+            self.writer = asyncio.ensure_future(self._write_batches())
+        try:
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _write_batches(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.flush_interval and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                data = "".join(self.format(record) + "\n" for record in batch)
+                await loop.run_in_executor(None, self._write, data)
+            except Exception as exc:
+                logging.getLogger(type(self).__module__).warning("writing %s failed", self.what, exc_info=exc)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, data):
+        if self.path is not None:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+        else:
+            stream = self.stream or sys.stderr
+            stream.write(data)
+            stream.flush()
+
+    async def flush(self):
+        """Waits until every queued record has been written."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def close(self):
+        """Writes the queued records and stops the background writer."""
+        await self.flush()
+        if self.writer is not None:
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+            self.queue = self.writer = None
+
+
 def dictreverse(mapping):
     """
     Returns a new dictionary with keys and values swapped.
@@ -1557,6 +1765,10 @@ class Context(object):
     `fullpath`
        : The full path requested, including query arguments (`== path + query`).
 
+    `route`
+       : The url pattern the request was matched with, prefixed by the patterns
+         of the sub applications it was delegated through.
+
     ### Response Data
 
     `status` (default: "200 OK")
@@ -1567,12 +1779,16 @@ class Context(object):
 
     `output`
        : A string to be used as the response.
+
+    `cleanups`
+       : Functions called once the response has been sent.
     """
 
     _instances = []
-    _vars = {}
 
     def __init__(self):
+        # one variable per name and instance, so that concurrent requests only ever see their own values.
+        object.__setattr__(self, "_vars", {})
         self.__class__._instances.append(self)
 
     #     self.__environ__ = contextvars.ContextVar("environ")
@@ -1590,23 +1806,31 @@ class Context(object):
     #     self.__output__ = contextvars.ContextVar("output")
 
     def __setattr__(self, name, value):
-        var = contextvars.ContextVar(name)
+        var = self._vars.get(name)
+        if var is None:
+            var = self._vars.setdefault(name, contextvars.ContextVar(name))
         var.set(value)
-        self._vars[name] = var
 
     def __getattr__(self, name):
         var = self._vars.get(name)
-        ctx = contextvars.copy_context()
-        if var and var in ctx:
-            return ctx[var]
-        else:
+        value = _missing if var is None else var.get(_missing)
+        if value is _missing:
             raise AttributeError(f"'{self.__class__.__name__}' has no attribute '{name}'")
+        return value
 
     def items(self):
-        return [(var.name, value) for var, value in contextvars.copy_context().items()]
+        return [(name, value) for name, value in self._items()]
+
+    def _items(self):
+        for name, var in list(self._vars.items()):
+            value = var.get(_missing)
+            if value is not _missing:
+                yield name, value
 
     def clear(self):
-        self._vars.clear()
+        """Unsets every value in the current context only."""
+        for var in list(self._vars.values()):
+            var.set(_missing)
 
     @classmethod
     def clear_all(cls):
@@ -1614,21 +1838,18 @@ class Context(object):
         cls._instances.clear()
 
     def __iter__(self):
-        return self._vars.keys()
+        return (name for name, _ in self._items())
 
     def get(self, key, default=None):
         var = self._vars.get(key)
-        if not var:
-            return default
-        return var.get()
+        value = _missing if var is None else var.get(_missing)
+        return default if value is _missing else value
 
     def update(self, *args, **kwargs):
         raise NotImplementedError
 
     def setdefault(self, key, default=None):
-        var = contextvars.ContextVar(key)
-        var.set(default)
-        self._vars[key] = var
+        self.__setattr__(key, default)
 
     def popitem(self):
         raise NotImplementedError
@@ -1637,32 +1858,37 @@ class Context(object):
         raise NotImplementedError
 
     def itervalues(self):
-        for var in self._vars.values():
-            yield var.get()
+        for _, value in self._items():
+            yield value
 
     def values(self):
         return list(self.itervalues())
 
     def iterkeys(self):
-        return self._vars.keys()
+        return iter(self)
 
     iter = keys = iterkeys
 
     def __contains__(self, key):
-        return key in self._vars
+        return self.get(key, _missing) is not _missing
 
     __setitem__ = __setattr__
 
     def __getitem__(self, key):
-        var = self._vars.get(key)
-        ctx = contextvars.copy_context()
-        if var and var in ctx:
-            return ctx[var]
-        else:
+        value = self.get(key, _missing)
+        if value is _missing:
             raise KeyError(key)
+        return value
 
     def __delitem__(self, key):
-        self._vars.pop(key)
+        if key not in self:
+            raise KeyError(key)
+        self._vars[key].set(_missing)
+
+    def __delattr__(self, name):
+        if name not in self:
+            raise AttributeError(name)
+        self._vars[name].set(_missing)
 
 
 if __name__ == "__main__":
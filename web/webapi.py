@@ -10,6 +10,10 @@ __all__ = [
     "input",
     "query",
     "data",
+    "json",
+    "json_items",
+    "body_chunks",
+    "stream_body",
     "setcookie",
     "cookies",
     "ctx",
@@ -34,7 +38,7 @@ __all__ = [
     "seeother",
     "notmodified",
     "tempredirect",
-    # 400, 401, 403, 404, 405, 406, 409, 410, 412, 415, 451
+    # 400, 401, 403, 404, 405, 406, 409, 410, 412, 413, 415, 451
     "BadRequest",
     "Unauthorized",
     "Forbidden",
@@ -44,7 +48,9 @@ __all__ = [
     "Conflict",
     "Gone",
     "PreconditionFailed",
+    "RequestEntityTooLarge",
     "UnsupportedMediaType",
+    "RangeNotSatisfiable",
     "UnavailableForLegalReasons",
     "badrequest",
     "unauthorized",
@@ -55,7 +61,9 @@ __all__ = [
     "conflict",
     "gone",
     "preconditionfailed",
+    "requestentitytoolarge",
     "unsupportedmediatype",
+    "rangenotsatisfiable",
     "unavailableforlegalreasons",
     # 500
     "InternalError",
@@ -65,12 +73,15 @@ __all__ = [
 import sys
 import pprint
 import logging
+import functools
 from http.cookies import Morsel, CookieError, SimpleCookie
-from urllib.parse import quote, unquote, parse_qsl
+from urllib.parse import quote, unquote
 
 import multipart
+import multipart.exceptions
+import multipart.multipart
 
-from . import types
+from . import types, jsonutils
 from .utils import Context, intget, dictadd, safestr, storage, storify
 from .py3helpers import urljoin
 
@@ -80,6 +91,35 @@ A configuration object for various aspects of web.py.
 
 `debug`
    : when True, enables reloading, disabled template caching and sets internalerror to debugerror.
+
+`form_max_fields`
+   : maximum number of fields accepted in a query string or form body (default: 1000).
+
+`form_max_key_length`, `form_max_value_length`
+   : maximum size in bytes of a single field name or value in a query string or form body (default: unlimited).
+     Fields of `multipart/form-data` bodies which aren't files are held in memory, so their values are limited
+     to `upload_max_memory_size` when `form_max_value_length` isn't set.
+
+`upload_dir`
+   : directory where uploaded files are spooled once they outgrow memory (default: system temp dir).
+
+`upload_max_memory_size`
+   : size in bytes up to which an uploaded file is kept in memory (default: 1 MiB).
+
+`upload_max_file_size`
+   : maximum size in bytes of a single uploaded file (default: unlimited).
+
+`upload_max_size`
+   : maximum size in bytes of a whole `multipart/form-data` body (default: unlimited).
+
+`etag_max_buffer`
+   : size in bytes up to which `http.autoetag` buffers a streamed body to hash it (default: 1 MiB).
+
+`metrics_dir`
+   : directory shared by the worker processes, where `web.metrics` merges their values (default: unset).
+
+`metrics_write_interval`
+   : seconds between two writes of the values of a worker to `metrics_dir` (default: 5).
 """
 
 logger = logging.getLogger("web.api")
@@ -320,6 +360,20 @@ class PreconditionFailed(HTTPError):
 preconditionfailed = PreconditionFailed
 
 
+class RequestEntityTooLarge(HTTPError):
+    """`413 Request Entity Too Large` error."""
+
+    message = "request entity too large"
+
+    def __init__(self, message=None):
+        status = "413 Request Entity Too Large"
+        headers = {"Content-Type": "text/html"}
+        super().__init__(status, headers, message or self.message)
+
+
+requestentitytoolarge = RequestEntityTooLarge
+
+
 class UnsupportedMediaType(HTTPError):
     """`415 Unsupported Media Type` error."""
 
@@ -334,6 +388,22 @@ class UnsupportedMediaType(HTTPError):
 unsupportedmediatype = UnsupportedMediaType
 
 
+class RangeNotSatisfiable(HTTPError):
+    """`416 Range Not Satisfiable` error."""
+
+    message = "range not satisfiable"
+
+    def __init__(self, size=None, message=None):
+        status = "416 Range Not Satisfiable"
+        headers = {"Content-Type": "text/html"}
+        if size is not None:
+            headers["Content-Range"] = "bytes */%d" % size
+        super().__init__(status, headers, message or self.message)
+
+
+rangenotsatisfiable = RangeNotSatisfiable
+
+
 class _UnavailableForLegalReasons(HTTPError):
     """`451 Unavailable For Legal Reasons` error."""
 
@@ -434,9 +504,21 @@ def input(*requireds, **defaults):
         raise badrequest()
 
 
+def _parse_params(raw):
+    try:
+        return types.QueryDict.parse(
+            raw,
+            max_fields=config.get("form_max_fields", 1000),
+            max_key_length=config.get("form_max_key_length"),
+            max_value_length=config.get("form_max_value_length"),
+        )
+    except ValueError as e:
+        raise badrequest(str(e))
+
+
 def query(**default_kwargs) -> types.QueryParams:
     """Returns the query params sent with the request."""
-    params: types.QueryParams = types.ImmutableDict(parse_qsl(ctx.query.strip("?")))
+    params: types.QueryParams = _parse_params(ctx.scope.get("query_string", b""))
     for key, value in default_kwargs.items():
         if key not in params:
             params[key] = value
@@ -446,12 +528,181 @@ def query(**default_kwargs) -> types.QueryParams:
 def data():
     """Returns the data sent with the request."""
     if "data" not in ctx:
+        if ctx.scope.get("receive") is not None:
+            raise RuntimeError("the request body is being streamed, read it with `web.body_chunks()`")
         cl = intget(ctx.scope["headers"].get("content_length"), 0)
         ctx.scope["input"].seek(0)
         ctx.data = ctx.scope["input"].read(cl)
     return ctx.data
 
 
+class _UploadFile(multipart.multipart.File):
+    """A `multipart` file part which refuses to grow beyond `MAX_FILE_SIZE` bytes."""
+
+    def on_data(self, data):
+        max_size = self._config.get("MAX_FILE_SIZE")
+        if max_size is not None and self._bytes_written + len(data) > max_size:
+            raise requestentitytoolarge()
+        return super().on_data(data)
+
+
+class _FormField(multipart.multipart.Field):
+    """A `multipart` field part which refuses to grow beyond `max_size` bytes."""
+
+    def __init__(self, name, max_size=None):
+        super().__init__(name)
+        self.max_size = max_size
+        self.size = 0
+
+    def on_data(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise requestentitytoolarge()
+        return super().on_data(data)
+
+
+class MultipartReader:
+    """
+    Incremental parser for `multipart/form-data` request bodies.
+
+    The body is fed chunk by chunk with `write` as it arrives, so only the
+    part currently being parsed is held in memory. Uploaded files are kept
+    in memory up to `config.upload_max_memory_size` bytes and spooled to
+    `config.upload_dir` after that. Other fields are kept in memory, up to
+    `config.form_max_value_length` bytes each, or `upload_max_memory_size`
+    by default. These limits, `config.upload_max_file_size` and
+    `config.upload_max_size` are enforced while the body is still streaming
+    in, raising `RequestEntityTooLarge` as soon as a limit is crossed.
+    Malformed or truncated bodies raise `BadRequest`.
+    """
+
+    def __init__(self, content_type):
+        content_type, params = multipart.multipart.parse_options_header(content_type)
+        self.fields = []
+        self.files = []
+        self.size = 0
+        self.max_size = config.get("upload_max_size")
+        self.max_fields = config.get("form_max_fields", 1000)
+        max_memory_size = config.get("upload_max_memory_size", 1024 * 1024)
+        max_value_length = config.get("form_max_value_length", max_memory_size)
+        try:
+            self.parser = multipart.FormParser(
+                content_type.decode("latin-1"),
+                self._on_field,
+                self._on_file,
+                boundary=params.get(b"boundary"),
+                FileClass=_UploadFile,
+                FieldClass=functools.partial(_FormField, max_size=max_value_length),
+                config={
+                    "UPLOAD_DIR": config.get("upload_dir"),
+                    "MAX_MEMORY_FILE_SIZE": max_memory_size,
+                    "MAX_FILE_SIZE": config.get("upload_max_file_size"),
+                },
+            )
+        except multipart.exceptions.FormParserError as e:
+            raise badrequest(str(e))
+
+    def _on_field(self, field):
+        if self.max_fields is not None and len(self.fields) >= self.max_fields:
+            raise badrequest("too many fields")
+        self.fields.append(field)
+
+    def _on_file(self, file):
+        file.file_object.seek(0)
+        self.files.append(file)
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise requestentitytoolarge()
+        try:
+            self.parser.write(chunk)
+        except multipart.exceptions.FormParserError as e:
+            raise badrequest(str(e))
+
+    def finalize(self):
+        # the parser accepts a body cut short without complaint.
+        if self.size and self.parser.parser.state != multipart.multipart.STATE_END:
+            raise badrequest("truncated multipart body")
+        try:
+            self.parser.finalize()
+        except multipart.exceptions.FormParserError as e:
+            raise badrequest(str(e))
+
+
+def json():
+    """Returns the request body decoded as JSON. Raises `BadRequest` if it isn't valid JSON."""
+    if "_json" not in ctx:
+        try:
+            ctx._json = jsonutils.loads(data())
+        except ValueError:
+            raise badrequest("invalid json")
+    return ctx._json
+
+
+def stream_body(handler):
+    """
+    Decorator for handler methods which consume the request body themselves,
+    with `body_chunks` or `json_items`, while it is still arriving.
+
+        class upload:
+            @web.stream_body
+            async def POST(self):
+                async for record in web.json_items("records"):
+                    ...
+    """
+    handler.stream_body = True
+    return handler
+
+
+async def body_chunks(chunk_size=64 * 1024):
+    """
+    Yields the request body chunk by chunk.
+
+    For handlers decorated with `stream_body` the chunks come straight from the
+    client as they arrive; otherwise the already buffered body is replayed.
+    """
+    receive = ctx.scope.get("receive")
+    if receive is None:
+        body = ctx.scope["input"]
+        body.seek(0)
+        for chunk in iter(lambda: body.read(chunk_size), b""):
+            yield chunk
+        return
+
+    # the body can only be received once.
+    ctx.scope["receive"] = None
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise badrequest("client disconnected")
+        more_body = message.get("more_body", False)
+        if message.get("body"):
+            yield message["body"]
+
+
+async def json_items(path=None):
+    """
+    Yields the elements of a JSON array in the request body one by one,
+    parsing them incrementally as the body is received.
+
+    `path` is a dotted path of object keys leading to the array, `None` for a
+    top-level array. Raises `BadRequest` if the body isn't valid JSON.
+
+        async for record in web.json_items("records"):
+            db.insert("records", **record)
+    """
+    parser = jsonutils.ItemParser(path)
+    try:
+        async for chunk in body_chunks():
+            for item in parser.feed(chunk):
+                yield item
+        parser.close()
+    except ValueError:
+        raise badrequest("invalid json")
+
+
 def form() -> types.Form:
     """Returns the form data sent with the request."""
 
@@ -464,11 +715,18 @@ def form() -> types.Form:
         files = formdata.setdefault("file", {})
         files[safestr(file.file_name)] = file.file_object
 
-    if ctx.scope["headers"].get("content_type", "").startswith("multipart/"):
+    reader = ctx.scope.get("multipart")
+    if reader is not None:
+        # already parsed while the body was being received.
+        for field in reader.fields:
+            on_field(field)
+        for file in reader.files:
+            on_file(file)
+    elif ctx.scope["headers"].get("content_type", "").startswith("multipart/"):
         ctx.scope["input"].seek(0)
         multipart.parse_form(ctx.scope["headers"], ctx.scope["input"], on_field, on_file)
-    elif ctx.scope["headers"].get("content_type", "") == "application/x-www-form-urlencoded":
-        formdata.update(parse_qsl(data()))
+    elif ctx.scope["headers"].get("content_type", "").startswith("application/x-www-form-urlencoded"):
+        return _parse_params(data())
 
     return types.ImmutableDict(formdata)
 